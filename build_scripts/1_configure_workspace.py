@@ -22,43 +22,55 @@ Step 1 in the CI Build Pipeline sequence.
 
 # %%
 import configargparse
+import configparser
 from copy import deepcopy
 import os
+import re
+import glob
 import json
-import requests
+import hashlib
 import shutil
 import subprocess
-from itertools import chain
+import sys
+from collections import defaultdict
 from build_config import (
+    ConfigError,
     get_extended_config,
     set_verbose_mode,
     write_config_file,
     print_verbose,
+    timed_span,
+    write_timing_report,
     unset_positive,
     unset_negative,
 )
-from build_utils import remove_nested_duplicates
+from build_utils import (
+    remove_nested_duplicates,
+    index_board_mappings,
+    BoardIndex,
+    BOARD_INDEX_FILE_NAME,
+    ExampleIndex,
+    load_json_file,
+    save_json_file,
+)
+from build_cache import (
+    configure_download_cache,
+    fetch_build_script_json,
+    get_download_cache_path,
+    save_build_script_file,
+)
 
 
 # %%
 def load_pio_to_arduino_mapping():
     """Download the platformio_to_arduino_boards.json file"""
-    print("Downloading board conversion file...")
-    response = requests.get(
-        "https://raw.githubusercontent.com/EnviroDIY/workflows/main/build_scripts/platformio_to_arduino_boards.json",
-        timeout=30,
-    )
-    response.raise_for_status()
+    print("Loading board conversion file...")
+    pio_to_acli = fetch_build_script_json("platformio_to_arduino_boards.json")
 
     # This is the dictionary of known mappings between PlatformIO board names and Arduino FQBNs
     # NOTE: Both PlatformIO board names and Arduino FQBNs are universally unique, so we can use them as keys and values in the dictionary.
     # PlatformIO environment names are unique within a given PlatformIO configuration file, but they are not universally unique, so we cannot use them as keys in the dictionary.
-    try:
-        pio_to_acli = response.json()
-        return pio_to_acli
-    except json.JSONDecodeError as e:
-        print("Error decoding JSON from platformio_to_arduino_boards.json:", e)
-        raise
+    return pio_to_acli
 
     # NOTE: We don't actually need this file, just the data from it.
     # #save the file locally to the CI directory for use in the build process
@@ -110,15 +122,10 @@ def load_arduino_cli_config(ci_path: str, artifact_path: str):
     if not os.path.isfile(arduino_cli_config):
         downloaded_arduino_cli_config = True
         print("Downloading default Arduino CLI configuration...")
-        # download the default file
-        response = requests.get(
-            "https://raw.githubusercontent.com/EnviroDIY/workflows/main/build_scripts/arduino_cli.yaml",
-            timeout=30,
-        )
-        response.raise_for_status()
         # copy to the CI directory
-        with open(os.path.join(ci_path, "arduino_cli.yaml"), "wb") as f:
-            f.write(response.content)
+        save_build_script_file(
+            "arduino_cli.yaml", os.path.join(ci_path, "arduino_cli.yaml")
+        )
         print("Saving Arduino CLI configuration to: {}".format(arduino_cli_config))
         # also copy to the artifacts directory
         shutil.copyfile(
@@ -145,15 +152,10 @@ def load_platformio_config(ci_path: str, artifact_path: str):
     if not os.path.isfile(pio_config_file):
         downloaded_pio_config = True
         print("Downloading default PlatformIO configuration...")
-        # download the default file
-        response = requests.get(
-            "https://raw.githubusercontent.com/EnviroDIY/workflows/main/build_scripts/platformio.ini",
-            timeout=30,
-        )
-        response.raise_for_status()
         # copy to the CI directory
-        with open(os.path.join(ci_path, "platformio.ini"), "wb") as f:
-            f.write(response.content)
+        save_build_script_file(
+            "platformio.ini", os.path.join(ci_path, "platformio.ini")
+        )
         print("Saving PlatformIO configuration to: {}".format(pio_config_file))
         # also copy to the artifacts directory
         shutil.copyfile(
@@ -182,7 +184,98 @@ def nested_list_to_dict(data):
     return data
 
 
+def read_platformio_config_in_process(pio_ini_dir: str) -> dict:
+    """
+    Read the computed project configuration with the installed PlatformIO package,
+    the same way `pio project config` does (including `extends`, the [env] section,
+    extra configs, and `${}` interpolation), without starting PlatformIO.
+    PlatformIO keeps the parsed configuration until the file is modified.
+    """
+    from platformio import fs
+    from platformio.exception import PlatformioException
+    from platformio.project.config import ProjectConfig
+
+    with fs.cd(pio_ini_dir):
+        try:
+            pio_config = ProjectConfig.get_instance(
+                os.path.join(os.getcwd(), "platformio.ini")
+            )
+            return {
+                section: pio_config.items(section, as_dict=True)
+                for section in pio_config.sections()
+            }
+        except (PlatformioException, configparser.Error) as exc:
+            raise RuntimeError(f"PlatformIO error: {exc}") from exc
+
+
+def get_platformio_config_key(pio_ini_dir: str) -> str | None:
+    """
+    Get a key for the output of `pio project config` for a project: a hash of its
+    platformio.ini and any extra config files, the project and PlatformIO core
+    directories they are resolved in, and the pio command.
+    Returns None if the output can not be keyed, ie, it depends on environment
+    variables or the extra config files can not be found without PlatformIO.
+    """
+    pio_ini_file = os.path.join(pio_ini_dir, "platformio.ini")
+    parser = configparser.ConfigParser(
+        inline_comment_prefixes=("#", ";"), interpolation=None
+    )
+    try:
+        parser.read(pio_ini_file, "utf-8")
+    except configparser.Error:
+        return None
+    extra_configs = parser.get("platformio", "extra_configs", fallback="")
+    if "${" in extra_configs:
+        return None
+
+    config_files = [pio_ini_file]
+    for pattern in re.split(r"[,\n]", extra_configs):
+        if pattern.strip() != "":
+            pattern = os.path.join(pio_ini_dir, os.path.expanduser(pattern.strip()))
+            config_files.extend(sorted(glob.glob(pattern, recursive=True)))
+
+    pio_command = shutil.which("pio") or ""
+    hasher = hashlib.sha256()
+    for part in [
+        os.path.abspath(pio_ini_dir),
+        os.environ.get("PLATFORMIO_CORE_DIR", ""),
+        pio_command,
+        str(os.path.getmtime(pio_command)) if pio_command else "",
+    ]:
+        hasher.update(part.encode("utf-8") + b"\0")
+    for config_file in config_files:
+        with open(config_file, "rb") as f:
+            content = f.read()
+        if b"${sysenv." in content:
+            return None
+        hasher.update(content + b"\0")
+    return hasher.hexdigest()
+
+
 def read_platformio_config(pio_ini_dir: str = "."):
+    """
+    Read the computed PlatformIO project configuration, as a dictionary of sections.
+
+    The configuration is read in-process with the PlatformIO package when it can be
+    imported. Otherwise, the output of `pio project config` is used, and saved in
+    the download cache by a hash of the configuration files, so the same
+    configuration does not start PlatformIO again.
+    """
+    try:
+        project_config = read_platformio_config_in_process(pio_ini_dir)
+        print_verbose("Read the PlatformIO config in-process")
+        return project_config
+    except ImportError:
+        print_verbose("The PlatformIO package can not be imported, running pio...")
+
+    config_key = get_platformio_config_key(pio_ini_dir)
+    cached_config_file = get_download_cache_path(
+        "platformio_configs", f"{config_key}.json"
+    )
+    if config_key is not None and os.path.isfile(cached_config_file):
+        print_verbose(f"Using the cached PlatformIO config {cached_config_file}")
+        return load_json_file(cached_config_file)
+
     result = subprocess.run(
         ["pio", "project", "config", "--json-output", "--project-dir", pio_ini_dir],
         capture_output=True,
@@ -204,6 +297,10 @@ def read_platformio_config(pio_ini_dir: str = "."):
     # The project config is returned as a list of lists, so we convert it to a dictionary for easier access.
     project_config = nested_list_to_dict(project_config_l)
 
+    if config_key is not None:
+        os.makedirs(os.path.dirname(cached_config_file), exist_ok=True)
+        save_json_file(cached_config_file, project_config)
+
     return project_config
 
 
@@ -253,6 +350,26 @@ def build_pio_mappings(
 
 
 # %%
+# The name indexes of the pairs of mapping dictionaries, by the ids of the dictionaries.
+# NOTE: The mapping dictionaries are not changed after they are built, so each pair
+# is only indexed once.
+board_mapping_indexes: dict[tuple[int, int], tuple[dict, dict, dict]] = {}
+
+
+def get_board_mapping_index(
+    primary_dict: dict[str, str], secondary_dict: dict[str, str | list[str]]
+) -> dict[str, list[list]]:
+    """Get the name index of a pair of mapping dictionaries, indexing them on first use"""
+    cache_key = (id(primary_dict), id(secondary_dict))
+    if cache_key not in board_mapping_indexes:
+        board_mapping_indexes[cache_key] = (
+            primary_dict,
+            secondary_dict,
+            index_board_mappings(primary_dict, secondary_dict),
+        )
+    return board_mapping_indexes[cache_key][2]
+
+
 def match_input_with_known_dicts(
     input_item,
     primary_dict: dict[str, str],
@@ -266,32 +383,33 @@ def match_input_with_known_dicts(
     The primary dictionary is expected to have unique keys and values,
     while the secondary dictionary may have non-unique values
     (e.g., multiple FQBNs for a single board name).
+    The names are looked up in an index of the dictionaries (see build_utils.BoardIndex).
     """
     if return_type.lower() not in ["keys", "values"]:
         raise ValueError(
             "return_type must be either 'keys' or 'values'. Got: {}".format(return_type)
         )
-    for match_dict in [primary_dict, secondary_dict]:
-        # first try to match with the keys, and return the key or value based on the return_type
-        for k, v in match_dict.items():
-            if input_item.lower() == k.lower():
-                return k if return_type.lower() == "keys" else v  # v may be a list!
-        # next try to match with the values, and return the key or value based on the return_type
-        for k, v in match_dict.items():
-            if isinstance(v, list):
-                for item in v:
-                    if input_item.lower() == item.lower():
-                        print_verbose(
-                            f"::notice::Matched input '{input_item}' with '{k}'"
-                        )
-                        return k if return_type.lower() == "keys" else item
-            else:
-                if input_item.lower() == v.lower():
-                    print_verbose(f"::notice::Matched input '{input_item}' with '{k}'")
-                    return k if return_type.lower() == "keys" else v
-    # if we get here, we didn't match
-    print(f"::warning:: '{input_item}' could not be matched!")
-    return None
+    return_keys = return_type.lower() == "keys"
+    matches = get_board_mapping_index(primary_dict, secondary_dict).get(
+        input_item.lower(), []
+    )
+    if len(matches) == 0:
+        print(f"::warning:: '{input_item}' could not be matched!")
+        return None
+    # report the names that match more than one different key or value
+    results = []
+    for k, v, _ in matches:
+        result = k if return_keys else v
+        if result not in results:
+            results.append(result)
+    if len(results) > 1:
+        print_verbose(
+            f"::notice::'{input_item}' is ambiguous, it matches {results}; using {results[0]}"
+        )
+    k, v, matched_value = matches[0]
+    if matched_value:
+        print_verbose(f"::notice::Matched input '{input_item}' with '{k}'")
+    return k if return_keys else v  # v may be a list!
 
 
 def match_inputs_with_known_dicts(
@@ -541,10 +659,31 @@ def get_arduino_fqbns_to_build(
 
 
 # %%
+def get_example_index(args) -> ExampleIndex:
+    """
+    Index the examples in the examples and extras paths, or load the index cached
+    in the download cache if none of the folders have changed since it was saved.
+    """
+    search_paths = [args.examples_path, args.extras_path]
+    cache_key = hashlib.sha256(
+        json.dumps([os.path.abspath(p) for p in search_paths]).encode("utf-8")
+    ).hexdigest()
+    example_index = ExampleIndex(
+        search_paths,
+        cache_file=get_download_cache_path("example_indexes", f"{cache_key}.json"),
+    )
+    print_verbose(
+        f"{'Loaded' if example_index.from_cache else 'Scanned'} the example index: "
+        f"{len(example_index.sketch_folders)} folders with sketches"
+    )
+    return example_index
+
+
 def parse_examples_to_build(args):
     """Parse examples from environment or find all examples"""
 
     examples_to_build = args.examples_to_build
+    example_index = None
 
     if examples_to_build not in unset_positive:
         # NOTE: if this function has already been called, the examples_to_build list
@@ -586,41 +725,34 @@ def parse_examples_to_build(args):
                 valid_examples.append(sub_dir_path)
             else:
                 ex_name = example.rsplit(os.path.sep, 1)[-1] + ".ino"
-                found_file = False
-                for root, subdirs, files in chain(
-                    os.walk(args.examples_path), os.walk(args.extras_path)
+                if example_index is None:
+                    example_index = get_example_index(args)
+                found_folders = example_index.find_sketch(ex_name)
+                # the excluded folders are not indexed, so also check the path itself
+                if len(found_folders) == 0 and os.path.isfile(
+                    os.path.join(args.workspace_path, example, ex_name)
                 ):
-                    for file in files:
-                        if file == ex_name:
-                            found_file = True
-                            sub_dir_path = os.path.relpath(
-                                os.path.join(root), args.workspace_path
-                            )
-                            valid_examples.append(sub_dir_path)
-                            print_verbose(
-                                f"Matched relative path: {example} (relative path: {sub_dir_path}; full path: {os.path.join(root, file)})"
-                            )
-                if not found_file:
+                    found_folders = [os.path.join(args.workspace_path, example)]
+                for root in found_folders:
+                    sub_dir_path = os.path.relpath(root, args.workspace_path)
+                    valid_examples.append(sub_dir_path)
+                    print_verbose(
+                        f"Matched relative path: {example} (relative path: {sub_dir_path}; full path: {os.path.join(root, ex_name)})"
+                    )
+                if len(found_folders) == 0:
                     print(f"::error::Example '{example}' does not exist!")
                     exit(1)
         examples_to_build = valid_examples
     else:
         print("Building all examples found in the example path.")
         examples_to_build = []
-        excluded_folders = [".history", "archive", "logger_test", "tests"]
-        for root, subdirs, files in chain(
-            os.walk(args.examples_path), os.walk(args.extras_path)
-        ):
-            for filename in files:
-                file_path = os.path.join(root, filename)
-                if filename == os.path.split(root)[-1] + ".ino" and not any(
-                    e in os.path.normpath(root).split(os.sep) for e in excluded_folders
-                ):
-                    sub_dir_path = os.path.relpath(root, args.workspace_path)
-                    examples_to_build.append(sub_dir_path)
-                    print_verbose(
-                        f"Found example: {filename} (relative path: {sub_dir_path}; full path: {file_path})"
-                    )
+        # the folders in build_utils.EXCLUDED_EXAMPLE_FOLDERS are not searched
+        for example in get_example_index(args).get_examples():
+            sub_dir_path = os.path.relpath(example["path"], args.workspace_path)
+            examples_to_build.append(sub_dir_path)
+            print_verbose(
+                f"Found example: {os.path.basename(example['sketch'])} (relative path: {sub_dir_path}; full path: {example['sketch']})"
+            )
 
         # Remove any ignored examples from the list
         ex_ignore = args.examples_to_ignore
@@ -651,6 +783,225 @@ def parse_examples_to_build(args):
     return examples_to_build
 
 
+# %%
+# Incremental builds
+
+# Changed files that can never change a compile
+DOCUMENTATION_EXTENSIONS = [
+    ".md",
+    ".txt",
+    ".rst",
+    ".dox",
+    ".png",
+    ".jpg",
+    ".jpeg",
+    ".gif",
+    ".svg",
+    ".pdf",
+    ".html",
+    ".css",
+]
+DOCUMENTATION_FILES = ["LICENSE", ".gitignore", ".gitattributes", "cspell.json"]
+DOCUMENTATION_FOLDERS = ["docs", "doc"]
+# Changed files that are followed through the include index
+SOURCE_EXTENSIONS = [".h", ".hpp", ".c", ".cpp", ".cc", ".ino", ".S", ".tpp", ".ipp"]
+INCLUDE_PATTERN = re.compile(r'^\s*#\s*include\s*[<"]([^>"]+)[>"]', re.MULTILINE)
+
+
+def get_changed_files(workspace_path: str, diff_base: str) -> list[str] | None:
+    """
+    List the files changed since the merge base of the diff base and HEAD, relative
+    to the workspace path. This includes any uncommitted changes.
+
+    Returns None if the changes cannot be found (ie, the diff base was not fetched).
+    """
+    try:
+        merge_base = subprocess.run(
+            ["git", "merge-base", diff_base, "HEAD"],
+            cwd=workspace_path,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+        changed_files = subprocess.run(
+            ["git", "diff", "--name-only", "--no-renames", "--relative", merge_base],
+            cwd=workspace_path,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.splitlines()
+    except (OSError, subprocess.CalledProcessError) as e:
+        stderr = getattr(e, "stderr", None) or str(e)
+        print(f"::warning::Unable to find the changes since {diff_base}: {stderr}")
+        return None
+    return [f for f in changed_files if f.strip() != ""]
+
+
+def read_includes(file_path: str) -> set[str]:
+    """Get the names (without folders) of the files included by a source file"""
+    try:
+        with open(file_path, "r", errors="ignore") as f:
+            return {os.path.basename(i) for i in INCLUDE_PATTERN.findall(f.read())}
+    except OSError:
+        return set()
+
+
+def get_source_stem(file_name: str) -> str:
+    """Get the name shared by a header and its source file (ie, 'Foo' for Foo.h and Foo.cpp)"""
+    return os.path.splitext(os.path.basename(file_name))[0]
+
+
+def build_include_index(args) -> dict[str, set[str]]:
+    """Map each library source file (outside the examples) to the files it includes"""
+    skip_paths = {
+        os.path.realpath(getattr(args, p))
+        for p in ["ci_path", "artifact_path", "examples_path", "extras_path"]
+    }
+    include_index: dict[str, set[str]] = {}
+    for root, subdirs, files in os.walk(args.workspace_path):
+        subdirs[:] = [
+            d
+            for d in subdirs
+            if not d.startswith(".")
+            and d != "home"  # where the compile jobs install the Arduino CLI
+            and os.path.realpath(os.path.join(root, d)) not in skip_paths
+        ]
+        for file in files:
+            if os.path.splitext(file)[1] in SOURCE_EXTENSIONS:
+                file_path = os.path.join(root, file)
+                include_index[os.path.relpath(file_path, args.workspace_path)] = (
+                    read_includes(file_path)
+                )
+    return include_index
+
+
+def is_in_example_folder(file_path: str, workspace_path: str) -> bool:
+    """Check if a file is in a sketch folder (one with an .ino of the same name)"""
+    folder = os.path.dirname(file_path)
+    while len(folder) > len(workspace_path):
+        if os.path.isfile(os.path.join(folder, os.path.basename(folder) + ".ino")):
+            return True
+        folder = os.path.dirname(folder)
+    return False
+
+
+def find_affected_examples(args, changed_files: list[str]) -> list[str] | None:
+    """
+    Find the examples that the changed files can affect.
+
+    - A change inside an example folder affects that example.
+    - A change to a library source file affects every example that includes it,
+      directly or through other library files. A header and the source files that
+      share its name are treated as one unit.
+    - Documentation changes affect nothing.
+    - Any other change (ie, to the library properties, the CI configuration, the
+      example dependencies, or the workflows) may affect every example.
+
+    Returns None if every example may be affected.
+    """
+    examples = {os.path.normpath(e): e for e in args.examples_to_build}
+    example_roots = [
+        os.path.relpath(getattr(args, p), args.workspace_path)
+        for p in ["examples_path", "extras_path"]
+    ]
+    affected_examples: set[str] = set()
+    changed_units: set[str] = set()
+
+    for changed_file in changed_files:
+        path = os.path.normpath(changed_file)
+        file_name = os.path.basename(path)
+        extension = os.path.splitext(file_name)[1]
+        in_example_root = any(path.startswith(r + os.sep) for r in example_roots)
+
+        example = next((e for e in examples if path.startswith(e + os.sep)), None)
+        if example is not None:
+            print_verbose(f"{changed_file} changes the example {examples[example]}")
+            affected_examples.add(examples[example])
+        elif (
+            extension.lower() in DOCUMENTATION_EXTENSIONS
+            or file_name in DOCUMENTATION_FILES
+            or path.split(os.sep)[0] in DOCUMENTATION_FOLDERS
+        ):
+            print_verbose(f"{changed_file} is documentation")
+        elif in_example_root and is_in_example_folder(
+            os.path.join(args.workspace_path, path), args.workspace_path
+        ):
+            print_verbose(f"{changed_file} is in an example that is not being built")
+        elif extension in SOURCE_EXTENSIONS and not in_example_root:
+            print_verbose(f"{changed_file} changes the library source")
+            changed_units.add(get_source_stem(file_name))
+        else:
+            print(f"{changed_file} may affect every example")
+            return None
+
+    if len(changed_units) > 0:
+        # spread the changes to every library file that includes a changed file
+        include_index = build_include_index(args)
+        units_including: dict[str, set[str]] = defaultdict(set)
+        for file_path, includes in include_index.items():
+            for include in includes:
+                units_including[get_source_stem(include)].add(
+                    get_source_stem(file_path)
+                )
+        to_check = list(changed_units)
+        while len(to_check) > 0:
+            for unit in units_including.get(to_check.pop(), set()):
+                if unit not in changed_units:
+                    changed_units.add(unit)
+                    to_check.append(unit)
+        print_verbose(f"Changed library files: {sorted(changed_units)}")
+
+        # then to every example that includes any of those files
+        for example in examples.values():
+            if example in affected_examples:
+                continue
+            for root, subdirs, files in os.walk(
+                os.path.join(args.workspace_path, example)
+            ):
+                example_includes = set()
+                for file in files:
+                    if os.path.splitext(file)[1] in SOURCE_EXTENSIONS:
+                        example_includes |= read_includes(os.path.join(root, file))
+                if any(get_source_stem(i) in changed_units for i in example_includes):
+                    print_verbose(f"The example {example} includes a changed file")
+                    affected_examples.add(example)
+                    break
+
+    return sorted(affected_examples)
+
+
+def select_affected_examples(args) -> list[str] | None:
+    """
+    If a diff base is set, find the examples affected by the changes since then and
+    save them to the args object for 3_build_matrix.py.
+    """
+    args.incremental_build = False
+    args.affected_examples = []
+    if args.diff_base in unset_negative:
+        return None
+
+    print(f"Finding the examples affected by the changes since {args.diff_base}...")
+    changed_files = get_changed_files(args.workspace_path, args.diff_base)
+    if changed_files is None:
+        print("Building every example.")
+        return None
+    print(f"Changed files: {len(changed_files)}")
+    for changed_file in changed_files:
+        print_verbose(f"  - {changed_file}")
+
+    affected_examples = find_affected_examples(args, changed_files)
+    if affected_examples is None:
+        print("Building every example.")
+        return None
+
+    args.incremental_build = True
+    args.affected_examples = affected_examples
+    print(f"Affected examples: {len(affected_examples)}")
+    for example in affected_examples:
+        print(f"  - {example}")
+    return affected_examples
+
+
 def clean_input_defines(args):
     """
     Clean the inline and compiler flags to remove any duplicates and empty strings and
@@ -710,16 +1061,24 @@ def clean_input_defines(args):
 
 
 # %%
-if __name__ == "__main__":
+def main(args: configargparse.Namespace | None = None) -> int:
+    """Configure the workspace and save the resolved boards, examples and flags to the config file"""
     print("=" * 60)
     print("CI Build Pipeline: Configure Matrix Workspace")
     print("=" * 60)
 
-    print_verbose(
-        "Reading configuration from environment variables, command line arguments, and the config file..."
-    )
-    args: configargparse.Namespace = get_extended_config()
+    if args is None:
+        print_verbose(
+            "Reading configuration from environment variables, command line arguments, and the config file..."
+        )
+        try:
+            with timed_span("Read the config"):
+                args = get_extended_config()
+        except ConfigError as e:
+            print(f"::error::{e}")
+            return 1
     set_verbose_mode(args.verbose)
+    configure_download_cache(args)
 
     # if the user has requested to build PlatformIO environments or if they have not
     # specified any boards to build, we will download the PlatformIO config to get all
@@ -731,20 +1090,22 @@ if __name__ == "__main__":
         print_verbose(
             "Looking for a PlatformIO config or downloading the default with all test environments..."
         )
-        pio_config_file, downloaded_pio_config = load_platformio_config(
-            args.ci_path, args.artifact_path
-        )
+        with timed_span("Download the PlatformIO config"):
+            pio_config_file, downloaded_pio_config = load_platformio_config(
+                args.ci_path, args.artifact_path
+            )
         args.pio_config_file = pio_config_file
         args.downloaded_pio_config = downloaded_pio_config
 
         # Read the PlatformIO config and build mapping dictionaries for boards and environments
         print_verbose("Reading the PlatformIO config...")
         pio_ini_dir = os.path.dirname(pio_config_file)
-        pio_config = read_platformio_config(pio_ini_dir)
-        print_verbose("Building mapping dictionaries...")
-        pio_env_to_board, pio_env_to_platform, board_to_pio_env = build_pio_mappings(
-            pio_config
-        )
+        with timed_span("Read the PlatformIO config"):
+            pio_config = read_platformio_config(pio_ini_dir)
+            print_verbose("Building mapping dictionaries...")
+            pio_env_to_board, pio_env_to_platform, board_to_pio_env = (
+                build_pio_mappings(pio_config)
+            )
     else:
         args.pio_config_file = None
         args.downloaded_pio_config = False
@@ -757,13 +1118,27 @@ if __name__ == "__main__":
     # typical build FQBNs and build the mapping dictionaries.
     if "arduino-cli" in args.compiler_list or args.boards_to_build in unset_positive:
         print_verbose("Loading PlatformIO to Arduino board conversion mapping...")
-        pio_board_to_fqbn = load_pio_to_arduino_mapping()
-        print_verbose("Building mapping dictionaries...")
-        pio_board_to_fqbn, board_to_fqbn = build_arduino_mappings(pio_board_to_fqbn)
+        with timed_span("Load the Arduino board mapping"):
+            pio_board_to_fqbn = load_pio_to_arduino_mapping()
+            print_verbose("Building mapping dictionaries...")
+            pio_board_to_fqbn, board_to_fqbn = build_arduino_mappings(pio_board_to_fqbn)
     else:
         pio_board_to_fqbn: dict[str, str] = {}
         board_to_fqbn: dict[str, str | list[str]] = {}
 
+    # Save an index of the board names, environments, and FQBNs for later stages and
+    # custom matrix builders
+    with timed_span("Save the board index"):
+        board_index = BoardIndex(
+            {
+                "pio_env": get_board_mapping_index(pio_env_to_board, board_to_pio_env),
+                "fqbn": get_board_mapping_index(pio_board_to_fqbn, board_to_fqbn),
+            }
+        )
+        args.board_index_file = os.path.join(args.artifact_path, BOARD_INDEX_FILE_NAME)
+        print_verbose(f"Saving the board index to: {args.board_index_file}")
+        board_index.save(args.board_index_file)
+
     if (
         args.boards_to_build in unset_positive
         or args.boards_to_ignore in unset_negative
@@ -771,9 +1146,10 @@ if __name__ == "__main__":
         print_verbose(
             "Compiling the list of common boards to build based on the inputs and the known boards..."
         )
-        common_boards = get_common_boards_to_build(
-            args, [pio_env_to_board, pio_board_to_fqbn]
-        )
+        with timed_span("Find the common boards"):
+            common_boards = get_common_boards_to_build(
+                args, [pio_env_to_board, pio_board_to_fqbn]
+            )
     else:
         common_boards = []
 
@@ -782,9 +1158,14 @@ if __name__ == "__main__":
         print_verbose(
             "Getting specifically requested PlatformIO environments and converting common boards to PlatformIO environments..."
         )
-        build_envs, build_platforms = get_pio_envs_to_build(
-            args, common_boards, pio_env_to_board, pio_env_to_platform, board_to_pio_env
-        )
+        with timed_span("Resolve the PlatformIO environments"):
+            build_envs, build_platforms = get_pio_envs_to_build(
+                args,
+                common_boards,
+                pio_env_to_board,
+                pio_env_to_platform,
+                board_to_pio_env,
+            )
         args.build_envs = build_envs
         args.build_platforms = build_platforms
     else:
@@ -796,9 +1177,10 @@ if __name__ == "__main__":
         print_verbose(
             "Getting specifically requested Arduino FQBNs and converting common boards to Arduino FQBNs..."
         )
-        build_fqbns, build_cores = get_arduino_fqbns_to_build(
-            args, common_boards, pio_board_to_fqbn, board_to_fqbn
-        )
+        with timed_span("Resolve the Arduino FQBNs"):
+            build_fqbns, build_cores = get_arduino_fqbns_to_build(
+                args, common_boards, pio_board_to_fqbn, board_to_fqbn
+            )
         args.build_fqbns = build_fqbns
         args.build_cores = build_cores
 
@@ -806,9 +1188,10 @@ if __name__ == "__main__":
         # Save to args namespace for later use
         # NOTE: This does NOT contain a list of boards or specific build environments!
         print_verbose("Looking for an Arduino CLI config and downloading if needed...")
-        arduino_cli_config, downloaded_arduino_cli_config = load_arduino_cli_config(
-            args.ci_path, args.artifact_path
-        )
+        with timed_span("Download the Arduino CLI config"):
+            arduino_cli_config, downloaded_arduino_cli_config = (
+                load_arduino_cli_config(args.ci_path, args.artifact_path)
+            )
         args.arduino_cli_config = arduino_cli_config
         args.downloaded_arduino_cli_config = downloaded_arduino_cli_config
     else:
@@ -821,21 +1204,40 @@ if __name__ == "__main__":
     print_verbose(
         "Parsing examples to build based on the inputs and the examples found in the examples path..."
     )
-    parse_examples_to_build(args)
+    with timed_span("Find the examples"):
+        parse_examples_to_build(args)
+
+    # If a diff base is given, find which of those examples the changes affect
+    with timed_span("Find the affected examples"):
+        select_affected_examples(args)
 
     # clean the inline and compiler flags to remove duplicates and empty strings
     print_verbose(
         "Cleaning inline and compiler flags to remove duplicates and empty strings..."
     )
-    clean_input_defines(args)
+    with timed_span("Clean the flags"):
+        clean_input_defines(args)
 
     # Save to file for next script
     print_verbose("Writing updated configuration to file...")
-    config_file = write_config_file(args)
+    try:
+        with timed_span("Write the config"):
+            config_file = write_config_file(args)
+    except ConfigError as e:
+        print(f"::error::{e}")
+        return 1
 
     print(f"\n✓ Configuration saved to: {config_file}")
     print("✓ Workspace setup complete")
 
+    write_timing_report("Configure Matrix Workspace", args.artifact_path)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
+
 
 # %%
 # CSpell:ignore argparser
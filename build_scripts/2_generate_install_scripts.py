@@ -4,9 +4,11 @@ Generate Platform and Library Installation Scripts.
 
 Part of the CI Build Pipeline. This step:
 - Loads platform and board configurations
-- Loads library and example dependencies from library.json and example_dependencies.json
+- Loads library and example dependencies from library.json and example_dependencies.json,
+  and resolves them into one list without duplicates
 - Generates bash installation scripts for both Arduino CLI and PlatformIO cores/platforms
 - Generates bash installation scripts for libraries and examples
+- Writes a manifest of the package bundles the scripts install, with their hashes
 - Outputs scripts to artifacts directory
 
 Step 2 in the CI Build Pipeline sequence.
@@ -14,10 +16,25 @@ Step 2 in the CI Build Pipeline sequence.
 
 # %%
 import os
+import sys
 import json
+import shlex
 from typing import List
-import requests
-from build_config import get_extended_config, set_verbose_mode, print_verbose
+import configargparse
+from build_config import (
+    ConfigError,
+    get_extended_config,
+    set_verbose_mode,
+    print_verbose,
+    timed_span,
+    write_timing_report,
+)
+from build_cache import configure_download_cache, fetch_build_script_json
+from package_bundles import (
+    MANIFEST_FILE_NAME,
+    create_package_manifest,
+    write_package_manifest,
+)
 
 from platformio.package.meta import PackageSpec
 
@@ -57,6 +74,60 @@ echo "\\e[32mCurrent PlatformIO version:\\e[0m"
 pio --version
 """
 
+# Parallel download of the cores before they are installed one at a time.
+# Any core that fails to download here is downloaded again by its install command.
+ACLI_PLATFORM_DOWNLOAD_TEXT = """
+echo "::group::Downloading cores"
+echo "\\e[32mDownloading {0} cores, {1} at a time\\e[0m"
+printf "%s\\n" {2} | xargs -P {1} -I {{}} arduino-cli --config-file "{3}" core download {{}} || echo "Some cores could not be downloaded; they will be downloaded again when they are installed"
+echo "::endgroup::"
+"""
+
+# Parallel download and unpacking of the platforms and tools before they are
+# installed one at a time. PlatformIO locks the whole package folder while it
+# installs a package, so each package is installed into its own staging folder
+# instead, and then moved into place. The downloads share the PlatformIO download
+# cache, which locks each download on its own. The install commands that follow
+# then find every package already installed, and install anything that was missed.
+PIO_PLATFORM_PREFETCH_TEXT = """
+echo "::group::Downloading platforms and tools"
+echo "\\e[32mDownloading and unpacking {0} packages, {1} at a time\\e[0m"
+pio_staging="$(mktemp -d)"
+cat > "$pio_staging/packages.txt" <<'PACKAGES'
+{2}
+PACKAGES
+xargs -P {1} -L 1 sh -c '
+    staging="$0/$1/$(echo "$2" | cksum | cut -d " " -f 1)"
+    mkdir -p "$staging"
+    if [ "$1" = "platform" ]; then
+        export PLATFORMIO_PLATFORMS_DIR="$staging"
+    else
+        export PLATFORMIO_PACKAGES_DIR="$staging"
+    fi
+    if pio pkg install -g --"$1" "$2" --skip-dependencies --silent > "$staging.log" 2>&1; then
+        echo "Downloaded $2"
+    else
+        echo "Could not download $2; it will be installed below"
+    fi
+' "$pio_staging" < "$pio_staging/packages.txt"
+pio_core_dir="${{PLATFORMIO_CORE_DIR:-$HOME/.platformio}}"
+for kind in platform tool; do
+    if [ "$kind" = "platform" ]; then
+        target_dir="${{PLATFORMIO_PLATFORMS_DIR:-$pio_core_dir/platforms}}"
+    else
+        target_dir="${{PLATFORMIO_PACKAGES_DIR:-$pio_core_dir/packages}}"
+    fi
+    mkdir -p "$target_dir"
+    for staged in "$pio_staging/$kind"/*/*; do
+        if [ -d "$staged" ] && [ ! -e "$target_dir/$(basename "$staged")" ]; then
+            mv "$staged" "$target_dir/"
+        fi
+    done
+done
+rm -rf "$pio_staging"
+echo "::endgroup::"
+"""
+
 PIO_PLATFORM_END_TEXT = """
 echo "::group::Package List"
 echo "\\e[32mCurrently installed packages:\\e[0m"
@@ -100,6 +171,64 @@ pio pkg list -g -v --only-libraries
 echo "::endgroup::"
 """
 
+# The lock files the library installation scripts record the installed libraries
+# in, next to the libraries so they are cached with them
+ACLI_LIBRARY_LOCK_FILE = "home/arduino/user/library.lock"
+PIO_LIBRARY_LOCK_FILE = (
+    "${PLATFORMIO_GLOBALLIB_DIR:-${PLATFORMIO_CORE_DIR:-$HOME/.platformio}/lib}"
+    "/.library.lock"
+)
+
+LIBRARY_LOCK_TEXT = """
+lock_file="{0}"
+mkdir -p "$(dirname "$lock_file")"
+touch "$lock_file"
+"""
+
+# Parallel download of the libraries that are not in the lock file yet, before they
+# are installed one at a time. Any library that fails to download here is downloaded
+# again by its install command.
+ACLI_LIBRARY_DOWNLOAD_TEXT = """
+echo "::group::Downloading libraries"
+echo "\\e[32mDownloading up to {0} libraries, {1} at a time\\e[0m"
+while IFS= read -r library; do
+    grep -qxF -- "$library" "$lock_file" || printf "%s\\n" "$library"
+done <<'LIBRARIES' | xargs -P {1} -I {{}} arduino-cli --config-file "{3}" lib download "{{}}" || echo "Some libraries could not be downloaded; they will be downloaded again when they are installed"
+{2}
+LIBRARIES
+echo "::endgroup::"
+"""
+
+# Parallel download and unpacking of the libraries that are not in the lock file yet.
+# As for the platforms, each library is installed into its own staging folder and
+# then moved into the global library folder, where its install command finds it.
+PIO_LIBRARY_PREFETCH_TEXT = """
+echo "::group::Downloading libraries"
+echo "\\e[32mDownloading and unpacking up to {0} libraries, {1} at a time\\e[0m"
+pio_staging="$(mktemp -d)"
+while IFS= read -r library; do
+    grep -qxF -- "$library" "$lock_file" || printf "%s\\n" "$library"
+done <<'LIBRARIES' | xargs -P {1} -I {{}} sh -c '
+    staging="$0/$(echo "$1" | cksum | cut -d " " -f 1)"
+    if pio pkg install -g --storage-dir "$staging" --library "$1" --skip-dependencies --silent > "$staging.log" 2>&1; then
+        echo "Downloaded $1"
+    else
+        echo "Could not download $1; it will be installed below"
+    fi
+' "$pio_staging" "{{}}"
+{2}
+LIBRARIES
+target_dir="${{PLATFORMIO_GLOBALLIB_DIR:-${{PLATFORMIO_CORE_DIR:-$HOME/.platformio}}/lib}}"
+mkdir -p "$target_dir"
+for staged in "$pio_staging"/*/*; do
+    if [ -d "$staged" ] && [ ! -e "$target_dir/$(basename "$staged")" ]; then
+        mv "$staged" "$target_dir/"
+    fi
+done
+rm -rf "$pio_staging"
+echo "::endgroup::"
+"""
+
 # Special installation scripts for non-standard libraries
 INSTALL_SDI12_EXT_ACLI = """echo "\\e[32mDownloading External Interrupt version of the SDI-12 library as a zip\\e[0m"
 curl -L --retry 15 --retry-delay 0 https://github.com/EnviroDIY/Arduino-SDI-12/archive/refs/heads/ExtInts.zip --create-dirs -o home/arduino/downloads/EnviroDIY_SDI12_ExtInts.zip
@@ -128,13 +257,8 @@ mv home/arduino/downloads/SoftwareSerial_ExtInts-master/* home/arduino/user/libr
 
 def load_pio_tools():
     """Download the platformio_platform_tools.json file"""
-    print("Downloading tools file...")
-    response = requests.get(
-        "https://raw.githubusercontent.com/EnviroDIY/workflows/main/build_scripts/platformio_platform_tools.json",
-        timeout=30,
-    )
-    response.raise_for_status()
-    return response.json()
+    print("Loading tools file...")
+    return fetch_build_script_json("platformio_platform_tools.json")
     # NOTE: We don't actually need this file, just the data from it.
     # pio_tools_file = os.path.join(ci_path, "platformio_platform_tools.json")
     # print("Saving tools file to: {}".format(pio_tools_file))
@@ -225,22 +349,20 @@ def convert_dep_dict_to_str(dependency: dict, include_version: bool = True) -> s
     return install_str
 
 
-def create_arduino_cli_lib_command(library: dict, include_version: bool = True) -> str:
-    """Generate Arduino CLI library installation command"""
-    arduino_command_args = [
-        "arduino-cli",
-        "--config-file",
-        '"{0}"',  # Will be formatted later
-        "lib",
-        "install",
+def is_arduino_cli_git_library(library: dict) -> bool:
+    """Check if the Arduino CLI installs a library from its git repository"""
+    return "github" in library.get("version", "") or library.get("name") in [
+        "MS5803",
+        "DallasTemperature",
     ]
 
+
+def get_arduino_cli_lib_spec(library: dict, include_version: bool = True) -> str:
+    """Get the library argument for arduino-cli lib install/download"""
     if "github" in library.get("version", ""):
-        arduino_command_args.append("--git-url")
-        arduino_command_args.append(library["version"])
+        return library["version"]
     elif library.get("name") in ["MS5803", "DallasTemperature"]:
-        arduino_command_args.append("--git-url")
-        arduino_command_args.append(library.get("url", ""))
+        return library.get("url", "")
     elif include_version:
         clean_version = (
             library.get("version", "")
@@ -250,9 +372,28 @@ def create_arduino_cli_lib_command(library: dict, include_version: bool = True)
             .replace("=", "")
             .replace("^", "")
         )
-        arduino_command_args.append(f"\"{library['name']}@{clean_version}\"")
+        return f"{library['name']}@{clean_version}"
+    else:
+        return library["name"]
+
+
+def create_arduino_cli_lib_command(library: dict, include_version: bool = True) -> str:
+    """Generate Arduino CLI library installation command"""
+    arduino_command_args = [
+        "arduino-cli",
+        "--config-file",
+        '"{0}"',  # Will be formatted later
+        "lib",
+        "install",
+    ]
+
+    if is_arduino_cli_git_library(library):
+        arduino_command_args.append("--git-url")
+        arduino_command_args.append(get_arduino_cli_lib_spec(library))
     else:
-        arduino_command_args.append(f"\"{library['name']}\"")
+        arduino_command_args.append(
+            f'"{get_arduino_cli_lib_spec(library, include_version)}"'
+        )
 
     arduino_command_args.append("--no-deps")
 
@@ -320,6 +461,170 @@ def create_pio_ci_core_command(
     return " ".join(pio_command_args)
 
 
+def resolve_pio_packages(platforms: List[str], pio_tools: dict) -> List[dict]:
+    """
+    Resolve the full set of PlatformIO platforms and tools to install, once.
+
+    Tools that are shared by several platforms (ie, tool-scons, toolchain-atmelavr)
+    are only installed with the first platform that needs them.
+
+    Returns a list of {"title", "platform", "tools"} in install order.
+    """
+    installed_tools = set()
+    resolved = []
+    for platform in dict.fromkeys(platforms):
+        tools = []
+        if platform in pio_tools.keys():
+            for tool in pio_tools[platform]["tools"]:
+                if tool not in installed_tools:
+                    installed_tools.add(tool)
+                    tools.append(tool)
+            group_title = pio_tools[platform]["name"]
+        else:
+            group_title = platform
+        resolved.append({"title": group_title, "platform": platform, "tools": tools})
+    return resolved
+
+
+def get_dependency_key(dependency: dict) -> str:
+    """Get the key that identifies a dependency, whatever version is requested"""
+    version = dependency.get("version", "")
+    if "://" in version or "github" in version:
+        return version.lower().removesuffix(".git")
+    return str(dependency.get("name") or dependency.get("id")).lower()
+
+
+def resolve_library_dependencies(
+    library_dependencies: List[dict], example_dependencies: List[dict]
+) -> tuple[List[dict], List[dict]]:
+    """
+    Resolve the library and example dependencies into one set, once.
+
+    The libraries are installed without their own dependencies (--no-deps and
+    --skip-dependencies), so the closure is the union of the dependencies declared
+    in library.json and example_dependencies.json. Each dependency is only kept the
+    first time it appears; if the examples ask for another version of a library
+    dependency, the library's version is used.
+
+    Returns the library dependencies and the example dependencies that are not
+    already library dependencies, in their original order.
+    """
+    resolved: dict[str, dict] = {}
+    lists: List[List[dict]] = []
+    for source, dependencies in [
+        ("library.json", library_dependencies),
+        ("example_dependencies.json", example_dependencies),
+    ]:
+        kept = []
+        for dependency in dependencies:
+            key = get_dependency_key(dependency)
+            if key not in resolved:
+                resolved[key] = dependency
+                kept.append(dependency)
+            elif resolved[key] != dependency:
+                print(
+                    f"::warning::{source} asks for {convert_dep_dict_to_str(dependency)}, "
+                    f"using {convert_dep_dict_to_str(resolved[key])}"
+                )
+            else:
+                print_verbose(f"Skipping duplicate dependency {key} in {source}")
+        lists.append(kept)
+    return lists[0], lists[1]
+
+
+def add_lock_to_command(command: str, lock_key: str) -> str:
+    """
+    Skip an install command if the lock file says it is installed, and record it.
+
+    The lock key is the install spec that was asked for, not the version that was
+    installed, so a library asked for with a version range is not updated to a newer
+    release in the range while the lock file (and the library cache it is in) is kept.
+    """
+    command_lines = [f"    {line}" if line else line for line in command.split("\n")]
+    quoted_key = shlex.quote(lock_key)
+    return "\n".join(
+        [
+            f'if grep -qxF -- {quoted_key} "$lock_file"; then',
+            f"    printf 'Already installed: %s\\n' {quoted_key}",
+            "else",
+            *command_lines,
+            f"    printf '%s\\n' {quoted_key} >> \"$lock_file\"",
+            "fi",
+        ]
+    )
+
+
+def write_library_install_script(
+    bash_file_path: str,
+    compiler: str,
+    libraries: List[dict],
+    arduino_cli_config: str,
+    install_jobs: int,
+) -> None:
+    """
+    Write a library installation script for Arduino CLI or PlatformIO.
+
+    Each install command is skipped if the lock file already has the library, and
+    adds the library to the lock file once it is installed. With more than one
+    install job, the libraries that are not in the lock file are downloaded in
+    parallel first.
+    """
+    with open(bash_file_path, "w") as f:
+        f.write("#!/bin/bash\n\n")
+        f.write(DEBUG_TEXT)
+        if compiler == "arduino-cli":
+            f.write(ACLI_LIBRARY_START_TEXT.format(arduino_cli_config))
+            f.write(LIBRARY_LOCK_TEXT.format(ACLI_LIBRARY_LOCK_FILE))
+            downloads = [
+                get_arduino_cli_lib_spec(library)
+                for library in libraries
+                if not is_arduino_cli_git_library(library)
+                and library.get("name")
+                not in ["SDI-12_ExtInts", "SoftwareSerial_ExternalInts"]
+            ]
+            if install_jobs > 1 and len(downloads) > 1:
+                f.write(
+                    ACLI_LIBRARY_DOWNLOAD_TEXT.format(
+                        len(downloads),
+                        install_jobs,
+                        "\n".join(downloads),
+                        arduino_cli_config,
+                    )
+                )
+        else:
+            f.write(PIO_LIBRARY_START_TEXT)
+            f.write(LIBRARY_LOCK_TEXT.format(PIO_LIBRARY_LOCK_FILE))
+            if install_jobs > 1 and len(libraries) > 1:
+                f.write(
+                    PIO_LIBRARY_PREFETCH_TEXT.format(
+                        len(libraries),
+                        install_jobs,
+                        "\n".join(map(convert_dep_dict_to_str, libraries)),
+                    )
+                )
+        for library in libraries:
+            if compiler == "arduino-cli":
+                install_command = create_arduino_cli_lib_command(library).format(
+                    arduino_cli_config
+                )
+                lock_key = get_arduino_cli_lib_spec(library)
+            else:
+                install_command = create_pio_ci_lib_command(
+                    library, update=False, include_version=True
+                )
+                lock_key = convert_dep_dict_to_str(library)
+            command_with_log = add_log_to_command(
+                add_lock_to_command(install_command, lock_key),
+                f"Installing {library['name']}",
+            )
+            f.write("\n".join(command_with_log))
+            f.write("\n")
+        if compiler == "arduino-cli":
+            f.write(ACLI_LIBRARY_END_TEXT.format(arduino_cli_config))
+        else:
+            f.write(PIO_LIBRARY_END_TEXT)
+
+
 def add_log_to_command(command: str, group_title: str) -> List[str]:
     """Wrap core installation command in logging group with ANSI colors"""
     command_list = []
@@ -333,47 +638,70 @@ def add_log_to_command(command: str, group_title: str) -> List[str]:
 # %%
 # Main script
 
-if __name__ == "__main__":
+def main(args: configargparse.Namespace | None = None) -> int:
+    """Generate the platform and library installation scripts"""
     print("=" * 60)
     print("CI Build Pipeline: Generate Installation Scripts")
     print("=" * 60)
 
-    print_verbose(
-        "Reading configuration from environment variables, command line arguments, and the config file..."
-    )
-    args = get_extended_config()
+    if args is None:
+        print_verbose(
+            "Reading configuration from environment variables, command line arguments, and the config file..."
+        )
+        try:
+            with timed_span("Read the config"):
+                args = get_extended_config()
+        except ConfigError as e:
+            print(f"::error::{e}")
+            return 1
     set_verbose_mode(args.verbose)
+    configure_download_cache(args)
 
     print("\n" + "=" * 60)
     print("Generating Platform and Core Installation Scripts")
     print("=" * 60)
 
+    # number of packages to download at the same time
+    install_jobs = max(1, int(args.install_jobs))
+    print(f"Packages to download at once: {install_jobs}")
+
     # Print out the list of platforms/cores
-    print(f"Arduino cores to install: {len(args.build_cores)}")
+    build_cores = list(dict.fromkeys(args.build_cores))
+    print(f"Arduino cores to install: {len(build_cores)}")
     print_verbose("Cores to install:")
-    for core in args.build_cores:
+    for core in build_cores:
         print_verbose(f"  - {core}")
 
     # Write the bash file for Arduino CLI platforms
-    bash_file_name = "install-platforms-arduino-cli.sh"
-    arduino_cli_config = os.path.join(args.ci_path, "arduino_cli.yaml")
-    print(f"\nWriting {bash_file_name}...")
-    with open(os.path.join(args.artifact_path, bash_file_name), "w") as bash_out:
-        bash_out.write("#!/bin/bash\n\n")
-        bash_out.write(DEBUG_TEXT)
-        bash_out.write(ACLI_PLATFORM_START_TEXT.format(arduino_cli_config))
-
-        for core in args.build_cores:
-            install_command = create_arduino_cli_core_command(
-                core_name=core,
-                arduino_cli_config=arduino_cli_config,
-            )
-            command_with_log = add_log_to_command(
-                install_command, core.replace(":", " ").title()
-            )
-            bash_out.write("\n".join(command_with_log))
+    with timed_span("Write the Arduino CLI platform script"):
+        bash_file_name = "install-platforms-arduino-cli.sh"
+        arduino_cli_config = os.path.join(args.ci_path, "arduino_cli.yaml")
+        print(f"\nWriting {bash_file_name}...")
+        with open(os.path.join(args.artifact_path, bash_file_name), "w") as bash_out:
+            bash_out.write("#!/bin/bash\n\n")
+            bash_out.write(DEBUG_TEXT)
+            bash_out.write(ACLI_PLATFORM_START_TEXT.format(arduino_cli_config))
+            if install_jobs > 1 and len(build_cores) > 1:
+                bash_out.write(
+                    ACLI_PLATFORM_DOWNLOAD_TEXT.format(
+                        len(build_cores),
+                        install_jobs,
+                        " ".join(f'"{core}"' for core in build_cores),
+                        arduino_cli_config,
+                    )
+                )
 
-        bash_out.write(ACLI_PLATFORM_END_TEXT.format(arduino_cli_config))
+            for core in build_cores:
+                install_command = create_arduino_cli_core_command(
+                    core_name=core,
+                    arduino_cli_config=arduino_cli_config,
+                )
+                command_with_log = add_log_to_command(
+                    install_command, core.replace(":", " ").title()
+                )
+                bash_out.write("\n".join(command_with_log))
+
+            bash_out.write(ACLI_PLATFORM_END_TEXT.format(arduino_cli_config))
 
     print(f"✓ Generated {bash_file_name}")
 
@@ -381,37 +709,46 @@ if __name__ == "__main__":
     print_verbose(
         "Downloading the list of extra tools associated with each PlatformIO platform..."
     )
-    pio_tools = load_pio_tools()
-
-    print(f"\nPlatformIO platforms to install: {len(args.build_platforms)}")
+    with timed_span("Download the PlatformIO tools"):
+        pio_tools = load_pio_tools()
+        pio_packages = resolve_pio_packages(args.build_platforms, pio_tools)
+    pio_tool_count = sum(len(package["tools"]) for package in pio_packages)
+    print(f"\nPlatformIO platforms to install: {len(pio_packages)}")
+    print(f"PlatformIO tools to install: {pio_tool_count}")
     print_verbose("Platforms to install:")
-    for platform in args.build_platforms:
-        print_verbose(f"  - {platform}")
+    for package in pio_packages:
+        print_verbose(f"  - {package['platform']}")
 
     # Write the bash file for PlatformIO platforms
-    bash_file_name = "install-platforms-platformio.sh"
-    print(f"Writing {bash_file_name}...")
-    with open(os.path.join(args.artifact_path, bash_file_name), "w") as bash_out:
-        bash_out.write("#!/bin/bash\n\n")
-        bash_out.write(DEBUG_TEXT)
-        bash_out.write(PIO_PLATFORM_START_TEXT)
-
-        for platform in args.build_platforms:
-            install_command = create_pio_ci_core_command(
-                platform_name=platform, is_tool=False
-            )
-            if platform in pio_tools.keys():
-                for tool in pio_tools[platform]["tools"]:
+    with timed_span("Write the PlatformIO platform script"):
+        bash_file_name = "install-platforms-platformio.sh"
+        print(f"Writing {bash_file_name}...")
+        with open(os.path.join(args.artifact_path, bash_file_name), "w") as bash_out:
+            bash_out.write("#!/bin/bash\n\n")
+            bash_out.write(DEBUG_TEXT)
+            bash_out.write(PIO_PLATFORM_START_TEXT)
+            if install_jobs > 1:
+                package_list = [f"platform {p['platform']}" for p in pio_packages] + [
+                    f"tool {tool}" for p in pio_packages for tool in p["tools"]
+                ]
+                bash_out.write(
+                    PIO_PLATFORM_PREFETCH_TEXT.format(
+                        len(package_list), install_jobs, "\n".join(package_list)
+                    )
+                )
+
+            for package in pio_packages:
+                install_command = create_pio_ci_core_command(
+                    platform_name=package["platform"], is_tool=False
+                )
+                for tool in package["tools"]:
                     install_command += "\n" + create_pio_ci_core_command(
                         platform_name=tool, is_tool=True
                     )
-                group_title = pio_tools[platform]["name"]
-            else:
-                group_title = platform
-            command_with_log = add_log_to_command(install_command, group_title)
-            bash_out.write("\n".join(command_with_log))
+                command_with_log = add_log_to_command(install_command, package["title"])
+                bash_out.write("\n".join(command_with_log))
 
-        bash_out.write(PIO_PLATFORM_END_TEXT)
+            bash_out.write(PIO_PLATFORM_END_TEXT)
 
     print(f"✓ Generated {bash_file_name}")
 
@@ -423,114 +760,86 @@ if __name__ == "__main__":
 
     # Load dependencies
     print("Loading dependencies...")
-    library_specs = load_library_dependencies(args.workspace_path)
-    example_specs = load_example_dependencies(args.examples_path)
-
-    # Ensure dependencies key exists
-    if "dependencies" not in library_specs:
-        library_specs["dependencies"] = []
-    if "dependencies" not in example_specs:
-        example_specs["dependencies"] = []
-
+    with timed_span("Resolve the library dependencies"):
+        library_specs = load_library_dependencies(args.workspace_path)
+        example_specs = load_example_dependencies(args.examples_path)
+
+        # Ensure dependencies key exists
+        if "dependencies" not in library_specs:
+            library_specs["dependencies"] = []
+        if "dependencies" not in example_specs:
+            example_specs["dependencies"] = []
+
+        library_dependencies, example_dependencies = resolve_library_dependencies(
+            library_specs["dependencies"], example_specs["dependencies"]
+        )
     print(f"Library dependencies: {len(library_specs['dependencies'])}")
     print(f"Example dependencies: {len(example_specs['dependencies'])}")
+    print(
+        f"Dependencies to install: {len(library_dependencies) + len(example_dependencies)}"
+    )
     print_verbose("Dependencies to install:")
-    for lib in library_specs["dependencies"] + example_specs["dependencies"]:
+    for lib in library_dependencies + example_dependencies:
         print_verbose(f"  - {lib.get('name') or lib.get('id') or lib}")
 
-    if (
-        len(library_specs["dependencies"]) == 0
-        and len(example_specs["dependencies"]) == 0
-    ):
+    if len(library_dependencies) == 0 and len(example_dependencies) == 0:
         print("\n✓ No dependencies to install")
 
     # NOTE: We still need to generate the install scripts even if there are no dependencies,
     # because the build architecture expects them to exist.
     # So we will generate empty scripts if there are no dependencies.
 
-    # Generate Arduino CLI scripts
-    print("\nGenerating Arduino CLI installation scripts...")
-
-    # Library dependencies for Arduino CLI
-    bash_file_name = "install-library-libdeps-arduino-cli.sh"
-    with open(os.path.join(args.artifact_path, bash_file_name), "w") as f:
-        f.write("#!/bin/bash\n\n")
-        f.write(DEBUG_TEXT)
-        f.write(ACLI_LIBRARY_START_TEXT.format(arduino_cli_config))
-        for library in library_specs["dependencies"]:
-            install_command = create_arduino_cli_lib_command(library)
-            command_with_log = add_log_to_command(
-                install_command.format(arduino_cli_config),
-                f"Installing {library['name']}",
-            )
-            f.write("\n".join(command_with_log))
-            f.write("\n")
-        f.write(ACLI_LIBRARY_END_TEXT.format(arduino_cli_config))
-    print(f"✓ Generated {bash_file_name}")
+    with timed_span("Write the library scripts"):
+        for compiler, compiler_name in [
+            ("arduino-cli", "Arduino CLI"),
+            ("platformio", "PlatformIO"),
+        ]:
+            print(f"\nGenerating {compiler_name} installation scripts...")
+            for bash_file_name, libraries in [
+                (f"install-library-libdeps-{compiler}.sh", library_dependencies),
+                (f"install-example-libdeps-{compiler}.sh", example_dependencies),
+            ]:
+                write_library_install_script(
+                    os.path.join(args.artifact_path, bash_file_name),
+                    compiler,
+                    libraries,
+                    arduino_cli_config,
+                    install_jobs,
+                )
+                print(f"✓ Generated {bash_file_name}")
+
+    # Write the manifest of the package bundles
+    # each platform's bundle has all of its tools, so it can be restored on its own
+    with timed_span("Write the package manifest"):
+        pio_platforms = {
+            package["platform"]: pio_tools.get(package["platform"], {}).get("tools", [])
+            for package in pio_packages
+        }
+        manifest = create_package_manifest(
+            build_cores,
+            pio_platforms,
+            library_dependencies + example_dependencies,
+        )
+        write_package_manifest(
+            manifest, os.path.join(args.artifact_path, MANIFEST_FILE_NAME)
+        )
+        print(f"\n✓ Generated {MANIFEST_FILE_NAME}")
+    for toolchain, bundles in manifest["toolchains"].items():
+        print(
+            f"  {toolchain}: {len(bundles['bundles'])} bundles, hash {bundles['hash'][:12]}"
+        )
 
-    # Example dependencies for Arduino CLI
-    bash_file_name = "install-example-libdeps-arduino-cli.sh"
-    with open(os.path.join(args.artifact_path, bash_file_name), "w") as f:
-        f.write("#!/bin/bash\n\n")
-        f.write(DEBUG_TEXT)
-        f.write(ACLI_LIBRARY_START_TEXT.format(arduino_cli_config))
-        for library in example_specs["dependencies"]:
-            install_command = create_arduino_cli_lib_command(library)
-            command_with_log = add_log_to_command(
-                install_command.format(arduino_cli_config),
-                f"Installing {library['name']}",
-            )
-            f.write("\n".join(command_with_log))
-            f.write("\n")
-        f.write(ACLI_LIBRARY_END_TEXT.format(arduino_cli_config))
-    print(f"✓ Generated {bash_file_name}")
+    print("\n✓ Installation scripts generated successfully")
+    print("✓ Ready for job matrix building and compilation")
 
-    # Generate PlatformIO scripts (if available)
-    print("\nGenerating PlatformIO installation scripts...")
+    write_timing_report("Generate Installation Scripts", args.artifact_path)
 
-    # Library dependencies for PlatformIO
-    bash_file_name = "install-library-libdeps-platformio.sh"
-    with open(os.path.join(args.artifact_path, bash_file_name), "w") as f:
-        f.write("#!/bin/bash\n\n")
-        f.write(DEBUG_TEXT)
-        f.write(PIO_LIBRARY_START_TEXT)
-        for library in library_specs["dependencies"]:
-            # spec = get_package_spec(library)
-            # if spec:
-            install_command = create_pio_ci_lib_command(
-                library, update=False, include_version=True
-            )
-            command_with_log = add_log_to_command(
-                install_command, f"Installing {library['name']}"
-            )
-            f.write("\n".join(command_with_log))
-            f.write("\n")
-        f.write(PIO_LIBRARY_END_TEXT)
-    print(f"✓ Generated {bash_file_name}")
+    return 0
 
-    # Example dependencies for PlatformIO
-    bash_file_name = "install-example-libdeps-platformio.sh"
-    with open(os.path.join(args.artifact_path, bash_file_name), "w") as f:
-        f.write("#!/bin/bash\n\n")
-        f.write(DEBUG_TEXT)
-        f.write(PIO_LIBRARY_START_TEXT)
-        for library in example_specs["dependencies"]:
-            # spec = get_package_spec(library)
-            # if spec:
-            install_command = create_pio_ci_lib_command(
-                library, update=False, include_version=True
-            )
-            command_with_log = add_log_to_command(
-                install_command, f"Installing {library['name']}"
-            )
-            f.write("\n".join(command_with_log))
-            f.write("\n")
-        f.write(PIO_LIBRARY_END_TEXT)
-    print(f"✓ Generated {bash_file_name}")
 
-    print("\n✓ Installation scripts generated successfully")
-    print("✓ Ready for job matrix building and compilation")
+if __name__ == "__main__":
+    sys.exit(main())
 
 
 # %%
-# CSpell:ignore
+# CSpell:ignore cksum
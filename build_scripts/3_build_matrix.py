@@ -16,17 +16,120 @@ Supports custom matrix builders via external scripts.
 import os
 import json
 import sys
-from build_utils import dict_product, remove_nested_duplicates
+import heapq
+import hashlib
+from itertools import chain
+from typing import Iterable, Iterator
+import configargparse
+from build_utils import (
+    dict_product,
+    iter_nested_unique,
+    external_sort,
+    write_matrix_store,
+    MatrixRuleIndex,
+    MATRIX_FILE_NAME,
+)
 from build_config import (
+    ConfigError,
     get_extended_config,
     set_verbose_mode,
     print_verbose,
     write_config_file,
+    timed_span,
+    write_timing_report,
 )
 
-def build_default_matrix(config: dict):
-    """Build the default matrix using dict_product"""
-    print("Building default job matrix...")
+def matrix_sort_key(matrix_entry: dict) -> tuple:
+    """Sort matrix entries by compiler, board, example, inline defines, and compiler flags"""
+    return (
+        matrix_entry["compiler"],
+        (
+            matrix_entry["board"]
+            if "board" in matrix_entry
+            else (
+                matrix_entry["pio_env"]
+                if "pio_env" in matrix_entry
+                else matrix_entry.get("fqbn", "")
+            )
+        ),
+        matrix_entry["example"],
+        matrix_entry["inline_defines"],
+        matrix_entry["compiler_flags"],
+    )
+
+
+def select_incremental_matrix(
+    entries: Iterable[dict], config: dict, counts: dict | None = None
+) -> Iterator[dict]:
+    """
+    Keep only the matrix entries for the examples affected by the changed files.
+
+    1_configure_workspace.py saves the affected examples when a diff base is set. If
+    it could not tell which examples are affected, every entry is kept. Otherwise a
+    few unaffected entries (--canary-count) are also kept as canaries, so a change
+    that affects examples in a way the include scan misses can still be caught.
+    The canaries are picked by a hash of the entry and the diff base, so the same
+    change always picks the same canaries.
+    """
+    if counts is None:
+        counts = {}
+    counts["affected"] = 0
+    counts["canary"] = 0
+
+    if config.get("incremental_build") not in [True, "true"]:
+        for matrix_entry in entries:
+            counts["affected"] += 1
+            yield matrix_entry
+        return
+
+    affected_examples = set(config.get("affected_examples") or [])
+    canary_count = int(config.get("canary_count") or 0)
+    diff_base = str(config.get("diff_base", ""))
+
+    # a heap of the canary_count lowest ranked unaffected entries, by negated rank
+    canaries: list[tuple[int, int, dict]] = []
+    for n, matrix_entry in enumerate(entries):
+        if matrix_entry.get("example") in affected_examples:
+            counts["affected"] += 1
+            yield matrix_entry
+            continue
+        if canary_count <= 0:
+            continue
+        rank = int.from_bytes(
+            hashlib.sha256(
+                (diff_base + json.dumps(matrix_entry, sort_keys=True)).encode()
+            ).digest()[:8]
+        )
+        if len(canaries) < canary_count:
+            heapq.heappush(canaries, (-rank, n, matrix_entry))
+        elif -rank > canaries[0][0]:
+            heapq.heapreplace(canaries, (-rank, n, matrix_entry))
+
+    for _, _, matrix_entry in sorted(canaries, key=lambda c: c[1]):
+        counts["canary"] += 1
+        print_verbose(
+            f"Canary entry: {matrix_entry['example']} "
+            f"{matrix_entry.get('pio_env', matrix_entry.get('fqbn', ''))}"
+        )
+        yield matrix_entry
+
+
+def iter_default_matrix(config: dict, counts: dict | None = None) -> Iterator[dict]:
+    """
+    Lazily build the default matrix using dict_product.
+
+    The entries stream through each step (product -> filter -> annotate -> dedupe ->
+    sort) without materializing the full cartesian product. The de-duplication keeps
+    the canonical key of every unique entry, and the sort spills to disk in chunks.
+
+    If a counts dictionary is given, it is updated with the number of entries that
+    passed each step once the iterator has been consumed.
+    """
+    if counts is None:
+        counts = {}
+    for step in ["possible", "filtered", "final"]:
+        counts[step] = 0
+    selected_counts: dict = {}
 
     workspace_path = config.get("workspace_path", os.getcwd())
     examples_to_build = config.get("examples_to_build", [])
@@ -35,105 +138,114 @@ def build_default_matrix(config: dict):
     inline_defines = config.get("inline_defines", [])
     compiler_flags = config.get("compiler_flags", [])
 
-    p_cart_join = list(
-        dict_product(
-            {
-                "compiler": ["platformio"],
-                "example": examples_to_build,
-                "pio_env": build_envs,
-                "inline_defines": inline_defines,
-                "compiler_flags": compiler_flags,
-            }
-        )
+    p_cart_join = dict_product(
+        {
+            "compiler": ["platformio"],
+            "example": examples_to_build,
+            "pio_env": build_envs,
+            "inline_defines": inline_defines,
+            "compiler_flags": compiler_flags,
+        }
     )
 
-    a_cart_join = list(
-        dict_product(
-            {
-                "compiler": ["arduino-cli"],
-                "example": examples_to_build,
-                "fqbn": build_fqbns,
-                "inline_defines": inline_defines,
-                "compiler_flags": compiler_flags,
-            }
-        )
+    a_cart_join = dict_product(
+        {
+            "compiler": ["arduino-cli"],
+            "example": examples_to_build,
+            "fqbn": build_fqbns,
+            "inline_defines": inline_defines,
+            "compiler_flags": compiler_flags,
+        }
     )
 
-    cart_join = p_cart_join + a_cart_join
-    cart_join_list = [json.dumps(e) for e in cart_join]
-    print(f"Total possible combinations: {len(cart_join)}")
-
     # Apply matrix exclusions (empty by default)
-    matrix_exclusions = []
-    expanded_matrix_exclusions = []
-    for exclusion in matrix_exclusions:
-        exclusion_list = list(dict_product(exclusion))
-        expanded_matrix_exclusions.extend(exclusion_list)
-
-    expanded_matrix_exclusions_set = remove_nested_duplicates(
-        expanded_matrix_exclusions
-    )
-    expanded_matrix_exclusions_list = [
-        json.dumps(e) for e in expanded_matrix_exclusions_set
-    ]
-    print(f"Matrix exclusions: {len(expanded_matrix_exclusions_list)}")
+    matrix_exclusions = MatrixRuleIndex(config.get("matrix_exclusions") or [])
+    print(f"Matrix exclusions: {len(matrix_exclusions)}")
 
     # Apply matrix inclusions (empty by default - includes all)
-    matrix_inclusions = []
-    expanded_matrix_inclusions = []
-    for inclusion in matrix_inclusions:
-        inclusion_list = list(dict_product(inclusion))
-        expanded_matrix_inclusions.extend(inclusion_list)
-
-    expanded_matrix_inclusions_set = remove_nested_duplicates(
-        expanded_matrix_inclusions
-    )
-    expanded_matrix_inclusions_list = [
-        json.dumps(e) for e in expanded_matrix_inclusions_set
-    ]
-    print(f"Matrix inclusions: {len(expanded_matrix_inclusions_list)}")
-
-    # Filter matrix
-    assembled_matrix = [
-        json.loads(e)
-        for e in cart_join_list
-        if e not in expanded_matrix_exclusions_list
-        and (
-            len(expanded_matrix_inclusions_list) == 0
-            or e in expanded_matrix_inclusions_list
+    matrix_inclusions = MatrixRuleIndex(config.get("matrix_inclusions") or [])
+    print(f"Matrix inclusions: {len(matrix_inclusions)}")
+
+    def filter_matrix(entries: Iterable[dict]) -> Iterator[dict]:
+        for matrix_entry in entries:
+            counts["possible"] += 1
+            if matrix_exclusions.matches(matrix_entry):
+                continue
+            if len(matrix_inclusions) > 0 and not matrix_inclusions.matches(
+                matrix_entry
+            ):
+                continue
+            counts["filtered"] += 1
+            yield matrix_entry
+
+    def annotate_matrix(entries: Iterable[dict]) -> Iterator[dict]:
+        for matrix_entry in entries:
+            example = matrix_entry["example"]
+            example_name = os.path.split(example)[-1]
+            example_full_path = os.path.join(
+                workspace_path, example, example_name + ".ino"
+            )
+            matrix_entry["other_commands"] = [
+                r"sed -i 's/#define TINY_GSM_MODEM_/\/\/ #define TINY_GSM_MODEM_/g' "
+                + f'"{example_full_path}"'
+            ]
+            yield matrix_entry
+
+    unique_matrix = iter_nested_unique(
+        annotate_matrix(
+            select_incremental_matrix(
+                filter_matrix(chain(p_cart_join, a_cart_join)), config, selected_counts
+            )
         )
-    ]
-
-    assembled_matrix = sorted(
-        assembled_matrix,
-        key=lambda x: (
-            x["compiler"],
-            (
-                x["board"]
-                if "board" in x
-                else x["pio_env"] if "pio_env" in x else x.get("fqbn", "")
-            ),
-            x["example"],
-            x["inline_defines"],
-            x["compiler_flags"],
-        ),
     )
+    sorted_matrix = external_sort(unique_matrix, key=matrix_sort_key)
+    # the sort reads every entry before it gives the first, so this times the product,
+    # filter, and de-duplication steps along with the sort
+    try:
+        with timed_span("Combine, filter, de-duplicate, and sort the entries"):
+            first_entry = next(sorted_matrix, None)
+        if first_entry is None:
+            return
+        for matrix_entry in chain([first_entry], sorted_matrix):
+            counts["final"] += 1
+            yield matrix_entry
+    finally:
+        # also when the matrix is empty, so the affected and canary counts are printed
+        counts.update(selected_counts)
+
+
+def print_matrix_counts(config: dict, counts: dict) -> None:
+    """Print the number of default matrix entries kept by each step"""
+    print(f"Total possible combinations: {counts['possible']}")
+    print(f"Filtered combinations: {counts['filtered']}")
+    if config.get("incremental_build") in [True, "true"]:
+        print(f"Combinations for affected examples: {counts['affected']}")
+        print(f"Canary combinations: {counts['canary']}")
+    print(f"Final filtered matrix: {counts['final']}")
+
 
-    for matrix_entry in assembled_matrix:
-        example = matrix_entry["example"]
-        example_name = os.path.split(example)[-1]
-        example_full_path = os.path.join(workspace_path, example, example_name + ".ino")
-        matrix_entry["other_commands"] = [
-            r"sed -i 's/#define TINY_GSM_MODEM_/\/\/ #define TINY_GSM_MODEM_/g' "
-            + f'"{example_full_path}"'
-        ]
+def build_default_matrix(config: dict):
+    """Build the default matrix using dict_product"""
+    print("Building default job matrix...")
 
-    final_matrix = remove_nested_duplicates(assembled_matrix)
-    print(f"Final filtered matrix: {len(final_matrix)}")
+    counts: dict = {}
+    final_matrix = list(iter_default_matrix(config, counts))
+    print_matrix_counts(config, counts)
 
     return final_matrix
 
 
+def write_default_matrix(config: dict, matrix_file: str) -> int:
+    """Build the default matrix and stream it into the matrix file, without a list"""
+    print("Building default job matrix...")
+
+    counts: dict = {}
+    write_matrix_store(iter_default_matrix(config, counts), matrix_file)
+    print_matrix_counts(config, counts)
+
+    return counts["final"]
+
+
 def build_custom_matrix(config: dict) -> list[dict] | None:
     """
     Allow custom matrix builder script.
@@ -163,32 +275,71 @@ def build_custom_matrix(config: dict) -> list[dict] | None:
 
 
 # %%
-if __name__ == "__main__":
+def main(args: configargparse.Namespace | None = None) -> int:
+    """Build the job matrix and save it to the config file"""
     print("=" * 60)
     print("CI Build Pipeline: Build Matrix")
     print("=" * 60)
 
-    print_verbose(
-        "Reading configuration from environment variables, command line arguments, and the config file..."
-    )
-    args = get_extended_config()
+    if args is None:
+        print_verbose(
+            "Reading configuration from environment variables, command line arguments, and the config file..."
+        )
+        try:
+            with timed_span("Read the config"):
+                args = get_extended_config()
+        except ConfigError as e:
+            print(f"::error::{e}")
+            return 1
     set_verbose_mode(args.verbose)
 
+    # The matrix is saved in its own file, so the config file stays small
+    matrix_file = os.path.join(args.artifact_path, MATRIX_FILE_NAME)
+
     # Try custom matrix builder first
-    final_matrix = build_custom_matrix(vars(args))
+    with timed_span("Build the custom matrix"):
+        final_matrix = build_custom_matrix(vars(args))
 
     # Fall back to default
-    if final_matrix is None:
-        final_matrix = build_default_matrix(vars(args))
-
-    # Save matrix to config for next script
-    args.final_matrix = final_matrix
+    with timed_span("Write the matrix"):
+        if final_matrix is None:
+            write_default_matrix(vars(args), matrix_file)
+        elif vars(args).get("incremental_build") in [True, "true"]:
+            counts: dict = {}
+            write_matrix_store(
+                select_incremental_matrix(final_matrix, vars(args), counts),
+                matrix_file,
+            )
+            print(f"Custom matrix entries for affected examples: {counts['affected']}")
+            print(f"Canary entries: {counts['canary']}")
+        else:
+            write_matrix_store(final_matrix, matrix_file)
+
+    # Save the matrix file to the config for the next script
+    args.matrix_file_path = matrix_file
+    # drop any matrix saved in the config file by an older version of this script
+    if "final_matrix" in args:
+        delattr(args, "final_matrix")
 
     # Save to file for next script
     print_verbose("Writing updated configuration to file...")
-    config_file = write_config_file(args)
+    try:
+        with timed_span("Write the config"):
+            config_file = write_config_file(args)
+    except ConfigError as e:
+        print(f"::error::{e}")
+        return 1
 
-    print(f"\nFinal matrix saved to: {config_file}")
+    print(f"\nFinal matrix saved to: {matrix_file}")
+    print(f"Configuration saved to: {config_file}")
+
+    write_timing_report("Build Matrix", args.artifact_path)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
 
 
 # %%
@@ -5,7 +5,7 @@ Build command blocks and job scripts from the final matrix.
 Converts the matrix into:
 1. Command blocks (commands for each matrix item)
 2. Log groups (grouped by log_groupers)
-3. Jobs (grouped by job_groupers)
+3. Jobs (grouped by job_groupers, or packed by expected duration)
 4. Bash scripts for each job
 
 This script handles:
@@ -27,15 +27,346 @@ import os
 import sys
 import re
 import json
-from copy import deepcopy
-from typing import List, Optional
+import hashlib
+import shlex
+from types import ModuleType
+from typing import Any, Callable, Dict, List, Optional, Tuple
 from subprocess import list2cmdline
-from build_utils import get_filename_slug, save_json_file
-from build_config import get_extended_config, set_verbose_mode, print_verbose
+import configargparse
+from build_utils import (
+    freeze_matrix_value,
+    get_filename_slug,
+    group_by_levels,
+    save_json_file,
+    write_log_manifest,
+    BUILD_METRICS_FILE_SUFFIX,
+    LOG_MANIFEST_FILE_NAME,
+    MatrixStore,
+)
+from build_config import (
+    ConfigError,
+    get_extended_config,
+    set_verbose_mode,
+    print_verbose,
+    timed_span,
+    write_timing_report,
+)
+from build_scheduler import (
+    BuildCostModel,
+    get_duration_file_for_log,
+    get_duration_key,
+    load_build_durations,
+    pack_jobs,
+)
 
 # Global config
 use_verbose = os.environ.get("RUNNER_DEBUG") == "1"
 
+# Bash function used by the job scripts to build a copy of an example.
+# Every file is hard linked (or reflinked, or copied, if the overlay is on another
+# file system), except the sketch file, which is always a real copy.
+EXAMPLE_OVERLAY_FUNCTION = """make_example_overlay() {
+    # make_example_overlay <example directory> <overlay directory> <sketch file>
+    rm -rf "$2"
+    mkdir -p "$2"
+    cp -al "$1/." "$2/" 2>/dev/null || cp -a --reflink=auto "$1/." "$2/" 2>/dev/null || cp -a "$1/." "$2/"
+    rm -f "$2/$3"
+    cp "$1/$3" "$2/$3"
+}
+
+"""
+
+# Bash functions used by the job scripts to reuse the output of earlier compiles.
+# A compile is keyed on the toolchain fingerprint (the versions of the installed
+# cores, platforms, tools and libraries, the contents of the installed libraries,
+# and the config file), the contents of the patched example, and the compile command
+# (board, environment and flags). Only successful compiles are stored. A hit prints
+# and logs the stored output exactly as the compiler wrote it, so the logs read by
+# parse_test_results.py are the same either way.
+# Set COMPILE_CACHE=false to always compile, COMPILE_CACHE_PATH to move the cache,
+# and COMPILE_CACHE_DAYS to change how long unused entries are kept.
+COMPILE_CACHE_FUNCTIONS = """compile_cache_dir="${COMPILE_CACHE_PATH:-$HOME/.cache/envirodiy_workflows/compile}"
+compile_output="$(mktemp)"
+
+hash_text() {
+    if command -v sha256sum >/dev/null 2>&1; then sha256sum | cut -d " " -f 1; else shasum -a 256 | cut -d " " -f 1; fi
+}
+
+hash_files() {
+    if command -v sha256sum >/dev/null 2>&1; then xargs -0 sha256sum; else xargs -0 shasum -a 256; fi
+}
+
+tree_digest() {
+    # tree_digest <directory>: hash of the names and contents of every file in a directory
+    if [ -d "$1" ]; then
+        (cd "$1" && find . -type f -print0 | LC_ALL=C sort -z | hash_files) | hash_text
+    else
+        echo "missing $1"
+    fi
+}
+
+compute_toolchain_digest() {
+    # compute_toolchain_digest <toolchain>: fingerprint an installed toolchain, once per job
+    # called by the job script itself, since compile_cache_key runs in a subshell and
+    # could not keep the digest for the next compile
+    if [ "${COMPILE_CACHE:-true}" = "false" ]; then return 0; fi
+    local digest_name="toolchain_digest_${1//-/_}"
+    if [ -z "${!digest_name}" ]; then
+        printf -v "$digest_name" "%s" "$("toolchain_fingerprint_${1//-/_}" 2>&1 | hash_text)"
+    fi
+}
+
+compile_cache_key() {
+    # compile_cache_key <toolchain> <source directory> <command digest>
+    if [ "${COMPILE_CACHE:-true}" = "false" ]; then echo "disabled"; return; fi
+    local digest_name="toolchain_digest_${1//-/_}"
+    # without a fingerprint from compute_toolchain_digest, a stored compile can't be trusted
+    if [ -z "${!digest_name}" ]; then echo "disabled"; return; fi
+    printf "%s\\n" "v1" "$1" "${!digest_name}" "$(tree_digest "$2")" "$3" | hash_text
+}
+
+compile_cache_replay() {
+    # compile_cache_replay <key> <log file>: print and log the stored output of a compile
+    if [ "$1" = "disabled" ] || [ ! -f "$compile_cache_dir/$1/output" ]; then return 1; fi
+    touch "$compile_cache_dir/$1/output"
+    echo -e "\\e[36mUsing the stored output of an identical compile ($1)\\e[0m" >&2
+    cat "$compile_cache_dir/$1/output"
+    cat "$compile_cache_dir/$1/output" >> "$2"
+}
+
+compile_cache_store() {
+    # compile_cache_store <key> <output file>: store the output of a successful compile
+    if [ "$1" = "disabled" ]; then return 0; fi
+    mkdir -p "$compile_cache_dir/$1"
+    cp "$2" "$compile_cache_dir/$1/output.tmp"
+    mv "$compile_cache_dir/$1/output.tmp" "$compile_cache_dir/$1/output"
+}
+
+# forget compiles that have not been used for a while
+if [ -d "$compile_cache_dir" ]; then
+    find "$compile_cache_dir" -mindepth 2 -maxdepth 2 -name output -mtime +"${COMPILE_CACHE_DAYS:-30}" | while read -r old_output; do rm -rf "$(dirname "$old_output")"; done
+fi
+
+"""
+
+# Bash functions used by the job scripts to record how long each successful compile
+# takes, in a sidecar file next to its log. parse_test_results.py collects these
+# into the build durations used to pack the jobs (see build_scheduler.py).
+BUILD_TIMER_FUNCTIONS = """build_clock() {
+    # print the current time in seconds, with a fraction if bash can give one
+    echo "${EPOCHREALTIME:-$(date +%s)}" | tr ',' '.'
+}
+
+record_build_duration() {
+    # record_build_duration <start time> <duration file>
+    awk -v start="$1" -v end="$(build_clock)" 'BEGIN { printf "%.3f\\n", end - start }' > "$2"
+}
+
+"""
+
+# Bash function used by the job scripts to record the metrics of each build, as one
+# line of the job's JSON lines metrics file (see build_utils.read_build_metrics).
+# The JSON object of the build (its log, log group, toolchain and matrix item) is
+# written into the script, and the exit code, seconds, whether the output was
+# reused from the compile cache, the RAM and flash use, and the toolchain version
+# are added to it when the build is done. The sizes are left out if the compiler
+# did not print them, so parse_test_results.py reads them from the log instead.
+BUILD_METRICS_FUNCTIONS = """record_build_metrics() {
+    # record_build_metrics <build JSON> <toolchain> <exit code> <start time> <cached> <log file>
+    local version_var="toolchain_version_${2//-/_}"
+    local sizes=""
+    local compact_log
+    if [ -z "${!version_var}" ]; then
+        # the installed toolchain does not change during a job, so only look once
+        if [ "$2" = "arduino-cli" ]; then
+            printf -v "$version_var" "%s" "$(arduino-cli version 2>&1 | head -n 1 | tr -d '"\\\\')"
+        else
+            printf -v "$version_var" "%s" "$(pio --version 2>&1 | head -n 1 | tr -d '"\\\\')"
+        fi
+    fi
+    if [ -f "$6" ] && [ "$2" = "arduino-cli" ]; then
+        compact_log="$(tr -d ' \\t\\r\\n' < "$6")"
+        sizes="$(echo "$compact_log" | sed -nE 's/.*\\{"name":"data","size":([0-9]+),"max_size":([0-9]+)\\}.*/,"ram_used":\\1,"ram_total":\\2/p')"
+        sizes="$sizes$(echo "$compact_log" | sed -nE 's/.*\\{"name":"text","size":([0-9]+),"max_size":([0-9]+)\\}.*/,"flash_used":\\1,"flash_total":\\2/p')"
+    elif [ -f "$6" ]; then
+        sizes="$(sed -nE 's/.*RAM:.*\\(used ([0-9]+) bytes from ([0-9]+) bytes\\).*/,"ram_used":\\1,"ram_total":\\2/p' "$6" | tail -n 1)"
+        sizes="$sizes$(sed -nE 's/.*Flash:.*\\(used ([0-9]+) bytes from ([0-9]+) bytes\\).*/,"flash_used":\\1,"flash_total":\\2/p' "$6" | tail -n 1)"
+    fi
+    printf '%s,"exit_code":%d,"seconds":%s,"cached":%s%s,"toolchain_version":"%s"}\\n' \\
+        "${1%\\}}" "$3" "$(awk -v start="$4" -v end="$(build_clock)" 'BEGIN { printf "%.3f", end - start }')" \\
+        "$5" "$sizes" "${!version_var}"
+}
+
+"""
+
+
+# %%
+# Compact matrix items
+
+# The keys of a matrix item that can name its board, in the order they are used
+BOARD_KEYS = ["board", "fqbn", "pio_env"]
+
+# The interned tuples of matrix values, so equal values are stored only once. This is
+# cleared at the start of main(), so a stage run again in the same interpreter (ie,
+# by generate_job_matrix.py or the benchmarks) does not keep the values of every run.
+interned_values: Dict[tuple, tuple] = {}
+
+
+def intern_matrix_value(value: Any) -> Any:
+    """Intern the strings in a matrix value, and make its lists into interned tuples"""
+    if isinstance(value, str):
+        return sys.intern(value)
+    if isinstance(value, (list, tuple)):
+        frozen = tuple([intern_matrix_value(v) for v in value])
+        return interned_values.setdefault(frozen, frozen)
+    return value
+
+
+class CommandBlock:
+    """The commands to build one matrix item.
+
+    The values of the matrix item are kept as a tuple of (key, value) pairs with
+    interned strings and tuples instead of lists, so the thousands of blocks that
+    share a compiler, board, or example share one copy of each value, and the
+    blocks are never copied while they are grouped.
+
+    A block can be indexed by the keys of its matrix item. If the matrix item has no
+    'board', the board is its FQBN or PlatformIO environment.
+    """
+
+    __slots__ = (
+        "fields",
+        "output_file_name",
+        "other_commands",
+        "build_commands",
+        "compile_cache_key_args",
+    )
+
+    def __init__(
+        self,
+        matrix_item: dict,
+        output_file_name: str,
+        other_commands: List[str],
+        build_commands: List[str],
+        compile_cache_key_args: List[str],
+    ):
+        self.fields: Tuple[Tuple[str, Any], ...] = tuple(
+            [
+                (sys.intern(k), intern_matrix_value(v))
+                for k, v in matrix_item.items()
+                if k not in ["build_commands", "other_commands"]
+            ]
+        )
+        self.output_file_name = output_file_name
+        self.other_commands = intern_matrix_value(other_commands)
+        self.build_commands = tuple(build_commands)
+        self.compile_cache_key_args = intern_matrix_value(compile_cache_key_args)
+
+    def keys(self) -> List[str]:
+        """The keys of the matrix item, without the commands"""
+        return [k for k, _ in self.fields]
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.keys() or (
+            key == "board" and any(k in self.keys() for k in BOARD_KEYS)
+        )
+
+    def __getitem__(self, key: str) -> Any:
+        for k, v in self.fields:
+            if k == key:
+                return v
+        if key == "board":
+            for board_key in BOARD_KEYS[1:]:
+                if board_key in self.keys():
+                    return self[board_key]
+        raise KeyError(key)
+
+    def get_values(self, groupers: List[str]) -> tuple:
+        """Get the values of the grouping fields, to group the blocks by"""
+        values = []
+        for grouper in groupers:
+            if grouper not in self:
+                raise ValueError(
+                    f"Matrix item {dict(self.fields)} does not have the key {grouper}"
+                )
+            value = self[grouper]
+            if value is None:
+                raise ValueError(
+                    f"Matrix item {dict(self.fields)} has a None value for the key {grouper}"
+                )
+            values.append(value)
+        return tuple(values)
+
+
+# A group key is a tuple of (field, value) pairs, ie, the values of the grouping fields
+GroupKey = Tuple[Tuple[str, Any], ...]
+
+
+def create_field_key_function(
+    groupers: List[str],
+) -> Callable[[CommandBlock], GroupKey]:
+    """Create a function that keys command blocks by the values of grouping fields"""
+
+    def get_field_key(command_block: CommandBlock) -> GroupKey:
+        return tuple(zip(groupers, command_block.get_values(groupers)))
+
+    return get_field_key
+
+
+def load_custom_matrix_builder(config: dict) -> ModuleType | None:
+    """Load continuous_integration/build_job_matrix.py, the custom matrix builder"""
+    ci_path = config.get("ci_path") or ""
+    custom_builder = os.path.join(ci_path, "build_job_matrix.py")
+    if not os.path.exists(custom_builder):
+        return None
+
+    import importlib.util
+
+    spec = importlib.util.spec_from_file_location(
+        "custom_matrix_builder", custom_builder
+    )
+    if spec is None or spec.loader is None:
+        return None
+    custom_module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(custom_module)
+    return custom_module
+
+
+def load_custom_key_function(
+    custom_module: ModuleType | None, function_name: str
+) -> Callable[[CommandBlock], GroupKey] | None:
+    """
+    Allow a custom grouping key function.
+
+    Looks for a function with the given name in the custom matrix builder script.
+    It is called with each command block and returns a dictionary of the fields and
+    values to group the block by, which are also used to name its group.
+    """
+    custom_function = getattr(custom_module, function_name, None)
+    if custom_function is None:
+        return None
+    print(f"Using the custom grouping key function {function_name}()")
+
+    def get_custom_key(command_block: CommandBlock) -> GroupKey:
+        custom_fields = custom_function(command_block)
+        return tuple((k, freeze_matrix_value(v)) for k, v in custom_fields.items())
+
+    return get_custom_key
+
+
+def get_log_group_key(group_fields: GroupKey) -> str:
+    """Get the name of a log group from the values of its grouping fields"""
+    l_key = "_".join(
+        [get_filename_slug(grouper, value) for grouper, value in group_fields]
+    )
+    l_key = re.sub(r"[\-]{2,}", "-", l_key)
+    l_key = re.sub(r"[_]{2,}", "_", l_key)
+    return l_key
+
+
+# %%
+# Commands
+
 
 def create_arduino_cli_compile_command(
     workspace_path: str,
@@ -142,6 +473,37 @@ def create_pio_ci_compile_command(
     return cmd_str
 
 
+def create_toolchain_fingerprint_functions(config: dict) -> str:
+    """Create the bash functions that print what a compile depends on for each toolchain
+
+    The output is hashed into the compile cache key, so anything that can change a
+    compile without changing the example or the compile command belongs here.
+    """
+    arduino_cli_config = config.get("arduino_cli_config") or ""
+    pio_config_file = config.get("pio_config_file") or ""
+    workspace_path = config.get("workspace_path") or ""
+    acli_args = list2cmdline(["--config-file", arduino_cli_config])
+    return f"""toolchain_fingerprint_arduino_cli() {{
+    arduino-cli version
+    arduino-cli {acli_args} core list
+    arduino-cli {acli_args} lib list
+    tree_digest "$(arduino-cli {acli_args} config get directories.user)/libraries"
+    cat "{arduino_cli_config}"
+}}
+
+toolchain_fingerprint_platformio() {{
+    pio --version
+    pio pkg list -g -v
+    tree_digest "${{PLATFORMIO_CORE_DIR:-$HOME/.platformio}}/lib"
+    tree_digest "${{PLATFORMIO_CORE_DIR:-$HOME/.platformio}}/boards"
+    tree_digest "${{PLATFORMIO_CORE_DIR:-$HOME/.platformio}}/variants"
+    tree_digest "{os.path.join(workspace_path, "lib")}"
+    cat "{pio_config_file}"
+}}
+
+"""
+
+
 def get_filename_for_log(job: dict, artifact_path: str, name_keys: list) -> str:
     """Generate filename for log output"""
     if "compiler" in job:
@@ -176,8 +538,30 @@ def group_and_log_commands(
     other_commands: List[str],
     group_title: str,
     output_filename: str,
+    compile_cache_key_args: List[str] | None = None,
+    build_metrics: dict | None = None,
 ) -> List[str]:
-    """Create a log group with build commands"""
+    """Create a log group with build commands
+
+    If compile cache key arguments (toolchain, source directory) are given, each
+    build command is skipped when an identical compile has already succeeded, and
+    its stored output is logged instead.
+
+    The time each successful compile takes is written next to the output file. If
+    the metrics of the build (see get_build_metrics) are given, the results of each
+    build command are added to them and appended to the job's metrics file.
+    """
+    duration_filename = get_duration_file_for_log(output_filename)
+    record_duration = 'if [ "$result_code" -eq "0" ]; then record_build_duration "$build_start" "{}"; fi'.format(
+        duration_filename
+    )
+    record_metrics = None
+    if build_metrics is not None:
+        record_metrics = 'record_build_metrics {} {} "$result_code" "$build_start" "$cached" "{}" >> "$metrics_file"'.format(
+            shlex.quote(json.dumps(build_metrics, separators=(",", ":"))),
+            build_metrics["toolchain"],
+            output_filename,
+        )
     command_list = []
     command_list.append("\necho ::group::{}".format(group_title))
     command_list.append("group_failed=0")
@@ -185,12 +569,48 @@ def group_and_log_commands(
     for command in build_commands:
         if command.startswith("sed"):
             command_list.append(command)
+        elif compile_cache_key_args is not None:
+            command_digest = hashlib.sha256(command.encode("utf-8")).hexdigest()
+            command_list.append(
+                "compile_key=$(compile_cache_key {})".format(
+                    list2cmdline(compile_cache_key_args + [command_digest])
+                )
+            )
+            command_list.append("build_start=$(build_clock)")
+            command_list.append(
+                'if compile_cache_replay "$compile_key" "{}"; then'.format(
+                    output_filename
+                )
+            )
+            command_list.append("result_code=0")
+            command_list.append("cached=true")
+            command_list.append("else")
+            command_list.append("cached=false")
+            command_list.append("build_start=$(build_clock)")
+            command_list.append(command + ' 2>&1 | tee "$compile_output"')
+            command_list.append("result_code=${PIPESTATUS[0]}")
+            command_list.append(record_duration)
+            command_list.append('cat "$compile_output" >> "{}"'.format(output_filename))
+            command_list.append(
+                'if [ "$result_code" -eq "0" ]; then compile_cache_store "$compile_key" "$compile_output"; fi'
+            )
+            command_list.append("fi")
+            command_list.append(
+                'if [ "$result_code" -ne "0" ]; then group_failed=1; status=1; fi'
+            )
+            if record_metrics is not None:
+                command_list.append(record_metrics)
         else:
+            command_list.append("cached=false")
+            command_list.append("build_start=$(build_clock)")
             command_list.append(command + ' 2>&1 | tee -a "{}"'.format(output_filename))
             command_list.append("result_code=${PIPESTATUS[0]}")
+            command_list.append(record_duration)
             command_list.append(
                 'if [ "$result_code" -ne "0" ]; then group_failed=1; status=1; fi'
             )
+            if record_metrics is not None:
+                command_list.append(record_metrics)
     command_list.append("echo ::endgroup::")
     command_list.append(
         f'if [ "$group_failed" -eq "0" ]; then echo -e "\\e[32m{group_title} successfully compiled\\e[0m"; else echo -e "\\e[31m{group_title} failed to compile\\e[0m"; fi'
@@ -198,27 +618,69 @@ def group_and_log_commands(
     return command_list
 
 
+def get_build_metrics(command_block: CommandBlock, log_group: str) -> dict:
+    """
+    Get the metrics of a build that are known before it is run: the name of its log,
+    its log group and toolchain, and the values of its matrix item
+    """
+    return {
+        "log_file": os.path.basename(command_block.output_file_name),
+        "log_group": log_group,
+        "toolchain": command_block.compile_cache_key_args[0],
+        "matrix": dict(command_block.fields),
+    }
+
+
+def create_example_overlay_command(
+    example_path: str, overlay_path: str, sketch_file: str
+) -> str:
+    """Create a command that builds a copy of an example to compile and patch"""
+    return list2cmdline(
+        ["make_example_overlay", example_path, overlay_path, sketch_file]
+    )
+
+
+def retarget_example_path(command: str, example_path: str, overlay_path: str) -> str:
+    """Point any use of the checked out example in a command at its overlay"""
+    return re.sub(
+        re.escape(example_path) + r"(?=[/\\\s\"']|$)",
+        lambda _: overlay_path,
+        command,
+    )
+
+
 def create_command_list_from_matrix(
     matrix_item: dict,
     workspace_path: str,
     artifact_path: str,
     config: dict,
-) -> Optional[dict]:
-    """Convert a matrix item into a command block"""
-    required_keys = ["compiler", "example", "board"]
+    overlay_path: str | None = None,
+) -> Optional[CommandBlock]:
+    """Convert a matrix item into a command block
+
+    The matrix item must have a compiler, an example, and a board, FQBN, or
+    PlatformIO environment.
+
+    If an overlay path is given, the item is built from its own copy of the example
+    in that directory, and its commands patch that copy instead of the checked out
+    example.
+    """
+    required_keys = ["compiler", "example"]
     for key in required_keys:
         if key not in matrix_item:
             raise ValueError(f"Matrix item must contain the key '{key}'")
+    if not any(key in matrix_item for key in BOARD_KEYS):
+        raise ValueError(
+            f"Matrix item must contain one of the keys {', '.join(BOARD_KEYS)}"
+        )
 
     compiler = matrix_item.get("compiler", "")
     example = matrix_item.get("example", "")
     compiler_flags = list(matrix_item.get("compiler_flags", []))
     inline_defines = list(matrix_item.get("inline_defines", []))
 
-    job_dict = deepcopy(matrix_item)
-    job_dict["inline_defines"] = inline_defines
     output_file_name = get_filename_for_log(
-        job_dict,
+        matrix_item,
         artifact_path,
         [
             k
@@ -227,10 +689,38 @@ def create_command_list_from_matrix(
         ],
     )
 
+    # Build a per-item copy of the example: hard links (or reflinks) to every file,
+    # except the sketch, which is copied so it can be patched on its own
+    example_name = os.path.split(example)[-1]
+    example_path = os.path.join(workspace_path, example)
+    overlay_commands: List[str] = []
+    other_commands = list(matrix_item.get("other_commands", []))
+    if overlay_path is not None:
+        overlay_example_path = os.path.join(
+            overlay_path,
+            os.path.splitext(os.path.basename(output_file_name))[0],
+            example_name,
+        )
+        overlay_commands.append(
+            create_example_overlay_command(
+                example_path, overlay_example_path, example_name + ".ino"
+            )
+        )
+        other_commands = [
+            retarget_example_path(command, example_path, overlay_example_path)
+            for command in other_commands
+        ]
+        code_path = os.path.dirname(overlay_example_path)
+        code_subfolder = example_name
+    else:
+        overlay_example_path = example_path
+        code_path = workspace_path
+        code_subfolder = example
+
     if compiler == "arduino-cli":
         build_command = create_arduino_cli_compile_command(
-            workspace_path=workspace_path,
-            code_subfolder=example,
+            workspace_path=code_path,
+            code_subfolder=code_subfolder,
             fqbn=(
                 matrix_item["fqbn"]
                 if "fqbn" in matrix_item
@@ -241,8 +731,8 @@ def create_command_list_from_matrix(
         )
     elif compiler in ["platformio", "pio"]:
         build_command = create_pio_ci_compile_command(
-            workspace_path=workspace_path,
-            code_subfolder=example,
+            workspace_path=code_path,
+            code_subfolder=code_subfolder,
             pio_board_or_env=(
                 matrix_item["pio_env"]
                 if "pio_env" in matrix_item
@@ -256,8 +746,7 @@ def create_command_list_from_matrix(
         raise ValueError("Invalid compiler provided.")
 
     # Handle inline flags (sed commands)
-    example_name = os.path.split(example)[-1]
-    example_full_path = os.path.join(workspace_path, example, example_name + ".ino")
+    example_full_path = os.path.join(overlay_example_path, example_name + ".ino")
     sed_commands: List[str] = []
     for flag in inline_defines:
         if len(flag) > 0:
@@ -268,28 +757,95 @@ def create_command_list_from_matrix(
                 f'#endif\\\n\' "{example_full_path}"'
             )
 
-    job_dict["output_file_name"] = output_file_name
-    job_dict["other_commands"] = matrix_item.get("other_commands", []) + sed_commands
-    job_dict["build_commands"] = [build_command]
+    return CommandBlock(
+        matrix_item,
+        output_file_name=output_file_name,
+        other_commands=overlay_commands + other_commands + sed_commands,
+        build_commands=[build_command],
+        compile_cache_key_args=[
+            "arduino-cli" if compiler == "arduino-cli" else "platformio",
+            overlay_example_path,
+        ],
+    )
 
-    return deepcopy(job_dict)
 
+def get_job_costs(job_units: List[dict]) -> dict[str, float]:
+    """Sum the expected seconds of the log groups in each job grouped by the job grouping fields"""
+    job_costs: dict[str, float] = {}
+    for unit in job_units:
+        job_costs[unit["affinity"]] = job_costs.get(unit["affinity"], 0) + unit["cost"]
+    return job_costs
+
+
+def create_packed_job_matrix(
+    grouped_command_matrix: dict[str, dict], job_units: List[dict], job_count: int
+) -> dict[str, dict]:
+    """
+    Pack the log groups into jobs by their expected durations, instead of making one
+    job for each combination of the job grouping fields (see build_scheduler.py)
+    """
+    grouped_job_matrix: dict[str, dict] = {}
+    job_numbers: dict[str, int] = {}
+    for units in pack_jobs(job_units, job_count):
+        toolchain = units[0]["toolchain"]
+        job_numbers[toolchain] = job_numbers.get(toolchain, 0) + 1
+        job_tag = f"{toolchain}-job-{job_numbers[toolchain]:02d}"
+        names = list(dict.fromkeys(unit["affinity_name"] for unit in units))
+        # which groups share a packed job changes from run to run, so the compile
+        # results are cached under the job's costliest grouping, which mostly stays
+        # with the same builds
+        affinity_costs = get_job_costs(units)
+        cache_tag = max(affinity_costs, key=affinity_costs.__getitem__)
+        job_name = f"{toolchain} - job {job_numbers[toolchain]}: " + ", ".join(names[:3])
+        if len(names) > 3:
+            job_name += f" and {len(names) - 3} more"
+        grouped_job_matrix[job_tag] = {
+            "job_name": job_name,
+            "job_tag": job_tag.lower(),
+            "job_command": [
+                command
+                for unit in units
+                for command in grouped_command_matrix[unit["log_group"]][
+                    "group_commands"
+                ]
+            ],
+            "cache_tag": cache_tag.lower(),
+            "toolchain": toolchain,
+            "cost": sum(unit["cost"] for unit in units),
+        }
+    return grouped_job_matrix
 
-if __name__ == "__main__":
+
+def main(args: configargparse.Namespace | None = None) -> int:
+    """Build the command blocks, log groups, jobs and bash scripts from the final matrix"""
     print("=" * 60)
     print("CI Build Pipeline: Build Jobs")
     print("=" * 60)
 
-    print_verbose(
-        "Reading configuration from environment variables, command line arguments, and the config file..."
-    )
-    args = get_extended_config()
+    if args is None:
+        print_verbose(
+            "Reading configuration from environment variables, command line arguments, and the config file..."
+        )
+        try:
+            with timed_span("Read the config"):
+                args = get_extended_config()
+        except ConfigError as e:
+            print(f"::error::{e}")
+            return 1
     set_verbose_mode(args.verbose)
     config = vars(args)
+    interned_values.clear()
 
     workspace_path = args.workspace_path
     artifact_path = args.artifact_path
-    final_matrix = args.final_matrix
+    # read the matrix from the matrix file, or from a config file written before there
+    # was a matrix file
+    if config.get("matrix_file_path") is not None:
+        final_matrix = MatrixStore(args.matrix_file_path)
+    else:
+        final_matrix = args.final_matrix
+    # every matrix item is built from its own copy of the example in this directory
+    overlay_path = os.path.join(artifact_path, "example_overlays")
 
     # if any("board" in matrix_item.keys() for matrix_item in final_matrix):
     #     import importlib.util
@@ -332,24 +888,40 @@ if __name__ == "__main__":
     #             final_matrix[n]["pio_env"] = env
 
     # Convert matrix to command blocks
-    print(f"Converting {len(final_matrix)} matrix items to command blocks...")
-    complete_command_matrix: List[dict] = []
-    for matrix_item in final_matrix:
-        command_block = create_command_list_from_matrix(
-            matrix_item=matrix_item,
-            workspace_path=workspace_path,
-            artifact_path=artifact_path,
-            config=config,
-        )
-        if command_block is not None:
-            complete_command_matrix.append(command_block)
+    # NOTE: The final matrix may be any iterable (ie, a MatrixStore that streams the
+    # entries from the matrix file), so it is only iterated once and never indexed.
+    print("Converting matrix items to command blocks...")
+    complete_command_matrix: List[CommandBlock] = []
+    first_matrix_keys: List[str] = []
+    with timed_span("Create the command blocks"):
+        for matrix_item in final_matrix:
+            if len(first_matrix_keys) == 0:
+                first_matrix_keys = list(matrix_item.keys())
+                # the matrix items may name their boards with different keys (ie, an
+                # FQBN or a PlatformIO environment), so group them by board instead
+                if "board" not in first_matrix_keys:
+                    first_matrix_keys = list(
+                        dict.fromkeys(
+                            "board" if k in BOARD_KEYS else k for k in first_matrix_keys
+                        )
+                    )
+            command_block = create_command_list_from_matrix(
+                matrix_item=matrix_item,
+                workspace_path=workspace_path,
+                artifact_path=artifact_path,
+                config=config,
+                overlay_path=overlay_path,
+            )
+            if command_block is not None:
+                complete_command_matrix.append(command_block)
 
     print(f"Total command blocks: {len(complete_command_matrix)}")
 
     # Group commands for logging
     if len(complete_command_matrix) == 0:
         print("::warning::No command blocks to process!")
-        sys.exit(0)
+        write_timing_report("Build Jobs", artifact_path)
+        return 0
 
     # Use log_grouping_fields from config, or default to all keys
     if "log_grouping_fields" in config and len(config["log_grouping_fields"]) > 0:
@@ -364,53 +936,22 @@ if __name__ == "__main__":
         ]
         print(f"Using log grouping fields from config: {log_groupers}")
     else:
-        log_groupers = list(final_matrix[0].keys())
+        log_groupers = first_matrix_keys
         # remove "build_commands" and "other_commands" from log_groupers if present
         log_groupers = [
             g for g in log_groupers if g not in ["build_commands", "other_commands"]
         ]
         print(f"Using all matrix keys as log grouping fields: {log_groupers}")
 
-    grouped_command_matrix: dict[str, dict] = {}
-    for matrix_item in complete_command_matrix:
-        l_names = []
-        for grouper in log_groupers:
-            if grouper not in matrix_item.keys():
-                raise ValueError(
-                    f"Matrix item {matrix_item} does not have the key {grouper}"
-                )
-            elif matrix_item[grouper] is None:
-                raise ValueError(
-                    f"Matrix item {matrix_item} has a None value for the key {grouper}"
-                )
-            else:
-                l_names.append(get_filename_slug(grouper, matrix_item[grouper]))
-
-        l_key = "_".join(l_names)
-        l_key = re.sub(r"[\-]{2,}", "-", l_key)
-        l_key = re.sub(r"[_]{2,}", "_", l_key)
-
-        l_command_list = group_and_log_commands(
-            matrix_item["build_commands"],
-            matrix_item["other_commands"],
-            group_title=l_key,
-            output_filename=matrix_item["output_file_name"],
+    # Expected build durations, for packing the jobs
+    job_count = int(config.get("job_count") or 0)
+    with timed_span("Load the build durations"):
+        cost_model = BuildCostModel(
+            load_build_durations(config["build_durations_file"])
+            if config.get("build_durations_file")
+            else {}
         )
 
-        if l_key not in grouped_command_matrix.keys():
-            l_dict: dict = {
-                "log_group": l_key,
-                "group_commands": l_command_list,
-            }
-            for grouper in log_groupers:
-                l_dict[grouper] = matrix_item[grouper]
-            grouped_command_matrix[l_key] = deepcopy(l_dict)
-        else:
-            grouped_command_matrix[l_key]["group_commands"] += l_command_list
-
-    print(f"Total log groups: {len(grouped_command_matrix)}")
-
-    # Group into jobs
     # Use job_grouping_fields from config, or default to ["compiler", "board"]
     if "job_grouping_fields" in config and len(config["job_grouping_fields"]) > 0:
         job_groupers = config["job_grouping_fields"]
@@ -418,54 +959,165 @@ if __name__ == "__main__":
     else:
         job_groupers = ["compiler", "board"]
         print(f"Using default job grouping fields: {job_groupers}")
-    grouped_job_matrix = {}
 
-    for l_key, group_dict in grouped_command_matrix.items():
-        j_names = []
-        for grouper in job_groupers:
-            if grouper not in group_dict.keys():
+    # Group the blocks into log groups and jobs in one pass, by the values of the
+    # grouping fields or by the custom key functions of the custom matrix builder
+    with timed_span("Group the command blocks"):
+        custom_module = load_custom_matrix_builder(config)
+        job_key_function = load_custom_key_function(
+            custom_module, "get_job_group_fields"
+        ) or create_field_key_function(job_groupers)
+        log_key_function = load_custom_key_function(
+            custom_module, "get_log_group_fields"
+        ) or create_field_key_function(log_groupers)
+        grouped_blocks = group_by_levels(
+            complete_command_matrix, [job_key_function, log_key_function]
+        )
+
+        # Groups in the same job whose values give the same names are merged, so each
+        # name is one group. A log group is only ever in one job, so the log group key
+        # must refine the job key: two blocks in the same log group must be in the
+        # same job.
+        grouped_command_matrix: dict[str, dict] = {}
+        log_group_fields: dict[str, tuple[GroupKey, GroupKey]] = {}
+        # The log of every build, for parse_test_results.py
+        log_manifest: List[dict] = []
+        for (j_fields, l_fields), command_blocks in grouped_blocks.items():
+            l_key = get_log_group_key(l_fields)
+            if l_key in grouped_command_matrix and log_group_fields[l_key][0] != j_fields:
                 raise ValueError(
-                    f"Matrix item {group_dict} does not have the key {grouper}"
+                    f"The log group '{l_key}' would be in the jobs "
+                    f"{dict(log_group_fields[l_key][0])} and {dict(j_fields)}. "
+                    "The log grouping fields must include the job grouping fields, "
+                    "so each log group is in a single job."
+                )
+            if l_key not in grouped_command_matrix:
+                grouped_command_matrix[l_key] = {
+                    "log_group": l_key,
+                    "group_commands": [],
+                    "toolchain": command_blocks[0].compile_cache_key_args[0],
+                    "cost": 0.0,
+                    **dict(l_fields),
+                }
+                log_group_fields[l_key] = (j_fields, l_fields)
+            l_dict = grouped_command_matrix[l_key]
+            for command_block in command_blocks:
+                if command_block.compile_cache_key_args[0] != l_dict["toolchain"]:
+                    raise ValueError(
+                        f"The log group '{l_key}' would build with both "
+                        f"{l_dict['toolchain']} and "
+                        f"{command_block.compile_cache_key_args[0]}. The grouping "
+                        "fields must keep the Arduino CLI and PlatformIO builds apart."
+                    )
+                build_metrics = get_build_metrics(command_block, l_key)
+                log_manifest.append(
+                    {
+                        k: build_metrics[k]
+                        for k in ["log_file", "toolchain", "log_group"]
+                    }
                 )
-            elif group_dict[grouper] is None:
+                l_dict["group_commands"] += group_and_log_commands(
+                    command_block.build_commands,
+                    command_block.other_commands,
+                    group_title=l_key,
+                    output_filename=command_block.output_file_name,
+                    compile_cache_key_args=list(command_block.compile_cache_key_args),
+                    build_metrics=build_metrics,
+                )
+                l_dict["cost"] += cost_model.estimate(
+                    get_duration_key(command_block.output_file_name),
+                    command_block.compile_cache_key_args[0],
+                )
+
+        print(f"Total log groups: {len(grouped_command_matrix)}")
+
+    # Group into jobs
+    with timed_span("Group the log groups into jobs"):
+        grouped_job_matrix = {}
+        job_units: List[dict] = []
+        job_names: dict[GroupKey, List[str]] = {}
+        for l_key, group_dict in grouped_command_matrix.items():
+            j_fields, l_fields = log_group_fields[l_key]
+            if j_fields not in job_names:
+                job_names[j_fields] = [
+                    get_filename_slug(grouper, value) for grouper, value in j_fields
+                ]
+            j_names = job_names[j_fields]
+
+            job_name = " - ".join(j_names)
+            job_tag = "-".join(j_names)
+            job_units.append(
+                {
+                    "log_group": l_key,
+                    "toolchain": group_dict["toolchain"],
+                    "affinity": job_tag,
+                    "affinity_name": " - ".join(
+                        name
+                        for (grouper, _), name in zip(j_fields, j_names)
+                        if grouper != "compiler"
+                    )
+                    or job_name,
+                    "cost": group_dict["cost"],
+                }
+            )
+
+            if job_tag not in grouped_job_matrix.keys():
+                j_dict: dict = {
+                    "job_name": job_name,
+                    "job_tag": job_tag.lower(),
+                    "cache_tag": job_tag.lower(),
+                    "job_command": list(group_dict["group_commands"]),
+                    "toolchain": group_dict["toolchain"],
+                }
+                j_dict.update(l_fields)
+                grouped_job_matrix[job_tag] = j_dict
+            elif grouped_job_matrix[job_tag]["toolchain"] != group_dict["toolchain"]:
                 raise ValueError(
-                    f"Matrix item {group_dict} has a None value for the key {grouper}"
+                    f"The job '{job_name}' would build with both "
+                    f"{grouped_job_matrix[job_tag]['toolchain']} and "
+                    f"{group_dict['toolchain']}. The grouping fields must keep the "
+                    "Arduino CLI and PlatformIO builds apart."
                 )
             else:
-                j_names.append(get_filename_slug(grouper, group_dict[grouper]))
-
-        job_name = " - ".join(j_names)
-        job_tag = "-".join(j_names)
-
-        if job_tag not in grouped_job_matrix.keys():
-            j_dict: dict = {
-                "job_name": job_name,
-                "job_tag": job_tag.lower(),
-                "job_command": group_dict["group_commands"],
-            }
-            for grouper in log_groupers:
-                j_dict[grouper] = group_dict[grouper]
-            grouped_job_matrix[job_tag] = j_dict
-        else:
-            grouped_job_matrix[job_tag]["job_command"] += group_dict["group_commands"]
+                grouped_job_matrix[job_tag]["job_command"].extend(
+                    group_dict["group_commands"]
+                )
 
     print(f"Total jobs: {len(grouped_job_matrix)}")
+    print(
+        f"Build durations: {cost_model.known} from earlier runs, {cost_model.unknown} estimated"
+    )
+    print(f"Expected longest job: {max(get_job_costs(job_units).values()):.0f} s")
+    if job_count > 0:
+        with timed_span("Pack the jobs"):
+            grouped_job_matrix = create_packed_job_matrix(
+                grouped_command_matrix, job_units, job_count
+            )
+        print(f"Packed into {len(grouped_job_matrix)} jobs")
+        print(
+            f"Expected longest packed job: {max(j['cost'] for j in grouped_job_matrix.values()):.0f} s"
+        )
 
     # Generate bash scripts
-    start_job_commands: List[str] = ["status=0"]
-    end_job_commands: List[str] = [
-        "\n\nexit $status",
-    ]
+    with timed_span("Write the job scripts"):
+        toolchain_fingerprint_functions = create_toolchain_fingerprint_functions(config)
+        start_job_commands: List[str] = ["status=0"]
+        end_job_commands: List[str] = [
+            "\n\nexit $status",
+        ]
 
-    for job_tag, matrix_job in grouped_job_matrix.items():
-        bash_file_name = job_tag + ".sh"
-        bash_file_path = os.path.join(artifact_path, bash_file_name)
-        if use_verbose:
-            print(f"Writing bash script to {bash_file_path}")
+        for job_tag, matrix_job in grouped_job_matrix.items():
+            bash_file_name = job_tag + ".sh"
+            bash_file_path = os.path.join(artifact_path, bash_file_name)
+            metrics_file_path = os.path.join(
+                artifact_path, job_tag + BUILD_METRICS_FILE_SUFFIX
+            )
+            if use_verbose:
+                print(f"Writing bash script to {bash_file_path}")
 
-        with open(bash_file_path, "w") as bash_out:
-            bash_out.write("#!/bin/bash\n\n")
-            bash_out.write("""set -e # Exit with nonzero exit code if anything fails
+            with open(bash_file_path, "w") as bash_out:
+                bash_out.write("#!/bin/bash\n\n")
+                bash_out.write("""set -e # Exit with nonzero exit code if anything fails
 if [ "$RUNNER_DEBUG" = "1" ]; then
     echo "Enabling debugging!"
     set -v # Prints shell input lines as they are read.
@@ -473,33 +1125,44 @@ if [ "$RUNNER_DEBUG" = "1" ]; then
 fi
 
 """)
-            bash_out.write("\n".join(start_job_commands))
-            bash_out.write("\n\n")
-            bash_out.write("\n".join(matrix_job["job_command"]))
-            bash_out.write("\n\n")
-            bash_out.write("\n".join(end_job_commands))
+                bash_out.write(EXAMPLE_OVERLAY_FUNCTION)
+                bash_out.write(COMPILE_CACHE_FUNCTIONS)
+                bash_out.write(BUILD_TIMER_FUNCTIONS)
+                bash_out.write(BUILD_METRICS_FUNCTIONS)
+                bash_out.write(toolchain_fingerprint_functions)
+                bash_out.write("\n".join(start_job_commands))
+                bash_out.write(
+                    f"\ncompute_toolchain_digest {matrix_job['toolchain']}"
+                )
+                bash_out.write(
+                    f'\nmetrics_file="{metrics_file_path}"\n: > "$metrics_file"'
+                )
+                bash_out.write("\n\n")
+                bash_out.write("\n".join(matrix_job["job_command"]))
+                bash_out.write("\n\n")
+                bash_out.write("\n".join(end_job_commands))
 
-        matrix_job["script"] = bash_file_path
+            matrix_job["script"] = bash_file_path
 
     # Prepare output matrices
     arduino_job_matrix = [
         {
             vk: vv
             for vk, vv in v.items()
-            if vk == "job_name" or vk == "job_tag" or vk == "script"
+            if vk in ["job_name", "job_tag", "cache_tag", "script"]
         }
         for k, v in grouped_job_matrix.items()
-        if v["compiler"] == "arduino-cli"
+        if v["toolchain"] == "arduino-cli"
     ]
 
     pio_job_matrix = [
         {
             vk: vv
             for vk, vv in v.items()
-            if vk == "job_name" or vk == "job_tag" or vk == "script"
+            if vk in ["job_name", "job_tag", "cache_tag", "script"]
         }
         for k, v in grouped_job_matrix.items()
-        if v["compiler"] in ["platformio", "pio"]
+        if v["toolchain"] == "platformio"
     ]
 
     # Write matrices to JSON files
@@ -507,11 +1170,16 @@ fi
     arduino_matrix_file = os.path.join(artifact_path, "arduino_job_matrix.json")
     pio_matrix_file = os.path.join(artifact_path, "pio_job_matrix.json")
 
-    save_json_file(arduino_matrix_file, arduino_job_matrix)
-    save_json_file(pio_matrix_file, pio_job_matrix)
+    with timed_span("Write the job matrices and the log manifest"):
+        save_json_file(arduino_matrix_file, arduino_job_matrix)
+        save_json_file(pio_matrix_file, pio_job_matrix)
+
+        print(f"Arduino job matrix saved to: {arduino_matrix_file}")
+        print(f"PlatformIO job matrix saved to: {pio_matrix_file}")
 
-    print(f"Arduino job matrix saved to: {arduino_matrix_file}")
-    print(f"PlatformIO job matrix saved to: {pio_matrix_file}")
+        log_manifest_file = os.path.join(artifact_path, LOG_MANIFEST_FILE_NAME)
+        write_log_manifest(log_manifest, log_manifest_file)
+    print(f"Log manifest saved to: {log_manifest_file}")
 
     # Output to GitHub
     if "GITHUB_OUTPUT" in os.environ.keys():
@@ -540,4 +1208,13 @@ fi
         for job in pio_job_matrix:
             print_verbose(f"  - {job['job_name']}")
 
+    write_timing_report("Build Jobs", artifact_path)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+
 # cSpell:ignore
@@ -11,18 +11,32 @@ Removes:
 # %%
 import os
 import json
+import sys
 import shutil
-from build_config import get_extended_config, set_verbose_mode, print_verbose
+import configargparse
+from build_config import (
+    ConfigError,
+    get_extended_config,
+    set_verbose_mode,
+    print_verbose,
+    write_timing_report,
+)
 
 # %%
-if __name__ == "__main__":
+def main(args: configargparse.Namespace | None = None) -> int:
+    """Remove the downloaded configuration files and, optionally, the artifacts"""
     # Only clean up if NOT in GitHub Actions
     if "GITHUB_WORKSPACE" not in os.environ.keys():
 
-        print_verbose(
-            "Reading configuration from environment variables, command line arguments, and the config file..."
-        )
-        args = get_extended_config()
+        if args is None:
+            print_verbose(
+                "Reading configuration from environment variables, command line arguments, and the config file..."
+            )
+            try:
+                args = get_extended_config()
+            except ConfigError as e:
+                print(f"::error::{e}")
+                return 1
         set_verbose_mode(args.verbose)
 
         print("Running locally - cleaning up generated files...")
@@ -63,5 +77,14 @@ if __name__ == "__main__":
                 print(f"Warning: Could not remove {args.artifact_path}: {e}")
 
         print("Cleanup complete")
+
+        # the trace is only saved if the artifacts were kept
+        write_timing_report("Cleanup", args.artifact_path)
     else:
         print("Running in GitHub Actions - skipping cleanup")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,525 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the CI Build Pipeline matrix utilities.
+
+This is not part of the pipeline. Run it locally to check how the matrix utilities
+scale with the size of the build matrix.
+
+Usage:
+    python benchmark_pipeline.py dedupe [--sizes 10000,100000,1000000] [--reference]
+    python benchmark_pipeline.py packing [--runners 10,20,40] [--boards 40] [--examples 15]
+    python benchmark_pipeline.py jobs [--sizes 10000,100000] [--reference]
+    python benchmark_pipeline.py logs [--count 2000] [--kilobytes 200] [--workers 1,4]
+    python benchmark_pipeline.py history [--runs 100] [--builds 3000]
+"""
+
+# %%
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import tracemalloc
+from copy import deepcopy
+from itertools import islice
+from build_utils import (
+    BUILD_METRICS_FILE_SUFFIX,
+    dict_product,
+    load_pipeline_stage,
+    remove_nested_duplicates,
+)
+from build_scheduler import JOB_SETUP_SECONDS, pack_jobs, simulate_makespan
+
+
+# %%
+# Synthetic matrices
+
+
+def make_synthetic_matrix(size: int, duplicate_fraction: float = 0.1) -> list[dict]:
+    """Make a matrix of roughly the shape the default builder makes.
+
+    About duplicate_fraction of the entries are copies of earlier entries with their
+    keys and their order-independent lists shuffled.
+    """
+    rng = random.Random(size)
+    unique_size = int(size * (1 - duplicate_fraction))
+    inline_defines = [[], ["MS_DEBUG"], ["BUILD_MODEM_SIM7080", "MS_DEBUG"]]
+    compiler_flags = [[], ["-Wall"], ["-Wall", "-Wextra"]]
+    n_examples = max(1, unique_size // (100 * len(inline_defines) * len(compiler_flags)))
+    options = {
+        "compiler": ["platformio"],
+        "example": [f"examples/example_{n}" for n in range(n_examples)],
+        "pio_env": [f"env_{n}" for n in range(100)],
+        "inline_defines": inline_defines,
+        "compiler_flags": compiler_flags,
+    }
+    matrix = []
+    for entry in islice(dict_product(options), unique_size):
+        entry["other_commands"] = [f"sed -i 's/a/b/g' {entry['example']}", "true"]
+        matrix.append(entry)
+    while len(matrix) < size:
+        duplicate = dict(matrix[rng.randrange(unique_size)])
+        duplicate["other_commands"] = list(reversed(duplicate["other_commands"]))
+        duplicate = dict(reversed(list(duplicate.items())))
+        matrix.append(duplicate)
+    rng.shuffle(matrix)
+    return matrix
+
+
+def make_synthetic_log_groups(
+    boards: int, examples: int, seed: int = 0
+) -> list[dict]:
+    """Make log groups with build durations of roughly the spread seen on the runners.
+
+    Each log group builds one example for one board with one set of inline defines.
+    How long a build takes depends on the board's platform (ie, ESP32 builds are much
+    slower than AVR builds) and on the size of the example.
+    """
+    rng = random.Random(seed)
+    log_groups = []
+    for toolchain in ["arduino-cli", "platformio"]:
+        board_factors = [rng.lognormvariate(0, 0.7) for _ in range(boards)]
+        example_factors = [rng.lognormvariate(0, 0.5) for _ in range(examples)]
+        for b, board_factor in enumerate(board_factors):
+            for e, example_factor in enumerate(example_factors):
+                for defines in range(3):
+                    log_groups.append(
+                        {
+                            "log_group": f"{toolchain}_{e}_{b}_{defines}",
+                            "toolchain": toolchain,
+                            "affinity": f"{toolchain}-board_{b}",
+                            "cost": 30 * board_factor * example_factor,
+                        }
+                    )
+    return log_groups
+
+
+# %%
+# Reference implementations
+
+
+def reference_remove_nested_duplicates(list_with_dups: list) -> list:
+    """The previous JSON normalization de-duplication, for comparison"""
+    ordered_fields = {"inline_defines", "compiler_flags"}
+
+    def normalize(value, ignore_job_group=False, parent_key=None):
+        if isinstance(value, dict):
+            return {
+                k: normalize(v, parent_key=k)
+                for k, v in value.items()
+                if not (ignore_job_group and k == "job_group")
+            }
+        if isinstance(value, list):
+            items = [normalize(item, parent_key=parent_key) for item in value]
+            if parent_key in ordered_fields:
+                return items
+            return sorted(items, key=lambda x: json.dumps(x, sort_keys=True))
+        return value
+
+    seen = set()
+    deduped_list = []
+    for item in list_with_dups:
+        json_str = json.dumps(
+            normalize(item, ignore_job_group=isinstance(item, dict)), sort_keys=True
+        )
+        if json_str not in seen:
+            seen.add(json_str)
+            deduped_list.append(item)
+    return deduped_list
+
+
+def reference_command_dict(matrix_item: dict, command_block) -> dict:
+    """The previous dictionary command block: a deep copy of the matrix item with its
+    commands, deep copied again when it is returned"""
+    job_dict = deepcopy(matrix_item)
+    job_dict["output_file_name"] = command_block.output_file_name
+    job_dict["other_commands"] = list(command_block.other_commands)
+    job_dict["build_commands"] = list(command_block.build_commands)
+    job_dict["compile_cache_key_args"] = list(command_block.compile_cache_key_args)
+    return deepcopy(job_dict)
+
+
+# %%
+# Benchmarks
+
+
+def time_call(func, *args) -> tuple[float, object]:
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def benchmark_dedupe(sizes: list[int], reference: bool) -> None:
+    """Time remove_nested_duplicates on synthetic matrices of each size"""
+    print(f"{'entries':>10} {'unique':>10} {'seconds':>9} {'us/entry':>9}", end="")
+    print(f" {'reference s':>12}" if reference else "")
+    for size in sizes:
+        matrix = make_synthetic_matrix(size)
+        elapsed, deduped = time_call(remove_nested_duplicates, matrix)
+        line = f"{size:>10} {len(deduped):>10} {elapsed:>9.3f} {elapsed / size * 1e6:>9.2f}"
+        if reference:
+            ref_elapsed, ref_deduped = time_call(
+                reference_remove_nested_duplicates, matrix
+            )
+            if ref_deduped != deduped:
+                print("::error::De-duplicated matrices do not match the reference!")
+                sys.exit(1)
+            line += f" {ref_elapsed:>12.3f}"
+        print(line)
+
+
+def benchmark_packing(runners: list[int], boards: int, examples: int) -> None:
+    """Compare the simulated workflow time of the packed jobs and the jobs per board"""
+    log_groups = make_synthetic_log_groups(boards, examples)
+    grouped_costs: dict[str, float] = {}
+    for log_group in log_groups:
+        grouped_costs[log_group["affinity"]] = (
+            grouped_costs.get(log_group["affinity"], 0) + log_group["cost"]
+        )
+    total = sum(grouped_costs.values())
+    print(
+        f"{len(log_groups)} log groups, {len(grouped_costs)} jobs by board, "
+        f"{total / 3600:.1f} h of builds, {JOB_SETUP_SECONDS:.0f} s setup per job"
+    )
+    print(
+        f"{'runners':>8} {'by board s':>11} {'packed s':>9} {'bound s':>8} "
+        f"{'speedup':>8} {'pack ms':>8}"
+    )
+    for runner_count in runners:
+        by_board = simulate_makespan(grouped_costs.values(), runner_count)
+        elapsed, packed_jobs = time_call(pack_jobs, log_groups, runner_count)
+        packed = simulate_makespan(
+            [sum(u["cost"] for u in job) for job in packed_jobs], runner_count
+        )
+        # no schedule on this many runners can finish sooner than this
+        bound = JOB_SETUP_SECONDS + max(
+            total / runner_count, max(u["cost"] for u in log_groups)
+        )
+        print(
+            f"{runner_count:>8} {by_board:>11.0f} {packed:>9.0f} {bound:>8.0f} "
+            f"{by_board / packed:>8.2f} {elapsed * 1000:>8.1f}"
+        )
+
+
+def get_retained_megabytes(func, *args) -> tuple[float, object]:
+    """Get the megabytes of memory still allocated by a function after it returns"""
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    result = func(*args)
+    retained = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return retained / 1e6, result
+
+
+def benchmark_jobs(sizes: list[int], reference: bool) -> None:
+    """Time making the command blocks for synthetic matrices of each size, and
+    measure the memory they take, per 100k matrix entries"""
+    build_jobs = load_pipeline_stage(
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), "4_build_jobs.py")
+    )
+    config = {
+        "arduino_cli_config": "/ws/arduino_cli.yaml",
+        "pio_config_file": "/ws/platformio.ini",
+    }
+
+    def make_block(matrix_item: dict):
+        return build_jobs.create_command_list_from_matrix(
+            matrix_item=matrix_item,
+            workspace_path="/ws",
+            artifact_path="/ws/artifacts",
+            config=config,
+            overlay_path="/ws/artifacts/example_overlays",
+        )
+
+    # each entry is decoded from its own line, like the matrix file, so the entries
+    # share no strings
+    def make_blocks(lines):
+        return [make_block(json.loads(line)) for line in lines]
+
+    def make_reference_blocks(lines):
+        blocks = []
+        for line in lines:
+            matrix_item = json.loads(line)
+            blocks.append(reference_command_dict(matrix_item, make_block(matrix_item)))
+        return blocks
+
+    print(f"{'entries':>10} {'s/100k':>8} {'MB/100k':>8}", end="")
+    print(f" {'ref s/100k':>11} {'ref MB/100k':>12}" if reference else "")
+    for size in sizes:
+        lines = [json.dumps(entry) for entry in make_synthetic_matrix(size)]
+        per_100k = 100000 / size
+        elapsed, _blocks = time_call(make_blocks, lines)
+        del _blocks
+        megabytes, _blocks = get_retained_megabytes(make_blocks, lines)
+        del _blocks
+        line = f"{size:>10} {elapsed * per_100k:>8.2f} {megabytes * per_100k:>8.1f}"
+        if reference:
+            # the reference makes the same commands, then copies them into dicts
+            ref_elapsed, _blocks = time_call(make_reference_blocks, lines)
+            del _blocks
+            ref_megabytes, _blocks = get_retained_megabytes(make_reference_blocks, lines)
+            del _blocks
+            line += f" {ref_elapsed * per_100k:>11.2f} {ref_megabytes * per_100k:>12.1f}"
+        print(line)
+
+
+def write_synthetic_pio_logs(log_path: str, count: int, kilobytes: int) -> list[str]:
+    """
+    Write PlatformIO logs of about the given size, one in ten of them failed, and
+    the metrics file the job script would write for them
+    """
+    filler = "Compiling .pio/build/mayfly/src/main.cpp.o\n"
+    filler *= kilobytes * 1024 // len(filler)
+    log_files = []
+    metrics_file = open(os.path.join(log_path, "job" + BUILD_METRICS_FILE_SUFFIX), "w")
+    for n in range(count):
+        log_file = os.path.join(log_path, f"platformio_ex{n % 30}_board{n % 40}_{n}.log")
+        build_metrics = {
+            "log_file": os.path.basename(log_file),
+            "log_group": os.path.splitext(os.path.basename(log_file))[0],
+            "toolchain": "platformio",
+            "matrix": {
+                "compiler": "platformio",
+                "example": f"examples/ex{n % 30}",
+                "pio_env": f"board{n % 40}",
+            },
+            "exit_code": 1 if n % 10 == 0 else 0,
+            "seconds": 7.963,
+            "cached": False,
+            "toolchain_version": "PlatformIO Core, version 6.1.16",
+        }
+        if n % 10 != 0:
+            build_metrics.update(
+                {
+                    "ram_used": 1000 + n,
+                    "ram_total": 8192,
+                    "flash_used": 20000 + n,
+                    "flash_total": 32256,
+                }
+            )
+        metrics_file.write(json.dumps(build_metrics) + "\n")
+        with open(log_file, "w") as f:
+            f.write(filler)
+            if n % 10 == 0:
+                f.write("*** [.pio/build/mayfly/firmware.elf] Error 1\n")
+                f.write(f"board{n % 40}   FAILED    00:00:03.100\n")
+            else:
+                f.write(
+                    f"RAM:   [====      ]  35.4% (used {1000 + n} bytes from 8192 bytes)\n"
+                    f"Flash: [===       ]  26.9% (used {20000 + n} bytes from 32256 bytes)\n"
+                    f"board{n % 40}   SUCCESS   00:00:07.963\n"
+                )
+        log_files.append(log_file)
+    metrics_file.close()
+    return log_files
+
+
+def benchmark_logs(count: int, kilobytes: int, workers: list[int]) -> None:
+    """Time parsing synthetic PlatformIO logs, reading each one whole and serially
+    as before, and from their ends on each number of worker processes, and merging
+    the metrics recorded by the job scripts instead of parsing the logs"""
+    import parse_test_results
+
+    with tempfile.TemporaryDirectory() as tmp:
+        log_files = write_synthetic_pio_logs(tmp, count, kilobytes)
+
+        def parse_whole_logs():
+            results = []
+            for log_file in log_files:
+                with open(log_file, "r") as f:
+                    results.append(parse_test_results.parse_pio_output(f.read()))
+            return results
+
+        ref_elapsed, ref_results = time_call(parse_whole_logs)
+        print(f"{count} logs of {kilobytes} KB, read whole: {ref_elapsed:.2f} s")
+        print(f"{'workers':>8} {'s':>8} {'speedup':>8}")
+        for worker_count in workers:
+            elapsed, results = time_call(
+                parse_test_results.parse_log_files,
+                log_files,
+                [None] * len(log_files),
+                worker_count,
+            )
+            if [{k: r[k] for k in ref_results[0]} for r, _ in results] != ref_results:
+                print("::error::The parsed logs do not match the whole logs!")
+                sys.exit(1)
+            print(f"{worker_count:>8} {elapsed:>8.2f} {ref_elapsed / elapsed:>8.1f}")
+
+        def merge_metrics():
+            build_metrics = parse_test_results.find_build_metrics(tmp)
+            return parse_test_results.parse_log_files(
+                log_files,
+                [build_metrics.get(os.path.basename(f)) for f in log_files],
+                1,
+            )
+
+        elapsed, results = time_call(merge_metrics)
+        if [{k: r[k] for k in ref_results[0]} for r, _ in results] != ref_results:
+            print("::error::The merged metrics do not match the whole logs!")
+            sys.exit(1)
+        print(f"{'metrics':>8} {elapsed:>8.2f} {ref_elapsed / elapsed:>8.1f}")
+
+
+def make_synthetic_results(run: int, builds: int) -> "pd.DataFrame":
+    """
+    Make the results table of a run, where the flash use of one build in fifty
+    grows by 2% from the run before
+    """
+    import pandas as pd
+
+    return pd.DataFrame(
+        {
+            "compiler": ["platformio"] * builds,
+            "example": [f"ex{n % 30}" for n in range(builds)],
+            "board": [f"board{n // 30 % 40}" for n in range(builds)],
+            "flag_inline_defines": [f"MODEM_{n // 1200}" for n in range(builds)],
+            "success": [0 if n % 25 == 0 else 1 for n in range(builds)],
+            "ram_used": [1000 + n for n in range(builds)],
+            "ram_total": [8192] * builds,
+            "flash_used": [
+                int((20000 + n) * (1.02 ** run if n % 50 == 1 else 1))
+                for n in range(builds)
+            ],
+            "flash_total": [262144] * builds,
+            "build_seconds": [30.0 + n % 7 for n in range(builds)],
+        }
+    )
+
+
+def benchmark_history(runs: int, builds: int) -> None:
+    """Time adding the results of many runs to the build history, comparing the
+    last run with the ones before it, and querying an example and a board"""
+    import build_history
+
+    with tempfile.TemporaryDirectory() as tmp:
+        history = build_history.open_build_history(os.path.join(tmp, "history.sqlite"))
+        elapsed = 0.0
+        for run in range(runs):
+            df = make_synthetic_results(run, builds)
+            run_elapsed, run_id = time_call(
+                build_history.append_build_results, history, df, f"run-{run}"
+            )
+            elapsed += run_elapsed
+        rows = history.execute("SELECT COUNT(*) FROM builds").fetchone()[0]
+        print(f"{runs} runs of {builds} builds ({rows} rows)")
+        print(f"  add a run: {elapsed / runs * 1000:.0f} ms")
+        elapsed, regressions = time_call(
+            build_history.find_regressions, history, run_id
+        )
+        print(f"  find the regressions: {elapsed * 1000:.0f} ms ({len(regressions)})")
+        elapsed, series = time_call(build_history.query_build_history, history, "ex7")
+        print(f"  query an example: {elapsed * 1000:.0f} ms ({len(series)} rows)")
+        elapsed, series = time_call(
+            build_history.query_build_history, history, None, "board7"
+        )
+        print(f"  query a board: {elapsed * 1000:.0f} ms ({len(series)} rows)")
+        history.close()
+
+
+# %%
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    dedupe_parser = subparsers.add_parser(
+        "dedupe", help="time remove_nested_duplicates on synthetic matrices"
+    )
+    dedupe_parser.add_argument(
+        "--sizes",
+        help="comma-separated list of matrix sizes",
+        type=str,
+        default="10000,100000,1000000",
+    )
+    dedupe_parser.add_argument(
+        "--reference",
+        help="also time (and check against) the previous JSON normalization",
+        action="store_true",
+    )
+
+    packing_parser = subparsers.add_parser(
+        "packing",
+        help="simulate the workflow time of the packed jobs and the jobs per board",
+    )
+    packing_parser.add_argument(
+        "--runners",
+        help="comma-separated list of runner counts (and packed job counts)",
+        type=str,
+        default="10,20,40",
+    )
+    packing_parser.add_argument(
+        "--boards", help="boards per toolchain", type=int, default=40
+    )
+    packing_parser.add_argument(
+        "--examples", help="examples per board", type=int, default=15
+    )
+
+    jobs_parser = subparsers.add_parser(
+        "jobs",
+        help="time making the command blocks and measure the memory they take",
+    )
+    jobs_parser.add_argument(
+        "--sizes",
+        help="comma-separated list of matrix sizes",
+        type=str,
+        default="10000,100000",
+    )
+    jobs_parser.add_argument(
+        "--reference",
+        help="also time and measure the previous dictionary command blocks",
+        action="store_true",
+    )
+
+    logs_parser = subparsers.add_parser(
+        "logs",
+        help="time parsing the PlatformIO logs",
+    )
+    logs_parser.add_argument(
+        "--count",
+        help="number of logs",
+        type=int,
+        default=2000,
+    )
+    logs_parser.add_argument(
+        "--kilobytes",
+        help="size of each log, in kilobytes",
+        type=int,
+        default=200,
+    )
+    logs_parser.add_argument(
+        "--workers",
+        help="comma-separated list of numbers of worker processes",
+        type=str,
+        default="1,4",
+    )
+
+    history_parser = subparsers.add_parser(
+        "history",
+        help="time adding runs to the build history and querying it",
+    )
+    history_parser.add_argument(
+        "--runs", help="number of runs", type=int, default=100
+    )
+    history_parser.add_argument(
+        "--builds", help="builds in each run", type=int, default=3000
+    )
+
+    args = parser.parse_args()
+    if args.benchmark == "dedupe":
+        benchmark_dedupe([int(s) for s in args.sizes.split(",")], args.reference)
+    elif args.benchmark == "packing":
+        benchmark_packing(
+            [int(s) for s in args.runners.split(",")], args.boards, args.examples
+        )
+    elif args.benchmark == "jobs":
+        benchmark_jobs([int(s) for s in args.sizes.split(",")], args.reference)
+    elif args.benchmark == "logs":
+        benchmark_logs(
+            args.count, args.kilobytes, [int(w) for w in args.workers.split(",")]
+        )
+    elif args.benchmark == "history":
+        benchmark_history(args.runs, args.builds)
+
+# %%
+# cSpell:ignore dedupe makespan
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+"""
+On-disk download cache for the shared CI configuration files.
+
+The board maps, tool lists, Arduino CLI configuration and PlatformIO configuration
+are all fetched from the shared workflow repository. This cache keeps one copy of
+each downloaded file, stored under the SHA-256 of its content, and an index of the
+URLs that point to them. Within the TTL a cached file is used without touching the
+network; after it, the file is revalidated with a conditional request
+(If-None-Match/If-Modified-Since). If the network is unavailable, or in offline
+mode, the cached copy or the copy bundled next to these scripts is used instead.
+
+Cache layout:
+    <cache path>/index.json         - URL -> {sha256, etag, last_modified, fetched_at}
+    <cache path>/objects/<sha256>   - file contents
+"""
+
+# %%
+import os
+import sys
+import json
+import time
+import hashlib
+import tempfile
+from typing import Any, Dict
+
+import requests
+from build_config import print_verbose
+
+# %%
+# settings
+
+# Where the shared configuration files live
+BUILD_SCRIPTS_URL = (
+    "https://raw.githubusercontent.com/EnviroDIY/workflows/main/build_scripts/"
+)
+# Where the copies bundled with these scripts live
+BUNDLED_FILES_PATH = os.path.dirname(os.path.abspath(__file__))
+# Defaults used when the cache is not configured from the pipeline arguments
+DEFAULT_CACHE_PATH = os.path.join(
+    os.path.expanduser("~"), ".cache", "envirodiy_workflows", "downloads"
+)
+DEFAULT_CACHE_TTL = 3600
+
+
+# %%
+class DownloadCache:
+    """A content-addressed cache of downloaded files.
+
+    Args:
+        cache_path: Directory for the index and the cached file contents
+        ttl: Seconds a cached file is used before it is revalidated
+        offline: Never touch the network; use cached or bundled files only
+        bundled_path: Directory of bundled fallback copies, named like the URL
+        timeout: Timeout for each request, in seconds
+    """
+
+    def __init__(
+        self,
+        cache_path: str = DEFAULT_CACHE_PATH,
+        ttl: int = DEFAULT_CACHE_TTL,
+        offline: bool = False,
+        bundled_path: str = BUNDLED_FILES_PATH,
+        timeout: int = 30,
+    ):
+        self.cache_path = os.path.abspath(os.path.expanduser(cache_path))
+        self.objects_path = os.path.join(self.cache_path, "objects")
+        self.index_file = os.path.join(self.cache_path, "index.json")
+        self.ttl = int(ttl)
+        self.offline = offline
+        self.bundled_path = bundled_path
+        self.timeout = timeout
+        self._index: Dict[str, Dict[str, Any]] | None = None
+
+    # Index and object store
+
+    @property
+    def index(self) -> Dict[str, Dict[str, Any]]:
+        if self._index is None:
+            try:
+                with open(self.index_file, "r") as f:
+                    self._index = json.load(f)
+            except (OSError, json.JSONDecodeError):
+                self._index = {}
+        return self._index  # type: ignore
+
+    def _save_index(self) -> None:
+        os.makedirs(self.cache_path, exist_ok=True)
+        # write to a temporary file and swap it in, so a reader never sees half an index
+        fd, tmp_file = tempfile.mkstemp(dir=self.cache_path, suffix=".json")
+        with os.fdopen(fd, "w") as f:
+            json.dump(self.index, f, indent=2)
+        os.replace(tmp_file, self.index_file)
+
+    def _read_object(self, digest: str) -> bytes | None:
+        try:
+            with open(os.path.join(self.objects_path, digest), "rb") as f:
+                content = f.read()
+        except OSError:
+            return None
+        if hashlib.sha256(content).hexdigest() != digest:
+            print(f"::warning::Discarding corrupt cached download {digest}")
+            return None
+        return content
+
+    def _write_object(self, content: bytes) -> str:
+        digest = hashlib.sha256(content).hexdigest()
+        object_file = os.path.join(self.objects_path, digest)
+        if not os.path.isfile(object_file):
+            os.makedirs(self.objects_path, exist_ok=True)
+            fd, tmp_file = tempfile.mkstemp(dir=self.objects_path)
+            with os.fdopen(fd, "wb") as f:
+                f.write(content)
+            os.replace(tmp_file, object_file)
+        return digest
+
+    def _read_bundled(self, url: str) -> bytes | None:
+        if self.bundled_path is None:
+            return None
+        bundled_file = os.path.join(self.bundled_path, url.rsplit("/", 1)[-1])
+        if not os.path.isfile(bundled_file):
+            return None
+        with open(bundled_file, "rb") as f:
+            return f.read()
+
+    # Fetching
+
+    def fetch(self, url: str) -> bytes:
+        """Get the contents of a URL, from the cache if it is still valid"""
+        entry = self.index.get(url, {})
+        cached = self._read_object(entry["sha256"]) if entry else None
+
+        if cached is not None and time.time() - entry["fetched_at"] < self.ttl:
+            print_verbose(f"Using cached copy of {url}")
+            return cached
+        if self.offline:
+            return self._fallback(url, cached, "offline mode is enabled")
+
+        # only ask for the file if it changed since the cached copy was downloaded
+        headers = {}
+        if cached is not None and entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if cached is not None and entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        try:
+            response = requests.get(url, headers=headers, timeout=self.timeout)
+            if response.status_code == 304 and cached is not None:
+                print_verbose(f"Cached copy of {url} is unchanged")
+                entry["fetched_at"] = time.time()
+                self._save_index()
+                return cached
+            response.raise_for_status()
+        except requests.RequestException as e:
+            return self._fallback(url, cached, str(e))
+
+        print_verbose(f"Downloaded {url}")
+        self.index[url] = {
+            "sha256": self._write_object(response.content),
+            "etag": response.headers.get("ETag"),
+            "last_modified": response.headers.get("Last-Modified"),
+            "fetched_at": time.time(),
+        }
+        self._save_index()
+        return response.content
+
+    def _fallback(self, url: str, cached: bytes | None, reason: str) -> bytes:
+        if cached is not None:
+            print(f"::warning::Using a stale cached copy of {url} ({reason})")
+            return cached
+        bundled = self._read_bundled(url)
+        if bundled is not None:
+            print(f"::warning::Using the bundled copy of {url} ({reason})")
+            return bundled
+        print(f"::error::Unable to get {url} and there is no cached copy ({reason})")
+        sys.exit(1)
+
+    def fetch_json(self, url: str) -> Any:
+        """Get the contents of a URL and decode them as JSON"""
+        return json.loads(self.fetch(url))
+
+    def fetch_to_file(self, url: str, filepath: str) -> None:
+        """Get the contents of a URL and write them to a file"""
+        with open(filepath, "wb") as f:
+            f.write(self.fetch(url))
+
+
+# %%
+# Shared cache for the pipeline stages
+
+download_cache = DownloadCache()
+
+
+def configure_download_cache(args) -> DownloadCache:
+    """Configure the shared download cache from the pipeline arguments
+
+    This should be called by any stage that downloads files, after parsing its
+    arguments, so the cache respects the --download-cache-* and --offline options.
+    """
+    global download_cache
+    download_cache = DownloadCache(
+        cache_path=args.download_cache_path,
+        ttl=args.download_cache_ttl,
+        offline=args.offline in [True, "true"],
+    )
+    return download_cache
+
+
+def get_download_cache_path(*paths: str) -> str:
+    """Get a path in the shared download cache directory, ie, for other cached files"""
+    return os.path.join(download_cache.cache_path, *paths)
+
+
+def fetch_build_script_file(filename: str) -> bytes:
+    """Get one of the shared configuration files in build_scripts"""
+    return download_cache.fetch(BUILD_SCRIPTS_URL + filename)
+
+
+def fetch_build_script_json(filename: str) -> Any:
+    """Get one of the shared JSON configuration files in build_scripts"""
+    return download_cache.fetch_json(BUILD_SCRIPTS_URL + filename)
+
+
+def save_build_script_file(filename: str, filepath: str) -> None:
+    """Get one of the shared configuration files in build_scripts and save it"""
+    download_cache.fetch_to_file(BUILD_SCRIPTS_URL + filename, filepath)
+
+
+# %%
+# cSpell:ignore fdopen
@@ -6,10 +6,19 @@ This script is not intended to be run as a standalone script.
 
 # %%
 import os
+import sys
+import copy
 import json
-from typing import Dict
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator
 import configargparse
 
+try:
+    import resource
+except ImportError:  # Windows; the peak memory use is not recorded
+    resource = None
+
 # %%
 # settings
 
@@ -61,6 +70,26 @@ list_args = [
 unset_positive = ["all", "", ["all"], [""], []]
 # for values with a default of None or "", these are considered unset
 unset_negative = ["", None, [""], [None], []]
+# arguments that are JSON lists of matrix rules (dictionaries), and can be empty
+json_list_args = [
+    "matrix_exclusions",
+    "matrix_inclusions",
+]
+
+# Version of the layout of the config file, saved in the file as config_version.
+# Bump it whenever a stage would misread a config file written by an older version.
+CONFIG_VERSION = 1
+# The types of the values in the config file; other values can have any type
+config_schema = {
+    "config_version": int,
+    **{arg_name.replace("-", "_"): str for arg_name in path_args},
+    "config_file_name": str,
+    "config_file_path": str,
+    "matrix_file_path": str,
+    "board_index_file": str,
+    **{arg_name: list for arg_name in list_args + json_list_args},
+    "final_matrix": list,
+}
 
 # %%
 # verbose printing
@@ -93,6 +122,170 @@ def print_verbose(msg: str) -> None:
         print(f"::debug::{msg}")
 
 
+# %%
+# stage timing
+
+# Name of the trace of the stages in the artifact path. Each stage adds its spans to
+# it, so the whole pipeline can be opened in chrome://tracing or ui.perfetto.dev.
+TIMING_TRACE_FILE_NAME = "pipeline_trace.json"
+
+# The spans timed by the current stage (cleared by write_timing_report())
+timing_spans: list[dict] = []
+# The depth of the span being timed, 0 outside of any span
+timing_depth = 0
+
+
+def get_timing_sample() -> dict:
+    """Get the wall clock, CPU times, and peak memory use so far of this process"""
+    times = os.times()
+    if resource is None:
+        peak_rss_mb = None
+    else:
+        # ru_maxrss is in kilobytes, except on macOS where it is in bytes
+        peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (
+            1024 * 1024 if sys.platform == "darwin" else 1024
+        )
+    return {
+        "time": time.time(),
+        "perf_counter": time.perf_counter(),
+        "cpu": times.user + times.system,
+        "child_cpu": times.children_user + times.children_system,
+        "peak_rss_mb": peak_rss_mb,
+    }
+
+
+def get_timing_span(name: str, start: dict, end: dict, depth: int) -> dict:
+    """Make a span from the samples taken at its start and end"""
+    return {
+        "name": name,
+        "depth": depth,
+        "start": start["time"],
+        "seconds": end["perf_counter"] - start["perf_counter"],
+        "cpu_seconds": end["cpu"] - start["cpu"],
+        "child_cpu_seconds": end["child_cpu"] - start["child_cpu"],
+        "peak_rss_mb": end["peak_rss_mb"],
+    }
+
+
+# Taken when the first stage imports this module, and again after each stage's report
+stage_start = get_timing_sample()
+
+
+@contextmanager
+def timed_span(name: str) -> Iterator[None]:
+    """Time a phase of a stage
+
+    Records the wall time, the CPU time of this process and of its subprocesses, and
+    the peak memory use of this process so far at the end of the phase. The peak is a
+    high-water mark of the whole process, not of the phase: a phase only raises it if
+    it uses more memory than every phase before it. Spans can be nested.
+
+    Args:
+        name: The name of the phase, shown in the trace and the summary table
+    """
+    global timing_depth
+    start = get_timing_sample()
+    timing_depth += 1
+    try:
+        yield
+    finally:
+        timing_depth -= 1
+        timing_spans.append(
+            get_timing_span(name, start, get_timing_sample(), timing_depth + 1)
+        )
+
+
+def get_trace_events(stage_name: str, spans: list[dict]) -> list[dict]:
+    """Convert the spans of a stage to complete events of the Chrome trace format"""
+    return [
+        {
+            "name": span["name"],
+            "cat": stage_name,
+            "ph": "X",
+            "ts": round(span["start"] * 1e6),
+            "dur": round(span["seconds"] * 1e6),
+            "pid": os.getpid(),
+            "tid": 0,
+            "args": {
+                k: round(span[k], 3)
+                for k in ["cpu_seconds", "child_cpu_seconds", "peak_rss_mb"]
+                if span[k] is not None
+            },
+        }
+        for span in spans
+    ]
+
+
+def format_timing_table(stage_name: str, spans: list[dict]) -> str:
+    """Format the spans of a stage as a markdown table, nested spans indented"""
+
+    def format_value(value: float | None) -> str:
+        return "" if value is None else f"{value:.2f}"
+
+    lines = [
+        f"### Timing: {stage_name}",
+        "",
+        "| Phase | Wall (s) | CPU (s) | Subprocess CPU (s) | Peak RSS (MB) |",
+        "| :-- | --: | --: | --: | --: |",
+    ]
+    # the spans are recorded as they end, so sort them by their start to nest them
+    for span in sorted(spans, key=lambda span: (span["start"], span["depth"])):
+        name = "&nbsp;&nbsp;" * span["depth"] + span["name"]
+        if span["depth"] == 0:
+            name = f"**{name}**"
+        values = [
+            span[k]
+            for k in ["seconds", "cpu_seconds", "child_cpu_seconds", "peak_rss_mb"]
+        ]
+        lines.append(f"| {name} | {' | '.join(map(format_value, values))} |")
+    return "\n".join(lines) + "\n"
+
+
+def write_timing_report(stage_name: str, artifact_path: str) -> str | None:
+    """Save the spans of a stage to the trace and the step summary
+
+    The whole stage, from the start of the stage to now, is added as the outermost
+    span. The spans are added to the trace in the artifact path, and a table of them
+    is added to the GitHub step summary, or printed in verbose mode.
+
+    Args:
+        stage_name: The name of the stage
+        artifact_path: Directory of the trace; no trace is saved if it does not exist
+
+    Returns:
+        The path of the trace, or None if no trace was saved
+    """
+    global stage_start
+    spans = [get_timing_span(stage_name, stage_start, get_timing_sample(), 0)]
+    spans += timing_spans
+    timing_spans.clear()
+    stage_start = get_timing_sample()
+
+    trace_file = None
+    if os.path.isdir(artifact_path):
+        trace_file = os.path.join(artifact_path, TIMING_TRACE_FILE_NAME)
+        trace_events = []
+        if os.path.exists(trace_file):
+            try:
+                with open(trace_file, "r") as f:
+                    trace_events = json.load(f)["traceEvents"]
+            except (OSError, ValueError, KeyError, TypeError):
+                print(f"::warning::Could not read the trace {trace_file}, replacing it")
+        trace_events += get_trace_events(stage_name, spans)
+        with open(trace_file, "w") as f:
+            json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms"}, f)
+        print_verbose(f"Stage timing saved to: {trace_file}")
+
+    table = format_timing_table(stage_name, spans)
+    if "GITHUB_STEP_SUMMARY" in os.environ.keys():
+        with open(os.environ["GITHUB_STEP_SUMMARY"], "a") as fh:
+            print(table, file=fh)
+    else:
+        for line in table.splitlines():
+            print_verbose(line)
+    return trace_file
+
+
 # %%
 # Arg parsing and config file reading
 
@@ -128,16 +321,23 @@ class JsonConfigFileParser(configargparse.ConfigFileParser):
         return new_d
 
     def parse_file(self, filename, namespace=None):
-        d = {}
-        with open(filename, "r") as f:
-            d = self.clean_dict(json.load(f), True)
+        d = self.clean_dict(read_config_snapshot(filename), True)
         if namespace is None:
             return self.dict_to_namespace(d)
         else:
             for k, v in d.items():
                 if not hasattr(namespace, k):
                     setattr(namespace, k, v)
-                elif getattr(namespace, k) != v and k not in ["verbose", "cleanup"]:
+                elif getattr(namespace, k) != v and k not in [
+                    "verbose",
+                    "cleanup",
+                    "in_process",
+                    "offline",
+                    "run_jobs",
+                    "local_workers",
+                    "job_timeout",
+                    "toolchain_slots",
+                ]:
                     if k not in ["examples_to_build"]:
                         # ^^ we expect these to be changed by the parsing
                         print(
@@ -159,6 +359,50 @@ class JsonConfigFileParser(configargparse.ConfigFileParser):
             json.dump(self.clean_dict(items), f, indent=2)
 
 
+# %%
+# Config snapshot
+
+
+class ConfigError(ValueError):
+    """A config file that this version of the build scripts cannot use"""
+
+
+def check_config_value(key: str, value: Any, source: str) -> None:
+    """Check a value read from or written to the config file against the schema"""
+    expected = config_schema.get(key)
+    if expected is not None and value is not None and not isinstance(value, expected):
+        raise ConfigError(
+            f"'{key}' in {source} should be a {expected.__name__}, "
+            f"not a {type(value).__name__}"
+        )
+
+
+def read_config_snapshot(config_file: str) -> Dict[str, Any]:
+    """Read a config file, checking its version and the types of its values"""
+    with open(config_file, "r", encoding="utf-8") as f:
+        values = json.load(f)
+    version = values.get("config_version", CONFIG_VERSION)
+    if version > CONFIG_VERSION:
+        raise ConfigError(
+            f"{config_file} was written by a newer version of the build scripts (config version {version})"
+        )
+    for key, value in values.items():
+        check_config_value(key, value, config_file)
+    return values
+
+
+def write_config_snapshot(values: Dict[str, Any], config_file: str) -> None:
+    """Write a config file, checking the types of its values"""
+    for key, value in values.items():
+        check_config_value(key, value, config_file)
+    with open(config_file, "w", encoding="utf-8", newline="\n") as f:
+        json.dump(values, f, indent=2)
+
+
+# %%
+# Arg parsing
+
+
 def get_env_parser():
     parser = configargparse.ArgParser(
         add_env_var_help=True,
@@ -173,6 +417,35 @@ def get_env_parser():
         env_var="RUNNER_DEBUG",
     )
     parser.add_argument("--cleanup", help="perform cleanup", action="store_true")
+    parser.add_argument(
+        "--in-process",
+        help="run all pipeline stages in a single interpreter, sharing one configuration object",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--run-jobs",
+        help="run the generated build jobs on this machine after generating them",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--local-workers",
+        help="number of jobs to run at once with --run-jobs (0 for the number of CPUs)",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--job-timeout",
+        help="seconds before a job run with --run-jobs is stopped (0 for no timeout)",
+        type=int,
+        default=3600,
+    )
+    parser.add_argument(
+        "--toolchain-slots",
+        help="number of jobs run with --run-jobs that may use the same toolchain at once",
+        type=int,
+        default=1,
+    )
 
     parser.add_argument(
         "--workspace-path",
@@ -220,6 +493,32 @@ def get_env_parser():
         default="matrix_config.json",
     )
 
+    parser.add_argument(
+        "--download-cache-path",
+        help="directory for the cache of downloaded configuration files",
+        type=str,
+        default=os.path.join(
+            os.path.expanduser("~"), ".cache", "envirodiy_workflows", "downloads"
+        ),
+    )
+    parser.add_argument(
+        "--download-cache-ttl",
+        help="seconds to use a cached download before checking whether it has changed",
+        type=int,
+        default=3600,
+    )
+    parser.add_argument(
+        "--offline",
+        help="never download configuration files; use cached or bundled copies",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--install-jobs",
+        help="number of packages the installation scripts download at the same time; 1 to install them one after another",
+        type=int,
+        default=1,
+    )
+
     parser.add_argument(
         "--compiler-list",
         help="comma-separated list of compilers to use",
@@ -312,6 +611,33 @@ def get_env_parser():
         default="",
         dest="raw_compiler_flags",
     )
+    parser.add_argument(
+        "--matrix-exclusions",
+        help="JSON list of matrix rules to exclude from the build matrix."
+        "\nEach rule is a dictionary of matrix keys to a list of values; keys that are left out or set to '*' match anything."
+        '\nFor example: `[{"compiler": ["arduino-cli"], "example": ["examples/menu_a_la_carte"]}]`',
+        type=str,
+        default="",
+    )
+    parser.add_argument(
+        "--matrix-inclusions",
+        help="JSON list of matrix rules to include in the build matrix (all entries are included if empty)."
+        "\nThe rules use the same format as the matrix exclusions.",
+        type=str,
+        default="",
+    )
+    parser.add_argument(
+        "--diff-base",
+        help="git ref to compare against; if set, only the matrix entries affected by the changed files are built",
+        type=str,
+        default="",
+    )
+    parser.add_argument(
+        "--canary-count",
+        help="number of unaffected matrix entries to sample and build with --diff-base",
+        type=int,
+        default=2,
+    )
     parser.add_argument(
         "--log-grouping-fields",
         help="comma-separated list of fields to group logs by",
@@ -324,6 +650,23 @@ def get_env_parser():
         type=str,
         default="compiler,board",
     )
+    parser.add_argument(
+        "--job-count",
+        help="number of jobs to pack the log groups into by their expected build durations; 0 to make one job for each combination of the job grouping fields",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--build-durations-file",
+        help="file of the build durations recorded by earlier runs, used to pack the jobs",
+        type=str,
+        default=os.path.join(
+            os.path.expanduser("~"),
+            ".cache",
+            "envirodiy_workflows",
+            "build_durations.json",
+        ),
+    )
     return parser
 
 
@@ -498,6 +841,40 @@ def parse_list_from_args(arg_name: str, args) -> list | None:
     return parsed_list
 
 
+def parse_json_list_from_args(arg_name: str, args) -> list | None:
+    """Parse a JSON list (ie, of matrix rules) from an argument value"""
+    if arg_name not in json_list_args and arg_name.replace("-", "_") not in json_list_args:
+        print(f"::warning::{arg_name} is not a recognized JSON list argument.")
+        return
+    arg_value = getattr(args, arg_name.replace("-", "_"), None)
+
+    # if the value is empty, return an empty list
+    if arg_value is None or arg_value == "":
+        parsed_list = []
+    # if it's already a list (ie, read back from the config file), return it as is
+    elif isinstance(arg_value, list):
+        parsed_list = arg_value
+    else:
+        try:
+            parsed_list = json.loads(arg_value)
+        except json.JSONDecodeError as e:
+            print(f"::error::{arg_name} is not valid JSON: {e}")
+            exit(1)
+        # a single rule is accepted without the surrounding list
+        if isinstance(parsed_list, dict):
+            parsed_list = [parsed_list]
+        if not isinstance(parsed_list, list) or not all(
+            isinstance(rule, dict) for rule in parsed_list
+        ):
+            print(f"::error::{arg_name} must be a JSON list of dictionaries.")
+            exit(1)
+        print_verbose(f"Using {arg_name}: {len(parsed_list)} rules")
+
+    # update the args object with the parsed list
+    setattr(args, arg_name.replace("-", "_"), parsed_list)
+    return parsed_list
+
+
 def get_env_config():
     """Get the configuration from the command line arguments and environment variables OR from the supplied config file"""
 
@@ -521,6 +898,8 @@ def get_env_config():
     print_verbose("Parsing list arguments from the args object...")
     for list_arg in list_args:
         parse_list_from_args(list_arg, args)
+    for json_list_arg in json_list_args:
+        parse_json_list_from_args(json_list_arg, args)
 
     return args
 
@@ -537,15 +916,48 @@ def write_config_file(args) -> str:
     # (i.e., '-' replaced with '_') when writing the config file.
     file_parser = JsonConfigFileParser()
     print_verbose(f"Writing configuration to: {config_file}")
-    file_parser.write_file(args.__dict__, config_file)
+    values = file_parser.clean_dict(dict(vars(args), config_version=CONFIG_VERSION))
+    write_config_snapshot(values, config_file)
     return config_file
 
 
+# The parsed configurations, by their command line and environment
+extended_config_cache: Dict[tuple, tuple] = {}
+
+
+def get_config_file_id(args) -> list | None:
+    """Get the size and modification time of the config file, if there is one"""
+    try:
+        stat = os.stat(args.config_file_path)
+    except (AttributeError, OSError, TypeError):
+        return None
+    return [stat.st_size, stat.st_mtime_ns]
+
+
 def get_extended_config():
     """
     Get the configuration from the command line arguments and environment variables,
     and extend it with additional derived values saved in the config files.
+
+    The configuration is only parsed and validated once for the same command line,
+    environment, and config file; later calls get a copy of it.
     """
+    cache_key = (tuple(sys.argv), tuple(sorted(os.environ.items())))
+    if cache_key in extended_config_cache:
+        file_id, cached = extended_config_cache[cache_key]
+        if get_config_file_id(cached) == file_id:
+            print_verbose("Using the configuration that was already parsed")
+            return copy.deepcopy(cached)
+
+    ext_args = read_extended_config()
+    file_id = get_config_file_id(ext_args)
+    if file_id is not None:
+        extended_config_cache[cache_key] = (file_id, copy.deepcopy(ext_args))
+    return ext_args
+
+
+def read_extended_config():
+    """Parse the command line, environment, and config file"""
 
     print_verbose("Getting environment and command line config...")
     env_args = get_env_config()
@@ -583,10 +995,14 @@ if __name__ == "__main__":
     args = get_env_config()
 
     # Dump the parsed inputs to a JSON file in the artifact path for use in later steps of the CI pipeline
-    config_file = write_config_file(args)
+    try:
+        config_file = write_config_file(args)
+    except ConfigError as e:
+        print(f"::error::{e}")
+        sys.exit(1)
 
     print(f"\n✓ Parsed inputs saved to: {config_file}")
     print("✓ Workflow inputs parsed successfully")
 
 # %%
-# cSpell:ignore
+# cSpell:ignore maxrss nbsp
@@ -0,0 +1,348 @@
+#!/usr/bin/env python
+"""
+History of the build results across pipeline runs, and the regression report.
+
+parse_test_results.py appends the results table of every run to a SQLite database,
+which the workflow caches between runs like the build durations file. Each build
+(a compiler, example, board, and set of flags) has a time series of its success,
+RAM and flash use, and build time, with one row for every run that built it. Rows
+are only ever added; the oldest runs are dropped once there are more than
+HISTORY_RUNS_KEPT of them.
+
+After a run is added, it is compared with the runs before it:
+    - The RAM and flash use of each successful build are compared with the last
+      earlier run in which the same build succeeded.
+    - The build time of each timed build is compared with the average of its build
+      times in the last TIME_BASELINE_RUNS runs, since the build times vary from run
+      to run, unless that is less than MIN_BASELINE_SECONDS.
+Any growth beyond the thresholds (in percent) is listed in the regression report.
+
+The builds are indexed by their run, key, example, and board, so a run is compared
+with one index lookup for each build, and the history of an example or a board can
+be queried quickly with hundreds of thousands of rows:
+
+    python build_history.py --example logging_to_MMW --board mayfly
+"""
+
+# %%
+import os
+import sys
+import sqlite3
+import argparse
+from datetime import datetime, timezone
+
+import pandas as pd
+
+# %%
+# settings
+
+# Where the history of the build results is kept between runs
+DEFAULT_HISTORY_FILE = os.path.join(
+    os.path.expanduser("~"), ".cache", "envirodiy_workflows", "build_history.sqlite"
+)
+# Version of the layout of the history database
+HISTORY_VERSION = 1
+# Number of runs to keep in the history
+HISTORY_RUNS_KEPT = 200
+# Number of earlier runs whose build times the build time is compared with
+TIME_BASELINE_RUNS = 5
+# Build times are not compared for builds that took less than this many seconds
+MIN_BASELINE_SECONDS = 5.0
+# Growth, in percent, beyond which a build is listed in the regression report
+DEFAULT_FLASH_THRESHOLD = 1.0
+DEFAULT_RAM_THRESHOLD = 1.0
+DEFAULT_TIME_THRESHOLD = 50.0
+
+# The columns of the results table that are kept for each build
+HISTORY_COLUMNS = [
+    "compiler",
+    "example",
+    "board",
+    "flags",
+    "success",
+    "ram_used",
+    "ram_total",
+    "flash_used",
+    "flash_total",
+    "build_seconds",
+]
+
+HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id INTEGER PRIMARY KEY,
+    run_name TEXT NOT NULL UNIQUE,
+    recorded_at TEXT NOT NULL,
+    git_ref TEXT,
+    git_sha TEXT
+);
+CREATE TABLE IF NOT EXISTS builds (
+    run_id INTEGER NOT NULL REFERENCES runs (run_id),
+    build_key TEXT NOT NULL,
+    compiler TEXT,
+    example TEXT,
+    board TEXT,
+    flags TEXT,
+    success INTEGER,
+    ram_used INTEGER,
+    ram_total INTEGER,
+    flash_used INTEGER,
+    flash_total INTEGER,
+    build_seconds REAL
+);
+CREATE INDEX IF NOT EXISTS builds_by_run ON builds (run_id);
+CREATE INDEX IF NOT EXISTS builds_by_key ON builds (build_key, run_id);
+CREATE INDEX IF NOT EXISTS builds_by_example ON builds (example, run_id);
+CREATE INDEX IF NOT EXISTS builds_by_board ON builds (board, run_id);
+"""
+
+
+# %%
+# The history database
+
+
+def open_build_history(history_file: str) -> sqlite3.Connection:
+    """Open the history database, creating it if there is none"""
+    os.makedirs(os.path.dirname(os.path.abspath(history_file)), exist_ok=True)
+    connection = sqlite3.connect(history_file)
+    version = connection.execute("PRAGMA user_version").fetchone()[0]
+    if version not in [0, HISTORY_VERSION]:
+        connection.close()
+        raise RuntimeError(f"Unknown build history version {version} in {history_file}")
+    connection.executescript(HISTORY_SCHEMA)
+    connection.execute(f"PRAGMA user_version = {HISTORY_VERSION}")
+    return connection
+
+
+def get_run_name() -> str:
+    """Name the current run by its GitHub Actions run ID and attempt, or the time"""
+    if "GITHUB_RUN_ID" in os.environ.keys():
+        run_attempt = os.environ.get("GITHUB_RUN_ATTEMPT", "1")
+        return f"{os.environ['GITHUB_RUN_ID']}-{run_attempt}"
+    return "local-" + datetime.now(timezone.utc).strftime("%Y%m%dT%H%M%S.%fZ")
+
+
+def get_build_flags(df: pd.DataFrame) -> pd.Series:
+    """Join the flag columns of the results table into one name=value list per build"""
+    flags = pd.Series("", index=df.index, dtype=object)
+    for col in sorted(c for c in df.columns if c.startswith("flag_")):
+        values = df[col].astype(object)
+        present = values.notna() & (values.astype(str) != "")
+        flag = col.removeprefix("flag_") + "=" + values.astype(str)
+        flags = flags.where(~present, flags.where(flags == "", flags + "; ") + flag)
+    return flags
+
+
+def append_build_results(
+    connection: sqlite3.Connection,
+    df: pd.DataFrame,
+    run_name: str | None = None,
+    runs_kept: int = HISTORY_RUNS_KEPT,
+) -> int | None:
+    """
+    Add the results table of a run (see parse_test_results.summarize_log_results)
+    to the history, then drop the oldest runs beyond the number kept.
+
+    Returns:
+        int | None: The ID of the run in the history, or None if a run with the same
+        name is already there
+    """
+    run_name = run_name or get_run_name()
+    existing = connection.execute("SELECT 1 FROM runs WHERE run_name = ?", (run_name,))
+    if existing.fetchone() is not None:
+        print(f"::warning::Run {run_name} is already in the build history")
+        return None
+
+    builds = df.assign(flags=get_build_flags(df))
+    for col in HISTORY_COLUMNS:
+        if col not in builds.columns:
+            builds[col] = None
+    builds = builds[HISTORY_COLUMNS].astype(object)
+    builds = builds.where(builds.notna(), None)
+    build_keys = (
+        builds["compiler"].astype(str)
+        + "|"
+        + builds["example"].astype(str)
+        + "|"
+        + builds["board"].astype(str)
+        + "|"
+        + builds["flags"]
+    )
+
+    with connection:
+        run_id = connection.execute(
+            "INSERT INTO runs (run_name, recorded_at, git_ref, git_sha) "
+            "VALUES (?, ?, ?, ?)",
+            (
+                run_name,
+                datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                os.environ.get("GITHUB_REF_NAME"),
+                os.environ.get("GITHUB_SHA"),
+            ),
+        ).lastrowid
+        connection.executemany(
+            f"INSERT INTO builds (run_id, build_key, {', '.join(HISTORY_COLUMNS)}) "
+            f"VALUES (?, ?, {', '.join('?' * len(HISTORY_COLUMNS))})",
+            zip(
+                [run_id] * len(builds),
+                build_keys.tolist(),
+                *[builds[col].tolist() for col in HISTORY_COLUMNS],
+            ),
+        )
+        connection.execute(
+            "DELETE FROM builds WHERE run_id IN "
+            "(SELECT run_id FROM runs ORDER BY run_id DESC LIMIT -1 OFFSET ?)",
+            (runs_kept,),
+        )
+        connection.execute(
+            "DELETE FROM runs WHERE run_id IN "
+            "(SELECT run_id FROM runs ORDER BY run_id DESC LIMIT -1 OFFSET ?)",
+            (runs_kept,),
+        )
+    return run_id
+
+
+def query_build_history(
+    connection: sqlite3.Connection,
+    example: str | None = None,
+    board: str | None = None,
+) -> pd.DataFrame:
+    """Get the time series of the builds of an example, a board, or both"""
+    conditions = []
+    params = []
+    if example is not None:
+        conditions.append("builds.example = ?")
+        params.append(example)
+    if board is not None:
+        conditions.append("builds.board = ?")
+        params.append(board)
+    return pd.read_sql_query(
+        f"SELECT runs.run_name, runs.recorded_at, {', '.join(HISTORY_COLUMNS)} "
+        "FROM builds JOIN runs USING (run_id) "
+        + ("WHERE " + " AND ".join(conditions) + " " if len(conditions) > 0 else "")
+        + "ORDER BY builds.build_key, builds.run_id",
+        connection,
+        params=params,
+    )
+
+
+# %%
+# Regressions
+
+
+def find_regressions(
+    connection: sqlite3.Connection,
+    run_id: int,
+    flash_threshold: float = DEFAULT_FLASH_THRESHOLD,
+    ram_threshold: float = DEFAULT_RAM_THRESHOLD,
+    time_threshold: float = DEFAULT_TIME_THRESHOLD,
+) -> pd.DataFrame:
+    """
+    Compare the builds of a run with the runs before it.
+
+    Returns:
+        pd.DataFrame: A row for every growth beyond its threshold, with the build,
+        the metric (flash_used, ram_used, or build_seconds), its earlier and current
+        values, and the growth in percent, largest first
+    """
+    current = pd.read_sql_query(
+        "SELECT build_key, compiler, example, board, flags, success, ram_used, "
+        "flash_used, build_seconds FROM builds WHERE run_id = ?",
+        connection,
+        params=(run_id,),
+    )
+    # the sizes of the last earlier run in which each build succeeded, found by
+    # walking back through the history of the build from the current run
+    previous_sizes = pd.read_sql_query(
+        "SELECT current.build_key, previous.ram_used, previous.flash_used "
+        "FROM builds AS current JOIN builds AS previous ON previous.rowid = "
+        "(SELECT rowid FROM builds WHERE build_key = current.build_key "
+        "AND run_id < current.run_id AND success = 1 ORDER BY run_id DESC LIMIT 1) "
+        "WHERE current.run_id = ?",
+        connection,
+        params=(run_id,),
+    )
+    # the average build time of each build in the last few earlier runs
+    previous_times = pd.read_sql_query(
+        "SELECT build_key, AVG(build_seconds) AS build_seconds FROM builds "
+        "WHERE run_id IN "
+        "(SELECT run_id FROM runs WHERE run_id < ? ORDER BY run_id DESC LIMIT ?) "
+        "AND build_seconds IS NOT NULL GROUP BY build_key",
+        connection,
+        params=(run_id, TIME_BASELINE_RUNS),
+    )
+
+    regressions = []
+    for metric, previous, threshold in [
+        ("flash_used", previous_sizes, flash_threshold),
+        ("ram_used", previous_sizes, ram_threshold),
+        ("build_seconds", previous_times, time_threshold),
+    ]:
+        compared = current.merge(
+            previous[["build_key", metric]].drop_duplicates("build_key", keep="last"),
+            on="build_key",
+            suffixes=("", "_previous"),
+        )
+        if metric != "build_seconds":
+            compared = compared[compared["success"] == 1]
+        earlier = compared[f"{metric}_previous"].astype(float)
+        growth = (compared[metric].astype(float) - earlier) / earlier * 100
+        min_earlier = MIN_BASELINE_SECONDS if metric == "build_seconds" else 0
+        grown = compared[(earlier > min_earlier) & (growth > threshold)]
+        regressions.append(
+            pd.DataFrame(
+                {
+                    "compiler": grown["compiler"],
+                    "example": grown["example"],
+                    "board": grown["board"],
+                    "flags": grown["flags"],
+                    "metric": metric,
+                    "previous": earlier[grown.index],
+                    "current": grown[metric].astype(float),
+                    "growth_percent": growth[grown.index].round(1),
+                }
+            )
+        )
+    return pd.concat(regressions, ignore_index=True).sort_values(
+        by=["growth_percent"], ascending=False, ignore_index=True
+    )
+
+
+def format_regression_report(regressions: pd.DataFrame) -> str:
+    """Format the regressions as a markdown section for the step summary"""
+    report = "\n\n### Size and Build Time Regressions\n\n"
+    if len(regressions) == 0:
+        return report + "No builds grew beyond the thresholds since the earlier runs.\n"
+    return report + regressions.to_markdown(index=False, tablefmt="github") + "\n"
+
+
+# %%
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Print the history of the builds of an example or a board"
+    )
+    parser.add_argument(
+        "--history-file",
+        help="the build history database",
+        type=str,
+        default=os.environ.get("BUILD_HISTORY_FILE", DEFAULT_HISTORY_FILE),
+    )
+    parser.add_argument("--example", help="the example name", type=str)
+    parser.add_argument("--board", help="the board", type=str)
+    args = parser.parse_args(argv)
+
+    if not os.path.isfile(args.history_file):
+        print(f"::error::There is no build history in {args.history_file}")
+        return 1
+    connection = open_build_history(args.history_file)
+    history = query_build_history(connection, args.example, args.board)
+    connection.close()
+    print(history.to_markdown(index=False, tablefmt="github"))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+
+# %%
+# cSpell:ignore tablefmt
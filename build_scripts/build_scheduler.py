@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+"""
+Cost-aware packing of the build commands into jobs.
+
+By default, 4_build_jobs.py makes one job for each combination of the job grouping
+fields (ie, compiler and board), so some jobs build a handful of examples and others
+build dozens, and the slowest runner sets the time the whole workflow takes. When a
+job count is set, the log groups are instead packed into that many jobs so the
+expected durations of the jobs are as even as possible.
+
+The expected duration of each build comes from the previous runs: every job script
+writes the time each compile took to a sidecar file next to its log
+(<log name>.duration), parse_test_results.py folds those into a moving average
+saved in the build durations file, and the workflow caches that file between runs.
+Builds that have never been timed are expected to take the median time of the
+builds with the same toolchain.
+
+Packing rules:
+    - A log group is never split between jobs.
+    - A job only uses one toolchain (Arduino CLI or PlatformIO), because the jobs
+      for each toolchain run in a different workflow with their own installs.
+    - The log groups that share a job grouping key (ie, the same board) are kept in
+      one job unless they take longer than an even share of the total, so a job
+      needs as few board platforms as possible.
+"""
+
+# %%
+import os
+import json
+import math
+import heapq
+import tempfile
+from statistics import median
+from typing import Dict, Iterable, List
+from build_config import print_verbose
+
+# %%
+# settings
+
+# Where the moving averages of the build durations are kept between runs
+DEFAULT_DURATIONS_FILE = os.path.join(
+    os.path.expanduser("~"), ".cache", "envirodiy_workflows", "build_durations.json"
+)
+# Expected seconds for a build when nothing with its toolchain has been timed
+DEFAULT_BUILD_SECONDS = 60.0
+# Weight of the newest duration in the moving average
+DURATION_WEIGHT = 0.5
+# Seconds each job takes to check out, install the toolchain, and upload its logs
+JOB_SETUP_SECONDS = 180.0
+
+
+# %%
+# Build duration history
+
+
+def get_duration_file_for_log(log_file: str) -> str:
+    """Get the name of the sidecar file a job script writes a build duration to"""
+    return os.path.splitext(log_file)[0] + ".duration"
+
+
+def get_duration_key(log_file: str) -> str:
+    """Get the key for the durations of a build: the name of its log, without the extension"""
+    return os.path.splitext(os.path.basename(log_file))[0]
+
+
+def read_duration_file(duration_file: str) -> float | None:
+    """Read the seconds a build took from its sidecar file"""
+    try:
+        with open(duration_file, "r") as f:
+            return float(f.read().strip().replace(",", "."))
+    except (OSError, ValueError):
+        return None
+
+
+def load_build_durations(durations_file: str) -> Dict[str, dict]:
+    """Load the build durations: key -> {toolchain, seconds, samples}"""
+    try:
+        with open(durations_file, "r") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        print_verbose(f"No build durations in {durations_file}")
+        return {}
+
+
+def update_build_durations(
+    durations_file: str, new_durations: Iterable[tuple[str, str, float]]
+) -> Dict[str, dict]:
+    """
+    Fold new (key, toolchain, seconds) build durations into the durations file.
+
+    Each build keeps a moving average of its durations, so a single slow run does
+    not move it too far.
+    """
+    durations = load_build_durations(durations_file)
+    for key, toolchain, seconds in new_durations:
+        if key in durations:
+            previous = durations[key]
+            seconds = (
+                DURATION_WEIGHT * seconds + (1 - DURATION_WEIGHT) * previous["seconds"]
+            )
+            samples = previous["samples"] + 1
+        else:
+            samples = 1
+        durations[key] = {
+            "toolchain": toolchain,
+            "seconds": round(seconds, 3),
+            "samples": samples,
+        }
+    os.makedirs(os.path.dirname(os.path.abspath(durations_file)), exist_ok=True)
+    # write to a temporary file and swap it in, so a reader never sees half a file
+    fd, tmp_file = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(durations_file)), suffix=".json"
+    )
+    with os.fdopen(fd, "w") as f:
+        json.dump(durations, f, indent=2, sort_keys=True)
+    os.replace(tmp_file, durations_file)
+    return durations
+
+
+class BuildCostModel:
+    """Expected build durations from the recorded history"""
+
+    def __init__(self, durations: Dict[str, dict]):
+        self.durations = durations
+        by_toolchain: Dict[str, List[float]] = {}
+        for entry in durations.values():
+            by_toolchain.setdefault(entry["toolchain"], []).append(entry["seconds"])
+        self.toolchain_medians = {t: median(s) for t, s in by_toolchain.items()}
+        self.known = 0
+        self.unknown = 0
+
+    def estimate(self, key: str, toolchain: str) -> float:
+        """Get the expected seconds for a build"""
+        if key in self.durations:
+            self.known += 1
+            return self.durations[key]["seconds"]
+        self.unknown += 1
+        return self.toolchain_medians.get(toolchain, DEFAULT_BUILD_SECONDS)
+
+
+# %%
+# Packing
+
+
+def split_evenly(units: List[dict], parts: int) -> List[List[dict]]:
+    """Split units into parts with costs as even as possible (longest first)"""
+    bins: List[tuple[float, int, List[dict]]] = [(0.0, n, []) for n in range(parts)]
+    for unit in sorted(units, key=lambda u: (-u["cost"], u["index"])):
+        cost, n, members = heapq.heappop(bins)
+        members.append(unit)
+        heapq.heappush(bins, (cost + unit["cost"], n, members))
+    return [members for _, _, members in sorted(bins, key=lambda b: b[1]) if members]
+
+
+def pack_jobs(units: List[dict], job_count: int) -> List[List[dict]]:
+    """
+    Pack units into at most job_count jobs, minimizing the longest job.
+
+    Each unit is a dictionary with a "cost" (expected seconds), a "toolchain", and an
+    "affinity" key for the units that should stay together if they can. Every
+    toolchain gets at least one job, even if that is more than job_count.
+
+    The affinity groups that take longer than an even share of the total are split
+    evenly, then the pieces are placed longest first onto the least loaded job with
+    the same toolchain, or onto a new job while there are jobs left. Returns the jobs,
+    each with its units in their original order.
+    """
+    units = [dict(unit, index=n) for n, unit in enumerate(units)]
+    toolchains = list(dict.fromkeys(unit["toolchain"] for unit in units))
+    job_count = max(job_count, len(toolchains))
+    total_cost = sum(unit["cost"] for unit in units)
+    share = max(total_cost / job_count, max((u["cost"] for u in units), default=0))
+
+    affinity_groups: Dict[tuple[str, str], List[dict]] = {}
+    for unit in units:
+        affinity_groups.setdefault((unit["toolchain"], unit["affinity"]), []).append(
+            unit
+        )
+    pieces: List[List[dict]] = []
+    for group in affinity_groups.values():
+        group_cost = sum(unit["cost"] for unit in group)
+        if group_cost > share and share > 0:
+            pieces.extend(split_evenly(group, math.ceil(group_cost / share)))
+        else:
+            pieces.append(group)
+    pieces.sort(key=lambda p: (-sum(u["cost"] for u in p), p[0]["index"]))
+
+    jobs: List[dict] = []  # {"toolchain", "cost", "units"}
+    without_job = set(toolchains)
+    for piece in pieces:
+        toolchain = piece[0]["toolchain"]
+        cost = sum(unit["cost"] for unit in piece)
+        candidates = [job for job in jobs if job["toolchain"] == toolchain]
+        # keep a job free for every toolchain that does not have one yet
+        free_jobs = job_count - len(jobs)
+        reserved = len(without_job - {toolchain})
+        if free_jobs > reserved:
+            candidates.append({"toolchain": toolchain, "cost": 0.0, "units": []})
+        job = min(candidates, key=lambda j: j["cost"])
+        if len(job["units"]) == 0:
+            jobs.append(job)
+            without_job.discard(toolchain)
+        job["cost"] += cost
+        job["units"].extend(piece)
+
+    return [sorted(job["units"], key=lambda u: u["index"]) for job in jobs]
+
+
+def simulate_makespan(
+    job_costs: Iterable[float], runners: int, setup_seconds: float = JOB_SETUP_SECONDS
+) -> float:
+    """
+    Simulate running jobs in order on a limited number of runners, each job starting
+    on the first runner to come free, and return when the last job finishes.
+    """
+    free_at = [0.0] * max(1, runners)
+    for cost in job_costs:
+        start = heapq.heappop(free_at)
+        heapq.heappush(free_at, start + setup_seconds + cost)
+    return max(free_at)
+
+
+# %%
+# cSpell:ignore fdopen makespan
@@ -7,14 +7,26 @@ Provides:
 - Workspace and CI directory setup
 - JSON file utilities
 - Filename slug generation
-- Matrix utilities (dict_product, deduplication)
+- Matrix utilities (dict_product, deduplication, inclusion/exclusion rules, grouping)
+- The matrix store, a newline-delimited file of the final matrix entries
+- Pipeline stage loading for in-process runs
+- The board name index, for resolving board names, environments and FQBNs
+- The example index, for finding the example sketches and their files
+- The log manifest, the list of the logs the build jobs write
+- The build metrics, the results each build job records for every build
 """
 
 # %%
 import os
+import sys
 import json
+import heapq
+import tempfile
+import importlib.util
+from array import array
 from itertools import product
-from typing import List, Dict, Any
+from types import ModuleType
+from typing import List, Dict, Any, Callable, Hashable, Iterable, Iterator
 
 # %%
 # Utilities for matrix generation and deduplication
@@ -44,57 +56,314 @@ def remove_nested_duplicates(list_with_dups):
 
     For dictionaries, the 'job_group' key is ignored when comparing.
     """
-    # Fields where list ordering indicates command order and must be preserved
-    COMMAND_ORDERED_FIELDS = {"inline_defines", "compiler_flags"}
+    return list(iter_nested_unique(list_with_dups))
 
-    def normalize(value, ignore_job_group=False, parent_key=None):
-        """Recursively normalize a value for order-independent comparison.
 
-        Args:
-            value: The value to normalize
-            ignore_job_group: Whether to ignore the 'job_group' key
-            parent_key: The parent dictionary key containing this value
-        """
+def iter_nested_unique(items_with_dups: Iterable) -> Iterator:
+    """Yield the first occurrence of each item, lazily.
+
+    This is the streaming form of remove_nested_duplicates(), with the same
+    comparison rules. The items themselves are not kept, but the canonical key of
+    every unique item is, so the memory used grows with the number of unique items
+    until the generator is exhausted.
+    """
+    hasher = CanonicalHasher()
+    seen = set()
+
+    for item in items_with_dups:
+
+        # Only ignore job_group when the item itself is a dictionary.
+        item_key = hasher.canonical_key(item, ignore_job_group=isinstance(item, dict))
+
+        if item_key not in seen:
+            seen.add(item_key)
+            yield item
+
+
+# Fields where list ordering indicates command order and must be preserved
+COMMAND_ORDERED_FIELDS = {"inline_defines", "compiler_flags"}
+
+
+class CanonicalHasher:
+    """Structural hashing of nested dictionaries and lists, for de-duplication.
+
+    Values are converted to a canonical key made of nested tuples, which is hashable
+    and compares equal for two values exactly when they would be equal after
+    normalizing them: dictionaries are compared regardless of key ordering and lists
+    are compared regardless of item ordering, except for lists under
+    COMMAND_ORDERED_FIELDS (and lists nested in them) which keep their order.
+    Tuples always keep their order. Scalars other than strings are keyed by their JSON
+    text, so True, 1 and 1.0 stay distinct.
+
+    Each dictionary or list is visited once and built from the keys of its children,
+    so a value is keyed in one pass over it. Keys of nested containers are
+    memoized by identity, which makes containers that are shared between matrix
+    entries (ie, the inline define and compiler flag lists from dict_product) free
+    after the first time. The memo keeps a reference to each container so an id can't
+    be reused, and it is cleared when it reaches memo_size entries.
+    """
+
+    def __init__(self, memo_size: int = 4096):
+        self._memo: Dict[tuple, tuple] = {}
+        self._memo_size = memo_size
+
+    def canonical_key(self, value, ignore_job_group: bool = False):
+        """Get the canonical (hashable) key of a value"""
+        return self._canonical(value, False, ignore_job_group)
+
+    def digest(self, value, ignore_job_group: bool = False) -> int:
+        """Get the structural hash of a value"""
+        return hash(self._canonical(value, False, ignore_job_group))
+
+    def _canonical(self, value, ordered: bool, ignore_job_group: bool = False):
+        if type(value) is str:
+            return value
+        if not isinstance(value, (dict, list, tuple)):
+            return ("j", json.dumps(value))
+
+        memo_key = (id(value), ordered, ignore_job_group)
+        memo_hit = self._memo.get(memo_key)
+        if memo_hit is not None and memo_hit[0] is value:
+            return memo_hit[1]
 
         if isinstance(value, dict):
-            return {
-                k: normalize(v, parent_key=k)
+            pairs = [
+                (k, v if type(v) is str else self._canonical(v, k in COMMAND_ORDERED_FIELDS))
                 for k, v in value.items()
                 if not (ignore_job_group and k == "job_group")
-            }
-
-        if isinstance(value, list):
-            normalized_items = [
-                normalize(item, parent_key=parent_key) for item in value
             ]
-
-            # Preserve order for command-ordered fields; sort order-independent lists
-            if parent_key in COMMAND_ORDERED_FIELDS:
-                return normalized_items
+            # The keys are unique, so sorting the pairs never compares the values
+            if all(type(k) is str for k, _ in pairs):
+                pairs.sort()
             else:
-                # Sort recursively normalized list items so list ordering
-                # does not affect comparison for truly order-independent lists.
-                return sorted(
-                    normalized_items, key=lambda x: json.dumps(x, sort_keys=True)
-                )
+                pairs.sort(key=_first_item)
+            canonical = ("D",) + tuple(pairs)
+        else:
+            items = [
+                item if type(item) is str else self._canonical(item, ordered)
+                for item in value
+            ]
+            # Sort the items so list ordering does not affect comparison for truly
+            # order-independent lists. Lists of strings sort directly, anything else
+            # sorts by the text of the canonical key, which is always comparable.
+            if not ordered and not isinstance(value, tuple):
+                if all(type(item) is str for item in items):
+                    items.sort()
+                else:
+                    items.sort(key=repr)
+            canonical = ("L",) + tuple(items)
+
+        if len(self._memo) >= self._memo_size:
+            self._memo.clear()
+        self._memo[memo_key] = (value, canonical)
+        return canonical
+
+
+def _first_item(pair: tuple):
+    return str(pair[0])
+
+
+def external_sort(
+    items: Iterable[Dict[str, Any]],
+    key: Callable[[Dict[str, Any]], Any],
+    chunk_size: int = 50000,
+) -> Iterator[Dict[str, Any]]:
+    """Sort JSON-serializable items with bounded memory, yielding them in order.
+
+    Items are read in chunks of at most chunk_size. If everything fits in one chunk
+    it is sorted in memory. Otherwise each chunk is sorted and spilled to a temporary
+    JSON-lines file and the files are merged lazily. The sort is stable.
+    """
+    items = iter(items)
+    chunk = [item for _, item in zip(range(chunk_size), items)]
+    if len(chunk) < chunk_size:
+        yield from sorted(chunk, key=key)
+        return
+
+    with tempfile.TemporaryDirectory(prefix="matrix_sort_") as tmp_dir:
+        chunk_files = []
+        while len(chunk) > 0:
+            chunk_file = os.path.join(tmp_dir, f"chunk_{len(chunk_files)}.jsonl")
+            with open(chunk_file, "w") as f:
+                for item in sorted(chunk, key=key):
+                    f.write(json.dumps(item) + "\n")
+            chunk_files.append(chunk_file)
+            chunk = [item for _, item in zip(range(chunk_size), items)]
+
+        def read_chunk(chunk_file: str) -> Iterator[Dict[str, Any]]:
+            with open(chunk_file, "r") as f:
+                for line in f:
+                    yield json.loads(line)
+
+        yield from heapq.merge(*[read_chunk(f) for f in chunk_files], key=key)
+
+
+# Rule values that match any value of a matrix key
+MATRIX_WILDCARDS = ["*", ["*"]]
+
+
+def freeze_matrix_value(value):
+    """Convert a matrix value into a hashable canonical key.
 
+    Lists keep their order, because the order of inline defines and compiler flags is
+    the order of the commands. Dictionaries are compared regardless of key ordering.
+    """
+    if isinstance(value, str):
         return value
+    if isinstance(value, dict):
+        return tuple(sorted((k, freeze_matrix_value(v)) for k, v in value.items()))
+    if isinstance(value, (list, tuple)):
+        return tuple([freeze_matrix_value(v) for v in value])
+    return value
 
-    seen = set()
-    deduped_list = []
 
-    for item in list_with_dups:
+class MatrixRuleIndex:
+    """Hash index of matrix inclusion or exclusion rules.
 
-        # Only ignore job_group when the item itself is a dictionary.
-        normalized_item = normalize(item, ignore_job_group=isinstance(item, dict))
+    Each rule is a dictionary of matrix keys to a list of values, like the input to
+    dict_product. A rule matches a matrix entry if the entry has every key in the rule
+    and the entry's value for each key is one of the rule's values. Keys that are
+    left out of a rule or set to '*' match anything, so a rule can match many entries.
+
+    Rules are expanded once and stored as sets keyed by the (sorted) keys they check,
+    so matching an entry costs one set lookup per distinct set of rule keys instead of
+    one comparison per rule.
+    """
+
+    def __init__(self, rules: List[Dict[str, Any]] | None = None):
+        self._index: Dict[tuple, set] = {}
+        for rule in rules or []:
+            self.add_rule(rule)
+
+    def add_rule(self, rule: Dict[str, Any]) -> None:
+        """Expand a rule and add every combination of its values to the index"""
+        options = {
+            k: v if isinstance(v, list) else [v]
+            for k, v in rule.items()
+            if v not in MATRIX_WILDCARDS
+        }
+        rule_keys = tuple(sorted(options.keys()))
+        rule_values = self._index.setdefault(rule_keys, set())
+        for combination in product(*[options[k] for k in rule_keys]):
+            rule_values.add(tuple(freeze_matrix_value(v) for v in combination))
+
+    def __len__(self) -> int:
+        """The number of expanded rule combinations"""
+        return sum(len(values) for values in self._index.values())
+
+    def matches(self, entry: Dict[str, Any]) -> bool:
+        """Check if any rule matches the matrix entry"""
+        for rule_keys, rule_values in self._index.items():
+            try:
+                entry_values = tuple([freeze_matrix_value(entry[k]) for k in rule_keys])
+            except KeyError:
+                # the entry doesn't have all of the keys checked by these rules
+                continue
+            if entry_values in rule_values:
+                return True
+        return False
+
+
+def group_by_levels(
+    items: Iterable, key_functions: List[Callable[[Any], Hashable]]
+) -> Dict[tuple, list]:
+    """Group items by several levels of keys in one pass.
+
+    Each key function gives the key of an item's group at one level, from the
+    coarsest level (ie, the job) to the finest (ie, the log group). Every key is
+    computed once per item, so grouping takes time linear in the number of items.
+
+    Returns:
+        dict: The items in each group at the finest level, by the tuple of the
+        group's keys at every level. The groups are in the order their first items
+        were seen and the items keep their order, so the coarser groups can be read
+        off in a stable order by their leading keys.
+    """
+    grouped: Dict[tuple, list] = {}
+    for item in items:
+        path = tuple([key_function(item) for key_function in key_functions])
+        group = grouped.get(path)
+        if group is None:
+            grouped[path] = [item]
+        else:
+            group.append(item)
+    return grouped
+
+
+# %%
+# The matrix store, which keeps the final matrix out of the config file
+
+# The file with the final matrix, in the artifact path
+MATRIX_FILE_NAME = "build_matrix.jsonl"
 
-        json_str = json.dumps(normalized_item, sort_keys=True)
 
-        if json_str not in seen:
-            seen.add(json_str)
-            deduped_list.append(item)
+def get_matrix_offsets_file(matrix_file: str) -> str:
+    """Get the file with the byte offset of each entry in a matrix file"""
+    return os.path.splitext(matrix_file)[0] + ".offsets"
 
-    return deduped_list
+
+def write_matrix_store(entries: Iterable[Dict[str, Any]], matrix_file: str) -> int:
+    """Write matrix entries to a matrix file, one compact JSON object per line.
+
+    The entries are written as they are read, so a generator of entries is never held
+    in memory. The byte offset of each entry is written to a separate file so a reader
+    can find any entry without reading the ones before it.
+
+    Returns:
+        int: The number of entries written
+    """
+    offsets = array("Q")
+    with open(matrix_file, "wb") as f:
+        for entry in entries:
+            offsets.append(f.tell())
+            f.write(json.dumps(entry, separators=(",", ":")).encode("ascii") + b"\n")
+    with open(get_matrix_offsets_file(matrix_file), "wb") as f:
+        offsets.tofile(f)
+    return len(offsets)
+
+
+class MatrixStore:
+    """The final matrix, read from a matrix file written by write_matrix_store().
+
+    Iterating over the store streams the entries from the file one line at a time.
+    Indexing it reads only the one entry, using the offsets file if there is one.
+    """
+
+    def __init__(self, matrix_file: str):
+        self.matrix_file = matrix_file
+        self._offsets: array | None = None
+
+    @property
+    def offsets(self) -> array:
+        """The byte offset of each entry, read from the offsets file or the matrix file"""
+        if self._offsets is None:
+            offsets = array("Q")
+            offsets_file = get_matrix_offsets_file(self.matrix_file)
+            if os.path.exists(offsets_file):
+                with open(offsets_file, "rb") as f:
+                    offsets.frombytes(f.read())
+            else:
+                offset = 0
+                with open(self.matrix_file, "rb") as f:
+                    for line in f:
+                        offsets.append(offset)
+                        offset += len(line)
+            self._offsets = offsets
+        return self._offsets
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        with open(self.matrix_file, "rb") as f:
+            for line in f:
+                yield json.loads(line)
+
+    def __getitem__(self, n: int) -> Dict[str, Any]:
+        offset = self.offsets[n]
+        with open(self.matrix_file, "rb") as f:
+            f.seek(offset)
+            return json.loads(f.readline())
 
 
 # %%
@@ -140,9 +409,9 @@ def get_filename_slug(job_key, value) -> str:
             return replace_all(value)
     elif (
         job_key in ["inline_defines", "compiler_flags"]
-        and isinstance(value, list)
+        and isinstance(value, (list, tuple))
         and len(value) > 0
-        and isinstance(value[0], list)
+        and isinstance(value[0], (list, tuple))
     ):
         return "-".join(
             [
@@ -152,7 +421,9 @@ def get_filename_slug(job_key, value) -> str:
                 ]
             ]
         )
-    elif job_key in ["inline_defines", "compiler_flags"] and isinstance(value, list):
+    elif job_key in ["inline_defines", "compiler_flags"] and isinstance(
+        value, (list, tuple)
+    ):
         return "-".join([replace_all(f) for f in value])
     elif job_key in ["inline_defines", "compiler_flags"] and isinstance(value, str):
         return replace_all(value)
@@ -162,5 +433,381 @@ def get_filename_slug(job_key, value) -> str:
         return replace_all(str(value))
 
 
+# %%
+# The log manifest, which lists the log every build writes
+
+# The file with the log manifest, in the artifact path
+LOG_MANIFEST_FILE_NAME = "log_manifest.json"
+# Version of the layout of the log manifest
+LOG_MANIFEST_VERSION = 1
+
+
+def write_log_manifest(entries: List[dict], manifest_file: str) -> None:
+    """Save the log manifest: a {log_file, toolchain, log_group} entry for each build"""
+    save_json_file(
+        manifest_file, {"manifest_version": LOG_MANIFEST_VERSION, "logs": entries}
+    )
+
+
+def read_log_manifest(manifest_file: str) -> List[dict] | None:
+    """Read the entries of a log manifest, or None if there is no usable manifest"""
+    try:
+        manifest = load_json_file(manifest_file)
+    except (OSError, json.JSONDecodeError):
+        return None
+    if manifest.get("manifest_version") != LOG_MANIFEST_VERSION:
+        print(f"::warning::Unknown log manifest version in {manifest_file}")
+        return None
+    return manifest["logs"]
+
+
+# %%
+# The build metrics, which the job scripts record for every build they run
+
+# The end of the name of the metrics file of each job, which is named by its job tag
+BUILD_METRICS_FILE_SUFFIX = ".metrics.jsonl"
+
+
+def read_build_metrics(metrics_files: List[str]) -> Dict[str, dict]:
+    """
+    Read the metrics of the builds from the JSON lines metrics files of the jobs.
+
+    Each line is the metrics of one build: its log file, log group, toolchain and
+    matrix item, written when the job script is made, and its exit code, seconds,
+    whether its output was reused from the compile cache, its RAM and flash use (if
+    the compiler printed them) and the toolchain version, written when it is built.
+
+    Returns:
+        dict: The metrics of each build, by the name of its log file. If a build
+        was run more than once, the metrics of its last run are used.
+    """
+    build_metrics: Dict[str, dict] = {}
+    for metrics_file in metrics_files:
+        try:
+            with open(metrics_file, "r") as f:
+                for line in f:
+                    try:
+                        metrics = json.loads(line)
+                    except json.JSONDecodeError:
+                        # the last line is cut short if the job was stopped
+                        continue
+                    if isinstance(metrics, dict) and "log_file" in metrics:
+                        build_metrics[metrics["log_file"]] = metrics
+        except OSError:
+            continue
+    return build_metrics
+
+
+# %%
+# Utilities for running the numbered pipeline stages in a single interpreter
+def load_pipeline_stage(script_path: str) -> ModuleType:
+    """Import a numbered pipeline stage script (ie, 3_build_matrix.py) as a module.
+
+    The stage file names start with a digit, so they cannot be imported with a normal
+    import statement. Loaded stages are cached in sys.modules so each is only
+    imported once per interpreter.
+    """
+    module_name = "ci_stage_" + os.path.splitext(os.path.basename(script_path))[0]
+    if module_name in sys.modules:
+        return sys.modules[module_name]
+
+    spec = importlib.util.spec_from_file_location(module_name, script_path)
+    if spec is None or spec.loader is None:
+        raise ImportError(f"Could not load pipeline stage from {script_path}")
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[module_name] = module
+    try:
+        spec.loader.exec_module(module)
+    except BaseException:
+        del sys.modules[module_name]
+        raise
+    return module
+
+
+def run_pipeline_stage(script_path: str, args) -> int:
+    """Run the main() function of a pipeline stage with an already parsed config.
+
+    Stages signal failure by calling exit(), so SystemExit is converted back into a
+    return code instead of stopping the calling interpreter.
+    """
+    module = load_pipeline_stage(script_path)
+    if not hasattr(module, "main"):
+        raise AttributeError(f"Pipeline stage {script_path} does not define main()")
+    try:
+        return_code = module.main(args)
+    except SystemExit as e:
+        if e.code is None:
+            return 0
+        return e.code if isinstance(e.code, int) else 1
+    return 0 if return_code is None else return_code
+
+
+# %%
+# Resolving board names, PlatformIO environments and Arduino FQBNs
+
+# The file with the board name index, in the artifact path
+BOARD_INDEX_FILE_NAME = "board_index.json"
+# Version of the layout of the board index file
+BOARD_INDEX_VERSION = 1
+
+
+def index_board_mappings(
+    primary_dict: Dict[str, str], secondary_dict: Dict[str, str | List[str]]
+) -> Dict[str, List[list]]:
+    """Index the names in a pair of board mapping dictionaries by their lower case.
+
+    Each name gets the list of its matches, as [key, value, matched a value], in the
+    order they are checked: the keys of the primary dictionary, then its values, then
+    the keys and values of the secondary dictionary. A value that is a list is
+    matched by each of its items, and the matched item is its value.
+    """
+    index: Dict[str, List[list]] = {}
+    for match_dict in [primary_dict, secondary_dict]:
+        for k, v in match_dict.items():
+            index.setdefault(k.lower(), []).append([k, v, False])
+        for k, v in match_dict.items():
+            for item in v if isinstance(v, list) else [v]:
+                index.setdefault(item.lower(), []).append([k, item, True])
+    return index
+
+
+class BoardIndex:
+    """Index of the known board names, PlatformIO environments, and Arduino FQBNs.
+
+    Any name (a PlatformIO board, a PlatformIO environment, an FQBN, or an FQBN's
+    board name without its core) is looked up once in a dictionary, instead of
+    scanning every mapping for each board. A name matches what the first of its
+    matches gives, so the results are the same as scanning the mappings in order.
+    Names with more than one different match are ambiguous.
+
+    The index is saved to board_index.json in the artifact path, so later stages
+    and custom matrix builders can resolve boards without the mappings.
+    """
+
+    # The kinds of names that boards can be resolved to
+    TARGETS = ["pio_env", "fqbn"]
+
+    def __init__(self, indexes: Dict[str, Dict[str, List[list]]] | None = None):
+        self.indexes: Dict[str, Dict[str, List[list]]] = indexes or {
+            target: {} for target in self.TARGETS
+        }
+
+    def get_matches(self, target: str, name: str) -> List[list]:
+        """Get the matches of a name, as [key, value, matched a value], first match first"""
+        return self.indexes[target].get(name.lower(), [])
+
+    def get_results(self, target: str, name: str, return_type: str) -> list:
+        """Get the different keys or values a name matches, the one that is used first"""
+        results: list = []
+        for k, v, _ in self.get_matches(target, name):
+            result = k if return_type.lower() == "keys" else v
+            if result not in results:
+                results.append(result)
+        return results
+
+    def match(
+        self, target: str, name: str, return_type: str
+    ) -> str | List[str] | None:
+        """
+        Match a name with the mappings of a target (pio_env or fqbn), and return the
+        key or the value of its first match, or None. The value may be a list.
+        """
+        matches = self.get_matches(target, name)
+        if len(matches) == 0:
+            return None
+        k, v, _ = matches[0]
+        return k if return_type.lower() == "keys" else v
+
+    def get_ambiguous_names(self, target: str, return_type: str) -> Dict[str, list]:
+        """Get the names that could match more than one different result"""
+        ambiguous = {}
+        for name in self.indexes[target]:
+            results = self.get_results(target, name, return_type)
+            if len(results) > 1:
+                ambiguous[name] = results
+        return ambiguous
+
+    def resolve(self, board: str) -> Dict[str, str | List[str] | None]:
+        """Get the PlatformIO environment(s) and the Arduino FQBN(s) for a board name"""
+        return {
+            "pio_env": self.match("pio_env", board, "keys"),
+            "fqbn": self.match("fqbn", board, "values"),
+        }
+
+    def save(self, index_file: str) -> None:
+        """Save the index to a file"""
+        save_json_file(
+            index_file, {"index_version": BOARD_INDEX_VERSION, **self.indexes}
+        )
+
+    @classmethod
+    def load(cls, index_file: str) -> "BoardIndex":
+        """Load an index saved by save()"""
+        saved = load_json_file(index_file)
+        if saved.get("index_version") != BOARD_INDEX_VERSION:
+            raise ValueError(f"Unknown board index version in {index_file}")
+        return cls({target: saved[target] for target in cls.TARGETS})
+
+
+# %%
+# Finding the example sketches
+
+# Folders that are never searched for examples
+EXCLUDED_EXAMPLE_FOLDERS = [".history", "archive", "logger_test", "tests"]
+# Version of the layout of the example index file
+EXAMPLE_INDEX_VERSION = 1
+
+
+def get_directory_mtime(directory: str) -> int:
+    """Get the modification time of a directory in nanoseconds, or -1 if it is missing"""
+    try:
+        return os.stat(directory).st_mtime_ns
+    except OSError:
+        return -1
+
+
+def scan_sketch_folders(
+    search_paths: List[str], excluded_folders: List[str]
+) -> tuple[List[dict], Dict[str, int]]:
+    """Find every folder with an .ino file in one pass over each search path.
+
+    The folders are listed with os.scandir, in the same order as os.walk, and the
+    excluded folders are pruned without being listed. Symbolic links to folders are
+    not followed.
+
+    Returns:
+        tuple: The folders with .ino files, as {path, sketches, files}, where files
+        are the names of every file in the folder, and the modification time of
+        each folder that was listed, by its path.
+    """
+    sketch_folders: List[dict] = []
+    directory_mtimes: Dict[str, int] = {}
+    for search_path in search_paths:
+        to_scan = [search_path]
+        while len(to_scan) > 0:
+            directory = to_scan.pop()
+            directory_mtimes[directory] = get_directory_mtime(directory)
+            try:
+                with os.scandir(directory) as it:
+                    entries = list(it)
+            except OSError:
+                continue
+            subdirs = []
+            files = []
+            for entry in entries:
+                try:
+                    is_dir = entry.is_dir()
+                except OSError:
+                    is_dir = False
+                if not is_dir:
+                    files.append(entry.name)
+                elif entry.name not in excluded_folders and not entry.is_symlink():
+                    subdirs.append(entry.path)
+            sketches = [f for f in files if f.endswith(".ino")]
+            if len(sketches) > 0:
+                sketch_folders.append(
+                    {"path": directory, "sketches": sketches, "files": files}
+                )
+            # the last folder pushed is scanned first, so push them in reverse
+            to_scan.extend(reversed(subdirs))
+    return sketch_folders, directory_mtimes
+
+
+class ExampleIndex:
+    """Index of the example sketches in the examples and extras folders.
+
+    An example is a folder with an .ino file of the same name. The folders are
+    scanned once, and the index can be saved to a cache file with the modification
+    time of every folder that was scanned. A folder's modification time changes
+    whenever a file or folder in it is added, removed, or renamed, so the cached
+    index is used for as long as every one of those times is the same.
+
+    Args:
+        search_paths: The folders to search for examples (ie, examples and extras)
+        excluded_folders: Names of the folders that are not searched
+        cache_file: A file to load the index from and save it to, if any
+    """
+
+    def __init__(
+        self,
+        search_paths: List[str],
+        excluded_folders: List[str] = EXCLUDED_EXAMPLE_FOLDERS,
+        cache_file: str | None = None,
+    ):
+        self.search_paths = [os.path.abspath(p) for p in search_paths]
+        self.excluded_folders = list(excluded_folders)
+        self.cache_file = cache_file
+        self.from_cache = False
+        cached = self._load_cache()
+        if cached is not None:
+            self.sketch_folders = cached["sketch_folders"]
+            self.directory_mtimes = cached["directory_mtimes"]
+            self.from_cache = True
+        else:
+            self.sketch_folders, self.directory_mtimes = scan_sketch_folders(
+                self.search_paths, self.excluded_folders
+            )
+            self._save_cache()
+
+    def _load_cache(self) -> dict | None:
+        if self.cache_file is None or not os.path.isfile(self.cache_file):
+            return None
+        try:
+            cached = load_json_file(self.cache_file)
+        except (OSError, json.JSONDecodeError):
+            return None
+        if (
+            cached.get("index_version") != EXAMPLE_INDEX_VERSION
+            or cached.get("search_paths") != self.search_paths
+            or cached.get("excluded_folders") != self.excluded_folders
+        ):
+            return None
+        for directory, mtime in cached["directory_mtimes"].items():
+            if get_directory_mtime(directory) != mtime:
+                return None
+        return cached
+
+    def _save_cache(self) -> None:
+        if self.cache_file is None:
+            return
+        os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+        save_json_file(
+            self.cache_file,
+            {
+                "index_version": EXAMPLE_INDEX_VERSION,
+                "search_paths": self.search_paths,
+                "excluded_folders": self.excluded_folders,
+                "directory_mtimes": self.directory_mtimes,
+                "sketch_folders": self.sketch_folders,
+            },
+        )
+
+    def get_examples(self) -> List[dict]:
+        """
+        Get the examples, as {path, sketch, files}, where sketch is the path of the
+        example's .ino file and files are the names of the other files beside it.
+        """
+        examples = []
+        for folder in self.sketch_folders:
+            sketch_name = os.path.basename(folder["path"]) + ".ino"
+            if sketch_name in folder["sketches"]:
+                examples.append(
+                    {
+                        "path": folder["path"],
+                        "sketch": os.path.join(folder["path"], sketch_name),
+                        "files": [f for f in folder["files"] if f != sketch_name],
+                    }
+                )
+        return examples
+
+    def find_sketch(self, sketch_name: str) -> List[str]:
+        """Get the folders with an .ino file of the given name"""
+        return [
+            folder["path"]
+            for folder in self.sketch_folders
+            if sketch_name in folder["sketches"]
+        ]
+
+
 # %%
 # Platform and board configuration utilities dups
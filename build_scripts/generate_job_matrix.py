@@ -6,13 +6,26 @@ This script is the main entry point that the workflow should call.
 It runs all matrix generation steps in sequence and handles output.
 
 Usage:
-    python generate_job_matrix.py
+    python generate_job_matrix.py [--in-process] [--run-jobs]
+
+With --in-process (or IN_PROCESS=true), each stage is imported as a module and run
+in this interpreter with the configuration parsed here, instead of starting a new
+Python process per stage that re-imports its dependencies and re-reads the config.
+
+With --run-jobs (or RUN_JOBS=true), the generated jobs are then run on this machine
+with run_local_jobs.py.
 """
 
 import os
 import sys
 import subprocess
-from build_config import get_extended_config, set_verbose_mode, print_verbose
+from build_config import (
+    ConfigError,
+    get_extended_config,
+    set_verbose_mode,
+    print_verbose,
+)
+from build_utils import run_pipeline_stage
 
 def main():
     """Run the matrix generation pipeline"""
@@ -23,7 +36,11 @@ def main():
     print_verbose(
         "Reading configuration from environment variables, command line arguments, and the config file..."
     )
-    args = get_extended_config()
+    try:
+        args = get_extended_config()
+    except ConfigError as e:
+        print(f"::error::{e}")
+        return 1
     set_verbose_mode(args.verbose)
 
     # Get the directory containing this script
@@ -39,7 +56,8 @@ def main():
     print(f"Matrix Generation Pipeline")
     print(f"Script directory: {script_dir}")
     print(f"Artifact path: {args.artifact_path}")
-    print(f"Running in GitHub Actions: {in_github}\n")
+    print(f"Running in GitHub Actions: {in_github}")
+    print(f"Running stages in-process: {args.in_process}\n")
 
     # Check for custom generator first
     if os.path.exists("continuous_integration/generate_job_matrix.py"):
@@ -84,16 +102,39 @@ def main():
         print(f"Running: {script_name}")
         print(f"{'='*60}\n")
 
-        result = subprocess.run(
-            [sys.executable, "-u", script_path],
-            env=env,
-            cwd=script_dir,
-        )
+        if args.in_process:
+            return_code = run_pipeline_stage(script_path, args)
+        else:
+            result = subprocess.run(
+                [sys.executable, "-u", script_path],
+                env=env,
+                cwd=script_dir,
+            )
+            return_code = result.returncode
 
-        if result.returncode != 0:
-            print(f"\nERROR: {script_name} failed with exit code {result.returncode}")
+        if return_code != 0:
+            print(f"\nERROR: {script_name} failed with exit code {return_code}")
             return 1
 
+    # Run the generated jobs here, if requested, before cleanup removes their configs
+    jobs_return_code = 0
+    if args.run_jobs:
+        print(f"\n{'='*60}")
+        print("Running: run_local_jobs.py")
+        print(f"{'='*60}\n")
+
+        run_jobs_script = os.path.join(script_dir, "run_local_jobs.py")
+        if args.in_process:
+            jobs_return_code = run_pipeline_stage(run_jobs_script, args)
+        else:
+            jobs_return_code = subprocess.run(
+                [sys.executable, "-u", run_jobs_script],
+                env=env,
+                cwd=script_dir,
+            ).returncode
+        if jobs_return_code != 0:
+            print(f"\nERROR: Some jobs failed (exit code {jobs_return_code})")
+
     # Run cleanup only if not in GitHub Actions
     if not in_github:
         print(f"\n{'='*60}")
@@ -101,7 +142,9 @@ def main():
         print(f"{'='*60}\n")
 
         cleanup_script = os.path.join(script_dir, "5_cleanup.py")
-        if os.path.exists(cleanup_script):
+        if os.path.exists(cleanup_script) and args.in_process:
+            run_pipeline_stage(cleanup_script, args)
+        elif os.path.exists(cleanup_script):
             subprocess.run(
                 [sys.executable, "-u", cleanup_script],
                 env=env,
@@ -111,6 +154,10 @@ def main():
         print("\nSkipping cleanup (running in GitHub Actions)")
 
     print(f"\n{'='*60}")
+    if jobs_return_code != 0:
+        print("Matrix generation completed, but some of the local jobs failed!")
+        print(f"{'='*60}\n")
+        return 1
     print("Matrix generation completed successfully!")
     print(f"{'='*60}\n")
 
@@ -15,17 +15,32 @@ Usage:
 
 Options:
     --no-cleanup    Don't clean up generated files when running locally
+    --in-process    Import and run each stage in this interpreter, sharing one config
 """
 
 import os
 import sys
 import subprocess
-from build_config import get_extended_config, set_verbose_mode, print_verbose
+from build_config import (
+    ConfigError,
+    get_extended_config,
+    set_verbose_mode,
+    print_verbose,
+)
+from build_utils import run_pipeline_stage
 
 def run_script(
-    script_name: str, script_path: str, artifact_path: str, env: dict | None = None
+    script_name: str,
+    script_path: str,
+    artifact_path: str,
+    env: dict | None = None,
+    args=None,
 ):
-    """Run a Python script and handle errors"""
+    """Run a Python script and handle errors
+
+    If a parsed config is given, the script is run in-process with that config
+    instead of in a new interpreter.
+    """
     if env is None:
         env = os.environ.copy()
 
@@ -33,14 +48,18 @@ def run_script(
     print(f"Running: {script_name}")
     print(f"{'='*60}")
 
-    result = subprocess.run(
-        [sys.executable, "-u", script_path],
-        env=env,
-        cwd=os.path.dirname(os.path.abspath(__file__)),
-    )
-
-    if result.returncode != 0:
-        print(f"::error::{script_name} failed with exit code {result.returncode}")
+    if args is not None:
+        return_code = run_pipeline_stage(script_path, args)
+    else:
+        result = subprocess.run(
+            [sys.executable, "-u", script_path],
+            env=env,
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+        )
+        return_code = result.returncode
+
+    if return_code != 0:
+        print(f"::error::{script_name} failed with exit code {return_code}")
         return False
 
     return True
@@ -54,12 +73,19 @@ def main():
     print_verbose(
         "Reading configuration from environment variables, command line arguments, and the config file..."
     )
-    args = get_extended_config()
+    try:
+        args = get_extended_config()
+    except ConfigError as e:
+        print(f"::error::{e}")
+        return 1
     set_verbose_mode(args.verbose)
 
     # Get the directory containing this script
     script_dir = os.path.dirname(os.path.abspath(__file__))
 
+    # Share the parsed config with every stage when running in-process
+    stage_args = args if args.in_process else None
+
     # Run all scripts in order
     scripts = [
         ("1. Configure Workspace", "1_configure_workspace.py"),
@@ -75,13 +101,15 @@ def main():
             print(f"::error::Script not found: {script_path}")
             return False
 
-        if not run_script(script_name, script_path, args.artifact_path):
+        if not run_script(
+            script_name, script_path, args.artifact_path, args=stage_args
+        ):
             return False
 
     script_name = "5. Cleanup"
     script_path = os.path.join(script_dir, "5_cleanup.py")
     if os.path.exists(script_path):
-        run_script(script_name, script_path, args.artifact_path)
+        run_script(script_name, script_path, args.artifact_path, args=stage_args)
 
     print(f"\n{'='*60}")
     print("Matrix generation completed successfully!")
@@ -18,6 +18,18 @@ import json
 import shutil
 import requests
 
+# Use the shared download cache if it was downloaded alongside this script
+try:
+    from build_cache import download_cache
+
+    def download_file(url: str) -> bytes:
+        return download_cache.fetch(url)
+
+except ImportError:
+
+    def download_file(url: str) -> bytes:
+        return requests.get(url).content
+
 from platformio.project.config import ProjectConfig
 from platformio.package.meta import PackageSpec
 
@@ -149,12 +161,12 @@ if "GITHUB_WORKSPACE" in os.environ.keys():
     arduino_cli_config = os.path.join(ci_path, "arduino_cli.yaml")
     if not os.path.isfile(arduino_cli_config):
         # download the default file
-        response = requests.get(
+        content = download_file(
             "https://raw.githubusercontent.com/EnviroDIY/workflows/main/build_scripts/arduino_cli.yaml"
         )
         # copy to the CI directory
         with open(os.path.join(ci_path, "arduino_cli.yaml"), "wb") as f:
-            f.write(response.content)
+            f.write(content)
         # also copy to the artifacts directory
         shutil.copyfile(
             os.path.join(ci_path, "arduino_cli.yaml"),
@@ -18,6 +18,18 @@ import json
 import shutil
 import requests
 
+# Use the shared download cache if it was downloaded alongside this script
+try:
+    from build_cache import download_cache
+
+    def download_file(url: str) -> bytes:
+        return download_cache.fetch(url)
+
+except ImportError:
+
+    def download_file(url: str) -> bytes:
+        return requests.get(url).content
+
 from platformio.project.config import ProjectConfig
 
 # %%
@@ -70,20 +82,20 @@ if not os.path.exists(artifact_dir):
 # Pull files to convert between boards and platforms and FQBNs
 
 # Translation between board names on PlatformIO and the Arduino CLI
-response = requests.get(
+content = download_file(
     "https://raw.githubusercontent.com/EnviroDIY/workflows/main/build_scripts/platformio_to_arduino_boards.json"
 )
 with open(os.path.join(ci_path, "platformio_to_arduino_boards.json"), "wb") as f:
-    f.write(response.content)
+    f.write(content)
 with open(os.path.join(ci_path, "platformio_to_arduino_boards.json")) as f:
     pio_to_acli = json.load(f)
 
 # Tools per platform
-response = requests.get(
+content = download_file(
     "https://raw.githubusercontent.com/EnviroDIY/workflows/main/build_scripts/platformio_platform_tools.json"
 )
 with open(os.path.join(ci_path, "platformio_platform_tools.json"), "wb") as f:
-    f.write(response.content)
+    f.write(content)
 with open(os.path.join(ci_path, "platformio_platform_tools.json")) as f:
     platformio_platform_tools = json.load(f)
 
@@ -97,12 +109,12 @@ if "GITHUB_WORKSPACE" in os.environ.keys():
     arduino_cli_config = os.path.join(ci_path, "arduino_cli.yaml")
     if not os.path.isfile(arduino_cli_config):
         # download the default file
-        response = requests.get(
+        content = download_file(
             "https://raw.githubusercontent.com/EnviroDIY/workflows/main/build_scripts/arduino_cli.yaml"
         )
         # copy to the CI directory
         with open(os.path.join(ci_path, "arduino_cli.yaml"), "wb") as f:
-            f.write(response.content)
+            f.write(content)
         # also copy to the artifacts directory
         shutil.copyfile(
             os.path.join(ci_path, "arduino_cli.yaml"),
@@ -118,12 +130,12 @@ default_pio_config_file = False
 pio_config_file = os.path.join(ci_path, "platformio.ini")
 if not os.path.isfile(pio_config_file):
     # download the default file
-    response = requests.get(
+    content = download_file(
         "https://raw.githubusercontent.com/EnviroDIY/workflows/main/build_scripts/platformio.ini"
     )
     # make a directory for it and copy it there
     with open(os.path.join(ci_path, "platformio.ini"), "wb") as f:
-        f.write(response.content)
+        f.write(content)
     # also copy to the artifacts directory
     shutil.copyfile(
         os.path.join(ci_path, "platformio.ini"),
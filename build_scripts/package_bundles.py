@@ -0,0 +1,670 @@
+#!/usr/bin/env python
+"""
+Content-hashed bundles of the installed cores, platforms, tools, and libraries.
+
+2_generate_install_scripts.py writes a package manifest (package_manifest.json) next
+to the install scripts. The manifest splits everything the install scripts install
+into bundles:
+    - one bundle for each Arduino core, with the tools it depends on
+    - one bundle for each PlatformIO platform, with all of the tools it needs
+    - one bundle for the libraries of each toolchain
+
+Each bundle has a hash of its canonical JSON specification, and each toolchain has a
+hash of its bundles. Most specifications are not pinned to a version, so the cache
+key of a set of bundles also has the exact versions that were installed for them,
+which pack records in a lock file next to the manifest.
+
+After the install scripts have run, the bundles can be packed into a local store.
+Files are stored once by the hash of their contents, compressed, so the tools shared
+between bundles and the files that did not change between versions are only kept
+once. The index of each bundle records the exact version of every package that was
+installed. A runner can then unpack only the bundles for the boards it builds,
+instead of restoring the whole ~/.platformio or ~/.arduino15 tree.
+
+Usage:
+    python package_bundles.py list [--manifest FILE] [--toolchain NAME]
+    python package_bundles.py key [--manifest FILE] [--toolchain NAME] [BUNDLE ...]
+    python package_bundles.py pack [--manifest FILE] [--store PATH] [BUNDLE ...]
+    python package_bundles.py unpack [--manifest FILE] [--store PATH] [BUNDLE ...]
+
+Without any bundle names, pack and unpack use every bundle of the selected
+toolchain(s). A bundle that is not in the store is skipped with a warning; the
+install scripts install anything that is missing.
+"""
+
+# %%
+import os
+import sys
+import json
+import shutil
+import zlib
+import hashlib
+import argparse
+import tempfile
+from typing import Dict, Iterable, List
+from build_config import set_verbose_mode, print_verbose
+
+# %%
+# settings
+
+MANIFEST_FILE_NAME = "package_manifest.json"
+MANIFEST_VERSION = 1
+# Where the packed bundles are kept between runs
+DEFAULT_STORE_PATH = os.path.join(
+    os.path.expanduser("~"), ".cache", "envirodiy_workflows", "package_bundles"
+)
+TOOLCHAINS = ["arduino-cli", "platformio"]
+# The keys of a dependency that change what is installed
+DEPENDENCY_KEYS = ["owner", "name", "version", "url"]
+
+
+# %%
+# Manifest
+
+
+def get_content_hash(value) -> str:
+    """Get the SHA-256 of the canonical JSON of a value"""
+    canonical = json.dumps(value, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+def get_dependency_spec(dependency: dict) -> dict:
+    """Get the parts of a library dependency that change what is installed"""
+    return {k: dependency[k] for k in DEPENDENCY_KEYS if dependency.get(k)}
+
+
+def make_bundle(toolchain: str, name: str, kind: str, packages: List[dict]) -> dict:
+    """Make a manifest bundle, with the hash of its toolchain and packages"""
+    return {
+        "name": name,
+        "kind": kind,
+        "packages": packages,
+        "hash": get_content_hash(
+            {"toolchain": toolchain, "kind": kind, "packages": packages}
+        ),
+    }
+
+
+def create_package_manifest(
+    build_cores: List[str],
+    pio_platforms: Dict[str, List[str]],
+    dependencies: List[dict],
+) -> dict:
+    """
+    Create the package manifest for the install scripts.
+
+    Args:
+        build_cores: The Arduino cores to install
+        pio_platforms: The PlatformIO platforms to install, with every tool each
+            one needs, including the tools it shares with other platforms
+        dependencies: The library and example dependencies
+
+    Returns:
+        dict: The manifest, with the bundles and hashes of each toolchain
+    """
+    # the same library may be both a library and an example dependency
+    specs = {get_content_hash(s): s for s in map(get_dependency_spec, dependencies)}
+    library_packages = [dict(specs[h], type="library") for h in sorted(specs)]
+
+    arduino_bundles = [
+        make_bundle(
+            "arduino-cli",
+            f"core-{core.split('@')[0].replace(':', '-')}",
+            "platform",
+            [{"type": "core", "spec": core}],
+        )
+        for core in sorted(set(build_cores))
+    ]
+    arduino_bundles.append(
+        make_bundle("arduino-cli", "libraries", "libraries", library_packages)
+    )
+
+    pio_bundles = [
+        make_bundle(
+            "platformio",
+            f"platform-{get_pio_package_name(platform)}",
+            "platform",
+            [{"type": "platform", "spec": platform}]
+            + [{"type": "tool", "spec": tool} for tool in sorted(set(tools))],
+        )
+        for platform, tools in sorted(pio_platforms.items())
+    ]
+    pio_bundles.append(
+        make_bundle("platformio", "libraries", "libraries", library_packages)
+    )
+
+    toolchains = {}
+    for toolchain, bundles in zip(TOOLCHAINS, [arduino_bundles, pio_bundles]):
+        toolchains[toolchain] = {
+            "hash": get_content_hash([bundle["hash"] for bundle in bundles]),
+            "bundles": bundles,
+        }
+    return {"version": MANIFEST_VERSION, "toolchains": toolchains}
+
+
+def write_package_manifest(manifest: dict, manifest_file: str) -> None:
+    """Write the manifest so the same packages always give the same file"""
+    with open(manifest_file, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+        f.write("\n")
+
+
+def load_package_manifest(manifest_file: str) -> dict:
+    """Read a package manifest"""
+    with open(manifest_file, "r") as f:
+        manifest = json.load(f)
+    if manifest.get("version") != MANIFEST_VERSION:
+        print(
+            f"::error::Unsupported package manifest version {manifest.get('version')} in {manifest_file}"
+        )
+        exit(1)
+    return manifest
+
+
+def get_lock_file(manifest_file: str) -> str:
+    """Get the file with the exact versions installed for the bundles of a manifest"""
+    return os.path.splitext(manifest_file)[0] + ".lock.json"
+
+
+def load_package_lock(lock_file: str) -> dict:
+    """Read the exact versions installed for each bundle, by toolchain and bundle name"""
+    try:
+        with open(lock_file, "r") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return {}
+
+
+def get_locked_versions(
+    lock: dict, toolchain: str, bundle: dict
+) -> Dict[str, str] | None:
+    """Get the versions locked for a bundle, if it was packed with the same packages"""
+    locked = lock.get(toolchain, {}).get(bundle["name"])
+    if locked is None or locked.get("hash") != bundle["hash"]:
+        return None
+    return locked["versions"]
+
+
+def get_bundles_key(selected: List[tuple[str, dict]], lock: dict) -> str:
+    """
+    Get the cache key of a set of bundles.
+
+    The key has the hash of each bundle's packages and the exact versions locked for
+    them, so it changes when a new upstream release is installed for a package that
+    is not pinned to a version. A bundle that has not been packed yet is keyed by
+    its packages alone.
+    """
+    return get_content_hash(
+        [
+            [bundle["hash"], get_locked_versions(lock, toolchain, bundle)]
+            for toolchain, bundle in selected
+        ]
+    )
+
+
+def select_bundles(
+    manifest: dict, toolchains: Iterable[str], names: Iterable[str]
+) -> List[tuple[str, dict]]:
+    """Get the (toolchain, bundle) pairs to use, all of them if no names are given"""
+    names = set(names)
+    selected = []
+    for toolchain in toolchains:
+        for bundle in manifest["toolchains"][toolchain]["bundles"]:
+            if len(names) == 0 or bundle["name"] in names:
+                selected.append((toolchain, bundle))
+    found = {bundle["name"] for _, bundle in selected}
+    for name in sorted(names - found):
+        print(f"::warning::No bundle named {name} in the package manifest")
+    return selected
+
+
+# %%
+# Finding the installed packages
+
+
+def get_pio_package_name(spec: str) -> str:
+    """Get the bare name of a PlatformIO package spec: owner/name@version or a URL"""
+    if "://" in spec:
+        name = spec.rstrip("/").split("/")[-1].split("#")[0]
+        return name.removesuffix(".git").removesuffix(".zip")
+    return spec.split("@")[0].split("/")[-1]
+
+
+def read_pio_package_meta(package_dir: str) -> dict | None:
+    """Read the metadata PlatformIO keeps about an installed package"""
+    try:
+        with open(os.path.join(package_dir, ".piopm"), "r") as f:
+            return json.load(f)
+    except (OSError, json.JSONDecodeError):
+        return None
+
+
+def find_pio_package(root_dir: str, spec: str) -> tuple[str, str] | None:
+    """
+    Find the folder and version of an installed PlatformIO package.
+
+    URL specs are matched by the URL PlatformIO installed them from, the others by
+    name.
+    """
+    name = get_pio_package_name(spec).lower()
+    if not os.path.isdir(root_dir):
+        return None
+    for entry in sorted(os.scandir(root_dir), key=lambda e: e.name):
+        if not entry.is_dir():
+            continue
+        meta = read_pio_package_meta(entry.path)
+        if meta is None:
+            continue
+        meta_spec = meta.get("spec") or {}
+        if "://" in spec:
+            matches = meta_spec.get("uri") == spec
+        else:
+            matches = (meta_spec.get("name") or meta.get("name", "")).lower() == name
+        if matches:
+            return entry.name, meta.get("version", "")
+    return None
+
+
+def get_arduino_directories(
+    arduino_cli_config: str, workspace_path: str
+) -> Dict[str, str]:
+    """
+    Get the data and user directories from the Arduino CLI configuration file.
+
+    Only the directories block is read, so this does not need a YAML parser.
+    Relative directories are relative to the workspace, where the CLI is run.
+    """
+    directories = {
+        "data": os.path.join(os.path.expanduser("~"), ".arduino15"),
+        "user": os.path.join(os.path.expanduser("~"), "Arduino"),
+    }
+    try:
+        with open(arduino_cli_config, "r") as f:
+            lines = f.read().splitlines()
+    except OSError:
+        print_verbose(f"No Arduino CLI configuration at {arduino_cli_config}")
+        return directories
+    in_directories = False
+    for line in lines:
+        if not line.startswith(" "):
+            in_directories = line.strip() == "directories:"
+            continue
+        if in_directories and ":" in line:
+            key, value = line.strip().split(":", 1)
+            value = value.strip().strip("'\"")
+            if key in directories and value:
+                directories[key] = os.path.join(workspace_path, value)
+    return directories
+
+
+def get_version_sort_key(version: str) -> tuple:
+    """Sort versions by their numbers, so 1.10.0 comes after 1.8.6 and 1.10.0-rc1"""
+    release, dash, prerelease = version.split("+")[0].partition("-")
+    numbers = tuple(int(part) if part.isdigit() else -1 for part in release.split("."))
+    return numbers, dash == "", prerelease
+
+
+def find_arduino_core(data_dir: str, core: str) -> tuple[List[str], str] | None:
+    """
+    Find the folders and version of an installed Arduino core.
+
+    Returns the core folder and the folders of the tools it depends on, relative to
+    the data directory.
+    """
+    vendor, arch = core.split("@")[0].split(":")[:2]
+    requested = core.split("@")[1] if "@" in core else None
+    hardware_dir = os.path.join(data_dir, "packages", vendor, "hardware", arch)
+    if not os.path.isdir(hardware_dir):
+        return None
+    versions = sorted(os.listdir(hardware_dir), key=get_version_sort_key)
+    if requested is not None:
+        versions = [v for v in versions if v == requested]
+    if len(versions) == 0:
+        return None
+    version = versions[-1]
+    folders = [os.path.join("packages", vendor, "hardware", arch, version)]
+    try:
+        with open(os.path.join(hardware_dir, version, "installed.json"), "r") as f:
+            installed = json.load(f)
+    except (OSError, json.JSONDecodeError):
+        installed = {}
+    for package in installed.get("packages", []):
+        for platform in package.get("platforms", []):
+            if platform.get("architecture") != arch:
+                continue
+            for tool in platform.get("toolsDependencies", []):
+                folders.append(
+                    os.path.join(
+                        "packages",
+                        tool["packager"],
+                        "tools",
+                        tool["name"],
+                        tool["version"],
+                    )
+                )
+    # the package indexes the CLI needs to know the core is installed
+    folders.extend(f for f in sorted(os.listdir(data_dir)) if f.endswith(".json"))
+    return folders, version
+
+
+def find_arduino_library(libraries_dir: str, name: str) -> tuple[str, str] | None:
+    """Find the folder and version of an installed Arduino library, by its name"""
+    if not os.path.isdir(libraries_dir):
+        return None
+    for entry in sorted(os.scandir(libraries_dir), key=lambda e: e.name):
+        properties = {}
+        try:
+            with open(os.path.join(entry.path, "library.properties"), "r") as f:
+                for line in f:
+                    if "=" in line:
+                        key, value = line.split("=", 1)
+                        properties[key.strip()] = value.strip()
+        except OSError:
+            pass
+        if properties.get("name", entry.name) in [name, name.replace(" ", "_")]:
+            return entry.name, properties.get("version", "")
+    return None
+
+
+def get_install_roots(args) -> Dict[str, str]:
+    """Get the folders the packages are installed in, by root name"""
+    pio_core_dir = os.environ.get(
+        "PLATFORMIO_CORE_DIR", os.path.join(os.path.expanduser("~"), ".platformio")
+    )
+    arduino_dirs = get_arduino_directories(args.arduino_cli_config, args.workspace_path)
+    return {
+        "pio_platforms": os.environ.get(
+            "PLATFORMIO_PLATFORMS_DIR", os.path.join(pio_core_dir, "platforms")
+        ),
+        "pio_packages": os.environ.get(
+            "PLATFORMIO_PACKAGES_DIR", os.path.join(pio_core_dir, "packages")
+        ),
+        "pio_lib": os.path.join(pio_core_dir, "lib"),
+        "arduino_data": arduino_dirs["data"],
+        "arduino_libraries": os.path.join(arduino_dirs["user"], "libraries"),
+    }
+
+
+def locate_bundle(
+    toolchain: str, bundle: dict, roots: Dict[str, str]
+) -> tuple[List[tuple[str, str]], Dict[str, str], List[str]]:
+    """
+    Find the installed folders of the packages in a bundle.
+
+    Returns the (root name, relative folder) pairs, the installed version of each
+    package, and the packages that are not installed.
+    """
+    folders: List[tuple[str, str]] = []
+    versions: Dict[str, str] = {}
+    missing: List[str] = []
+    for package in bundle["packages"]:
+        label = package.get("spec") or package.get("name")
+        if toolchain == "platformio":
+            root = {"platform": "pio_platforms", "tool": "pio_packages"}.get(
+                package["type"], "pio_lib"
+            )
+            if package["type"] == "library" and "://" in package.get("version", ""):
+                # libraries from a git repository are installed from the URL
+                found = find_pio_package(roots[root], package["version"])
+            else:
+                found = find_pio_package(roots[root], label)
+            if found is not None:
+                folders.append((root, found[0]))
+        elif package["type"] == "core":
+            found = find_arduino_core(roots["arduino_data"], package["spec"])
+            if found is not None:
+                folders.extend(("arduino_data", folder) for folder in found[0])
+                found = (None, found[1])
+        else:
+            found = find_arduino_library(roots["arduino_libraries"], package["name"])
+            if found is not None:
+                folders.append(("arduino_libraries", found[0]))
+        if found is None:
+            missing.append(label)
+        else:
+            versions[label] = found[1]
+    return list(dict.fromkeys(folders)), versions, missing
+
+
+# %%
+# Bundle store
+
+
+def remove_path(path: str) -> None:
+    """Remove a file, link, or folder, if there is one"""
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
+
+
+class BundleStore:
+    """
+    A local store of packed bundles.
+
+    Layout:
+        objects/<hash[:2]>/<hash> - the zlib compressed contents of each file
+        bundles/<bundle hash>.json - the files and package versions of each bundle
+    """
+
+    def __init__(self, store_path: str = DEFAULT_STORE_PATH):
+        self.store_path = store_path
+        self.objects_path = os.path.join(store_path, "objects")
+        self.bundles_path = os.path.join(store_path, "bundles")
+        self.new_objects = 0
+        self.reused_objects = 0
+
+    def _object_file(self, content_hash: str) -> str:
+        return os.path.join(self.objects_path, content_hash[:2], content_hash)
+
+    def _write_atomic(self, file_path: str, data: bytes) -> None:
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(file_path))
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        os.replace(tmp_file, file_path)
+
+    def put_file(self, file_path: str) -> str:
+        """Store the contents of a file, once, and return their hash"""
+        with open(file_path, "rb") as f:
+            data = f.read()
+        content_hash = hashlib.sha256(data).hexdigest()
+        object_file = self._object_file(content_hash)
+        if os.path.isfile(object_file):
+            self.reused_objects += 1
+        else:
+            self._write_atomic(object_file, zlib.compress(data, 6))
+            self.new_objects += 1
+        return content_hash
+
+    def get_file(self, content_hash: str) -> bytes:
+        """Get stored file contents by their hash"""
+        with open(self._object_file(content_hash), "rb") as f:
+            return zlib.decompress(f.read())
+
+    def bundle_file(self, bundle: dict) -> str:
+        return os.path.join(self.bundles_path, f"{bundle['hash']}.json")
+
+    def has_bundle(self, bundle: dict) -> bool:
+        return os.path.isfile(self.bundle_file(bundle))
+
+    def get_versions(self, bundle: dict) -> Dict[str, str]:
+        """Get the package versions recorded when a bundle was packed"""
+        with open(self.bundle_file(bundle), "r") as f:
+            return json.load(f)["versions"]
+
+    def pack(
+        self,
+        bundle: dict,
+        folders: List[tuple[str, str]],
+        roots: Dict[str, str],
+        versions: Dict[str, str],
+    ) -> dict:
+        """Store the files of a bundle's folders and write the bundle index"""
+        files = []
+        for root, folder in folders:
+            top = os.path.join(roots[root], folder)
+            if os.path.isfile(top):
+                walked = [(os.path.dirname(top), [], [os.path.basename(top)])]
+            else:
+                walked = os.walk(top)
+            for dir_path, dir_names, file_names in walked:
+                dir_names.sort()
+                for file_name in sorted(file_names):
+                    file_path = os.path.join(dir_path, file_name)
+                    entry = {
+                        "root": root,
+                        "path": os.path.relpath(file_path, roots[root]),
+                    }
+                    if os.path.islink(file_path):
+                        entry["link"] = os.readlink(file_path)
+                    else:
+                        entry["hash"] = self.put_file(file_path)
+                        entry["mode"] = os.stat(file_path).st_mode & 0o777
+                    files.append(entry)
+        index = {
+            "name": bundle["name"],
+            "hash": bundle["hash"],
+            "versions": versions,
+            "folders": [list(folder) for folder in folders],
+            "files": files,
+        }
+        self._write_atomic(
+            self.bundle_file(bundle),
+            json.dumps(index, indent=1, sort_keys=True).encode("utf-8"),
+        )
+        return index
+
+    def unpack(self, bundle: dict, roots: Dict[str, str]) -> int:
+        """
+        Restore the files of a packed bundle and return how many there were.
+
+        The folders the bundle was packed from are removed first, so the files of
+        an older version installed in the same folder (PlatformIO package folders
+        have no version in their names) are not left mixed into the new one.
+        """
+        with open(self.bundle_file(bundle), "r") as f:
+            index = json.load(f)
+        for root, folder in index.get("folders", []):
+            remove_path(os.path.join(roots[root], folder))
+        for entry in index["files"]:
+            file_path = os.path.join(roots[entry["root"]], entry["path"])
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            remove_path(file_path)
+            if "link" in entry:
+                os.symlink(entry["link"], file_path)
+            else:
+                with open(file_path, "wb") as f:
+                    f.write(self.get_file(entry["hash"]))
+                os.chmod(file_path, entry["mode"])
+        return len(index["files"])
+
+
+# %%
+def main(argv: List[str] | None = None) -> int:
+    """List, pack, or unpack the bundles in a package manifest"""
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("command", choices=["list", "key", "pack", "unpack"])
+    parser.add_argument("bundles", nargs="*", help="names of the bundles to use")
+    parser.add_argument(
+        "--manifest",
+        help="the package manifest written by 2_generate_install_scripts.py",
+        default=os.path.join(
+            os.getcwd(), "continuous_integration_artifacts", MANIFEST_FILE_NAME
+        ),
+    )
+    parser.add_argument(
+        "--store",
+        help="folder to keep the packed bundles in",
+        default=os.environ.get("PACKAGE_STORE_PATH") or DEFAULT_STORE_PATH,
+    )
+    parser.add_argument("--toolchain", choices=TOOLCHAINS, default=None)
+    parser.add_argument(
+        "--workspace-path",
+        help="folder the install scripts were run from",
+        default=os.getcwd(),
+    )
+    parser.add_argument(
+        "--arduino-cli-config",
+        help="the Arduino CLI configuration file used to install the cores",
+        default=os.path.join(os.getcwd(), "continuous_integration", "arduino_cli.yaml"),
+    )
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_intermixed_args(argv)
+    set_verbose_mode(args.verbose)
+
+    manifest = load_package_manifest(args.manifest)
+    toolchains = [args.toolchain] if args.toolchain else TOOLCHAINS
+    selected = select_bundles(manifest, toolchains, args.bundles)
+    # the exact versions that were installed for each bundle
+    lock_file = get_lock_file(args.manifest)
+    lock = load_package_lock(lock_file)
+
+    if args.command == "key":
+        # with no bundle names, this is the key for the whole toolchain
+        for toolchain, bundle in selected:
+            if get_locked_versions(lock, toolchain, bundle) is None:
+                print(
+                    f"::warning::{toolchain} {bundle['name']} has not been packed, "
+                    "so its key does not have the installed versions",
+                    file=sys.stderr,
+                )
+        print(get_bundles_key(selected, lock))
+        return 0
+
+    if args.command == "list":
+        store = BundleStore(args.store)
+        for toolchain, bundle in selected:
+            packed = store.has_bundle(bundle)
+            versions = store.get_versions(bundle) if packed else {}
+            print(
+                f"{toolchain} {bundle['name']} {bundle['hash'][:12]} "
+                f"({'packed' if packed else 'not packed'})"
+            )
+            for package in bundle["packages"]:
+                label = package.get("spec") or package.get("name")
+                print_verbose(f"  - {label} {versions.get(label, '')}".rstrip())
+        return 0
+
+    roots = get_install_roots(args)
+    store = BundleStore(args.store)
+    return_code = 0
+    for toolchain, bundle in selected:
+        label = f"{toolchain} {bundle['name']}"
+        if args.command == "unpack":
+            if not store.has_bundle(bundle):
+                print(f"::warning::{label} has not been packed; it will be installed")
+                continue
+            print(f"Unpacked {label}: {store.unpack(bundle, roots)} files")
+            continue
+        folders, versions, missing = locate_bundle(toolchain, bundle, roots)
+        for package in missing:
+            print(f"::warning::{package} is not installed, so it is not in {label}")
+        if len(missing) > 0:
+            # a partial bundle would hide the missing packages from later runs
+            return_code = 1
+            continue
+        index = store.pack(bundle, folders, roots, versions)
+        lock.setdefault(toolchain, {})[bundle["name"]] = {
+            "hash": bundle["hash"],
+            "versions": versions,
+        }
+        print(f"Packed {label}: {len(index['files'])} files")
+
+    if args.command == "pack":
+        print(
+            f"Stored {store.new_objects} new files, reused {store.reused_objects} stored files"
+        )
+        with open(lock_file, "w") as f:
+            json.dump(lock, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Installed versions saved to: {lock_file}")
+    return return_code
+
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+
+# %%
+# cSpell:ignore fdopen piopm lexists
@@ -1,29 +1,82 @@
 #!/usr/bin/env python
+"""
+Parse the compile logs of the build jobs and summarize the build results.
+
+The job info, exit code, duration, and RAM and flash use of each build are read from
+the metrics files the job scripts write. The logs are found from the log manifest
+written by 4_build_jobs.py, or by searching the workspace if there is no manifest,
+and are only parsed (in parallel on a process pool) for the builds without metrics,
+or whose metrics do not have the sizes.
+
+The results are added to the build history (see build_history.py), and any growth
+of the flash use, RAM use, or build time since the earlier runs beyond the thresholds
+(in percent) is reported after the summary.
+
+Usage:
+    python parse_test_results.py [--quiet] [--workers N] [--history-file FILE]
+        [--flash-threshold PERCENT] [--ram-threshold PERCENT]
+        [--time-threshold PERCENT]
+"""
+
 # %%
-from glob import glob
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from glob import escape, glob
+import mmap
 import os
 import re
 import json
+import sys
 
+import numpy as np
 import pandas as pd
+from build_history import (
+    DEFAULT_FLASH_THRESHOLD,
+    DEFAULT_HISTORY_FILE,
+    DEFAULT_RAM_THRESHOLD,
+    DEFAULT_TIME_THRESHOLD,
+    append_build_results,
+    find_regressions,
+    format_regression_report,
+    open_build_history,
+)
+from build_scheduler import (
+    DEFAULT_DURATIONS_FILE,
+    get_duration_file_for_log,
+    get_duration_key,
+    read_duration_file,
+    update_build_durations,
+)
+from build_utils import (
+    BUILD_METRICS_FILE_SUFFIX,
+    LOG_MANIFEST_FILE_NAME,
+    get_filename_slug,
+    read_build_metrics,
+    read_log_manifest,
+)
 
 # %%
-# The workspace directory
-workspace_dir = os.getcwd()
-if "\\continuous_integration" in workspace_dir:
-    workspace_dir = workspace_dir.replace("\\continuous_integration", "")
+# settings
 
-workspace_path = os.path.abspath(os.path.realpath(workspace_dir))
-print(f"Workspace Path: {workspace_path}")
+# How much of the end of a PlatformIO log is searched first for the build results
+PIO_LOG_TAIL_BYTES = 16 * 1024
+# The logs are only split across processes when there are more than this many
+MIN_LOGS_FOR_POOL = 64
 
 
 # %%
-# A directory of files to save and upload as artifacts to use in future jobs
-artifact_dir = os.path.join(
-    os.path.join(workspace_dir, "continuous_integration_artifacts")
-)
-artifact_path = os.path.abspath(os.path.realpath(artifact_dir))
-print(f"Artifact Path: {artifact_path}")
+def get_workspace_path() -> str:
+    """Get the workspace directory"""
+    workspace_dir = os.getcwd()
+    if "\\continuous_integration" in workspace_dir:
+        workspace_dir = workspace_dir.replace("\\continuous_integration", "")
+    return os.path.abspath(os.path.realpath(workspace_dir))
+
+
+def get_artifact_path(workspace_path: str) -> str:
+    """Get the directory of files to save and upload as artifacts to use in future jobs"""
+    artifact_dir = os.path.join(workspace_path, "continuous_integration_artifacts")
+    return os.path.abspath(os.path.realpath(artifact_dir))
 
 
 # %%
@@ -118,9 +171,44 @@ def parse_pio_output(result_str: str) -> dict[str, int | None] | None:
     }
 
 
-def get_job_info_from_filename(filename: str) -> dict:
-    base_name = os.path.splitext(os.path.basename(filename))[0]
-    name_parts = base_name.split("_")
+def read_pio_log(log_file: str) -> dict[str, int | None] | None:
+    """
+    Parse a PlatformIO log, searching the end of the log first.
+
+    The final status is printed at the end of the compile, just after the RAM and
+    flash use (which are not printed if the compile fails before linking), so only
+    the last PIO_LOG_TAIL_BYTES of the memory-mapped log are decoded. The whole log
+    is only searched if the status, or the sizes of a successful build, are not
+    at its end.
+    """
+    with open(log_file, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return parse_pio_output("")
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as log_map:
+            start = max(0, size - PIO_LOG_TAIL_BYTES)
+            if start > 0:
+                # start at the first whole line
+                newline = log_map.find(b"\n", start)
+                start = newline + 1 if newline >= 0 else size
+            parsed_result = parse_pio_output(
+                log_map[start:].decode("utf-8", errors="replace")
+            )
+            if start > 0 and (
+                parsed_result["success"] is None  # type: ignore
+                or (
+                    parsed_result["success"]  # type: ignore
+                    and any(parsed_result[k] is None for k in SIZE_COLUMNS)  # type: ignore
+                )
+            ):
+                parsed_result = parse_pio_output(
+                    log_map[:].decode("utf-8", errors="replace")
+                )
+    return parsed_result
+
+
+def get_job_info_from_name_parts(name_parts: list[str]) -> dict:
+    """Get the job info from the slugs of the matrix values that name a log"""
     assumed_vals = {
         "compiler": name_parts[0],
         "example": name_parts[1],
@@ -132,92 +220,396 @@ def get_job_info_from_filename(filename: str) -> dict:
     return assumed_vals
 
 
+def get_job_info_from_filename(filename: str) -> dict:
+    """Guess the job info from the name of a log, for a build without metrics"""
+    base_name = os.path.splitext(os.path.basename(filename))[0]
+    return get_job_info_from_name_parts(base_name.split("_"))
+
+
+def get_job_info_from_metrics(build_metrics: dict) -> dict:
+    """
+    Get the job info from the matrix item in the metrics of a build.
+
+    The values are the slugs 4_build_jobs.py names the log with, in the same order,
+    so a build gets the same compiler, example, board, and flag_1 ... flag_N
+    columns (and the same key in the build history) whether or not its job wrote
+    metrics.
+    """
+    name_parts = [
+        get_filename_slug(key, value)
+        for key, value in build_metrics["matrix"].items()
+        if key not in ["build_commands", "other_commands"]
+        and value is not None
+        and value != ""
+        and value != []
+    ]
+    return get_job_info_from_name_parts(name_parts)
+
+
 # %%
-# parse all of the job logs and create a summary CSV file
-pio_logs = glob(f"**{os.sep}pio_*.log", recursive=True) + glob(
-    f"**{os.sep}platformio_*.log", recursive=True
-)
-print(f"Found {len(pio_logs)} PlatformIO compiler logs")
-acli_logs = (
-    glob(f"**{os.sep}arduino_*.json", recursive=True)
-    + glob(f"**{os.sep}arduino-cli_*.json", recursive=True)
-    + glob(f"**{os.sep}a-cli_*.json", recursive=True)
-)
-print(f"Found {len(acli_logs)} Arduino CLI logs")
+# The build sizes parsed from the logs
+SIZE_COLUMNS = ["ram_used", "ram_total", "flash_used", "flash_total"]
+# The columns with only a few different values, which are stored as categories
+CATEGORY_COLUMNS = ["compiler", "example", "board"]
+# The build status in the summary, by the success code in the results table
+SUCCESS_SYMBOLS = {2: ":black_circle:", 1: ":heavy_check_mark:", 0: ":x:"}
+# The compact table of the build results, saved next to the logs
+RESULTS_TABLE_FILE_NAME = "build_results.parquet"
 
 
-log_results = []
-for log_file in pio_logs + acli_logs:
-    job_info = get_job_info_from_filename(log_file)
-    print(f"Parsing log file: {log_file} for job info: {job_info}")
-    with open(log_file, "r") as f:
-        if job_info["compiler"] in ["pio", "platformio"]:
-            log_contents = f.read()
-            parsed_result = parse_pio_output(log_contents)
-            print(f"Parsed result for {log_file}: {parsed_result}")
+def summarize_log_results(log_results: list[dict]) -> pd.DataFrame:
+    """
+    Make a table of the build results, with the RAM and flash use as percentages,
+    sorted with the failures at the top, then by board, example, flag, and compiler.
+
+    Every column is computed at once instead of row by row, and the compiler, board,
+    example, and flag columns are categories. The success column is 1 for a
+    success, 0 for a failure, and 2 for a build without a result.
+    """
+    df = pd.DataFrame.from_records(log_results)
+    flag_columns = [col for col in df.columns if col.startswith("flag_")]
+    for col in CATEGORY_COLUMNS + SIZE_COLUMNS + ["success"]:
+        if col not in df.columns:
+            df[col] = None
+    for col in CATEGORY_COLUMNS + flag_columns:
+        df[col] = df[col].astype("category")
+
+    sizes = df[SIZE_COLUMNS].astype(float)
+    for size in ["flash", "ram"]:
+        # a total of 0 or none gives no percentage
+        total = sizes[f"{size}_total"].replace(0, np.nan)
+        df[f"{size}_percent"] = (sizes[f"{size}_used"] / total * 100).round(1)
+    df["success"] = (
+        df["success"].map({True: 1, False: 0}).fillna(2).astype(np.int8)
+    )
+
+    return df.sort_values(
+        by=["success", "board", "example"] + flag_columns + ["compiler"]
+    )
+
+
+def save_results_table(df: pd.DataFrame, results_file: str) -> bool:
+    """Save the table of the build results to a Parquet file, if pyarrow is installed"""
+    try:
+        df.to_parquet(results_file, index=False)
+    except ImportError as exc:
+        print(f"::warning::Could not save the build results table: {exc}")
+        return False
+    return True
+
+
+# %%
+def is_pio_log(job_info: dict) -> bool:
+    """Check if a log is a PlatformIO log, rather than an Arduino CLI JSON output"""
+    return job_info["compiler"] in ["pio", "platformio"]
+
+
+def search_log_files() -> list[str]:
+    """Find the logs by searching the current directory, when there is no manifest"""
+    pio_logs = glob(f"**{os.sep}pio_*.log", recursive=True) + glob(
+        f"**{os.sep}platformio_*.log", recursive=True
+    )
+    print(f"Found {len(pio_logs)} PlatformIO compiler logs")
+    acli_logs = (
+        glob(f"**{os.sep}arduino_*.json", recursive=True)
+        + glob(f"**{os.sep}arduino-cli_*.json", recursive=True)
+        + glob(f"**{os.sep}a-cli_*.json", recursive=True)
+    )
+    print(f"Found {len(acli_logs)} Arduino CLI logs")
+    return pio_logs + acli_logs
+
+
+def find_log_files(artifact_path: str, quiet: bool = False) -> list[str]:
+    """
+    Find the logs listed in the log manifest in the artifact path.
+
+    The logs are expected in the artifact path, where the log artifacts of all of
+    the jobs are downloaded. Any that are not there are looked for by name in the
+    folders under the artifact path, and the rest are reported as missing. If there is no
+    manifest, the current directory is searched for anything named like a log.
+    """
+    manifest = read_log_manifest(os.path.join(artifact_path, LOG_MANIFEST_FILE_NAME))
+    if manifest is None:
+        print("No log manifest found, searching for the logs...")
+        return search_log_files()
+
+    log_files = []
+    not_found = []
+    for entry in manifest:
+        log_file = os.path.join(artifact_path, entry["log_file"])
+        if os.path.isfile(log_file):
+            log_files.append(log_file)
         else:
-            try:
-                log_contents = json.load(f)
-                parsed_result = parse_arduino_output(log_contents)
-                print(f"Parsed result for {log_file}: {parsed_result}")
-            except json.JSONDecodeError:
-                parsed_result = {"success": False}
+            not_found.append(entry["log_file"])
+    if len(not_found) > 0:
+        found_elsewhere = {}
+        # the logs of each job may be in their own folder if they were not merged
+        for root, subdirs, files in os.walk(artifact_path):
+            for file in set(files).intersection(not_found):
+                found_elsewhere.setdefault(file, os.path.join(root, file))
+        log_files.extend(found_elsewhere[f] for f in not_found if f in found_elsewhere)
+        missing = [f for f in not_found if f not in found_elsewhere]
+        if len(missing) > 0:
+            print(f"::warning::{len(missing)} logs in the manifest were not found")
+            if not quiet:
+                for log_file in missing:
+                    print(f"  - {log_file}")
+    print(f"Found {len(log_files)} of the {len(manifest)} logs in the manifest")
+    return log_files
+
+
+def find_build_metrics(artifact_path: str) -> dict[str, dict]:
+    """Read the metrics files of the jobs in the artifact path, by log file name"""
+    metrics_files = glob(
+        os.path.join(escape(artifact_path), "**", f"*{BUILD_METRICS_FILE_SUFFIX}"),
+        recursive=True,
+    )
+    build_metrics = read_build_metrics(metrics_files)
+    print(
+        f"Found the metrics of {len(build_metrics)} builds "
+        f"in {len(metrics_files)} metrics files"
+    )
+    return build_metrics
+
+
+def needs_log(build_metrics: dict | None) -> bool:
+    """Check if the log of a build has to be parsed for its results"""
+    return build_metrics is None or any(
+        build_metrics.get(k) is None for k in SIZE_COLUMNS
+    )
+
+
+def read_log(log_file: str, pio_log: bool) -> dict[str, int | None] | None:
+    """Parse the build results from a PlatformIO log or an Arduino CLI JSON output"""
+    if pio_log:
+        return read_pio_log(log_file)
+    with open(log_file, "r") as f:
+        try:
+            return parse_arduino_output(json.load(f))
+        except json.JSONDecodeError:
+            return {"success": False}
+
+
+def parse_log_file(
+    log_file: str | None, build_metrics: dict | None = None
+) -> tuple[dict, tuple | None]:
+    """
+    Get the results of one build, from its metrics and its log.
+
+    If there are metrics, the success is from the exit code, and the log is only
+    parsed for the RAM and flash use if they are not in the metrics. Otherwise the
+    job info is guessed from the name of the log, the results are parsed from the
+    log, and the build duration is read from its sidecar file.
+
+    Returns:
+        tuple: The job info and build results, and the build duration as
+        (key, toolchain, seconds), or None if there is no duration
+    """
+    if build_metrics is None:
+        assert log_file is not None
+        job_info = get_job_info_from_filename(log_file)
+        toolchain = "platformio" if is_pio_log(job_info) else "arduino-cli"
+        build_seconds = read_duration_file(get_duration_file_for_log(log_file))
+        parsed_result = read_log(log_file, toolchain == "platformio")
+    else:
+        job_info = get_job_info_from_metrics(build_metrics)
+        toolchain = build_metrics["toolchain"]
+        # only the compiles that were run, and not reused from the cache, are timed
+        build_seconds = (
+            build_metrics["seconds"]
+            if build_metrics["exit_code"] == 0 and not build_metrics["cached"]
+            else None
+        )
+        parsed_result = {k: build_metrics.get(k) for k in SIZE_COLUMNS}
+        parsed_result["success"] = build_metrics["exit_code"] == 0
+        if log_file is not None and needs_log(build_metrics):
+            log_result = read_log(log_file, toolchain == "platformio")
+            if log_result is not None:
+                parsed_result.update({k: log_result.get(k) for k in SIZE_COLUMNS})
+        log_file = log_file or build_metrics["log_file"]
+
+    build_duration = None
+    if build_seconds is not None:
+        job_info["build_seconds"] = build_seconds
+        build_duration = (get_duration_key(log_file), toolchain, build_seconds)
     if parsed_result is not None:
         job_info.update(parsed_result)
-    log_results.append(job_info)
-
-print(f"Final log results: {len(log_results)} entries")
-df = pd.DataFrame(log_results)
+    return job_info, build_duration
 
 
-df["flash_percent"] = df.apply(
-    lambda row: (
-        (row["flash_used"] / row["flash_total"] * 100) if row["flash_total"] else None
-    ),
-    axis=1,
-)
-df["flash_percent"] = df["flash_percent"].round(1)
-df["ram_percent"] = df.apply(
-    lambda row: (
-        (row["ram_used"] / row["ram_total"] * 100) if row["ram_total"] else None
-    ),
-    axis=1,
-)
-df["ram_percent"] = df["ram_percent"].round(1)
-df["success"] = df["success"].fillna(2).astype(int)
-# sort with failures at the top, then by board, example, flag, and compiler
-df = df.sort_values(
-    by=["success", "board", "example"]
-    + [col for col in df.columns if col.startswith("flag_")]
-    + ["compiler"],
-)
-df["success"] = df["success"].replace(
-    {2: ":black_circle:", 1: ":heavy_check_mark:", 0: ":x:"}
-)
+def parse_log_files(
+    log_files: list[str | None],
+    build_metrics: list[dict | None],
+    workers: int | None = None,
+) -> list[tuple[dict, tuple | None]]:
+    """
+    Get the results of the builds, in order. The logs that have to be parsed are
+    spread across a process pool if there are many.
+    """
+    workers = workers or os.cpu_count() or 1
+    results: list = [None] * len(log_files)
+    to_parse = []
+    for n, (log_file, metrics) in enumerate(zip(log_files, build_metrics)):
+        if log_file is not None and needs_log(metrics):
+            to_parse.append(n)
+        else:
+            results[n] = parse_log_file(log_file, metrics)
+    if workers < 2 or len(to_parse) <= MIN_LOGS_FOR_POOL:
+        for n in to_parse:
+            results[n] = parse_log_file(log_files[n], build_metrics[n])
+        return results
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        parsed = executor.map(
+            parse_log_file,
+            [log_files[n] for n in to_parse],
+            [build_metrics[n] for n in to_parse],
+            chunksize=max(1, len(to_parse) // (workers * 4)),
+        )
+        for n, result in zip(to_parse, parsed):
+            results[n] = result
+    return results
 
 
 # %%
-display_columns = ["compiler", "example", "board"]
-display_columns += [col for col in df.columns if col.startswith("flag_")]
-display_columns += [
-    "success",
-    "ram_used",
-    "ram_percent",
-    "flash_used",
-    "flash_percent",
-]
-md_table = df[display_columns].to_markdown(index=False, tablefmt="github")
+def main(argv: list[str] | None = None) -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument(
+        "--quiet",
+        help="do not print the parsed result of every log",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--workers",
+        help="number of processes to parse the logs with (default: one per CPU)",
+        type=int,
+        default=None,
+    )
+    parser.add_argument(
+        "--history-file",
+        help="the build history database to add the results to (empty for none)",
+        type=str,
+        default=os.environ.get("BUILD_HISTORY_FILE", DEFAULT_HISTORY_FILE),
+    )
+    parser.add_argument(
+        "--flash-threshold",
+        help="flash use growth, in percent, to report",
+        type=float,
+        default=DEFAULT_FLASH_THRESHOLD,
+    )
+    parser.add_argument(
+        "--ram-threshold",
+        help="RAM use growth, in percent, to report",
+        type=float,
+        default=DEFAULT_RAM_THRESHOLD,
+    )
+    parser.add_argument(
+        "--time-threshold",
+        help="build time growth, in percent, to report",
+        type=float,
+        default=DEFAULT_TIME_THRESHOLD,
+    )
+    args = parser.parse_args(argv)
 
-print("\n\n### Summary of Build Results\n")
-print(md_table)
+    workspace_path = get_workspace_path()
+    print(f"Workspace Path: {workspace_path}")
+    artifact_path = get_artifact_path(workspace_path)
+    print(f"Artifact Path: {artifact_path}")
 
+    # merge the metrics of the builds with their logs
+    build_metrics = find_build_metrics(artifact_path)
+    log_files: list[str | None] = []
+    metrics: list[dict | None] = []
+    build_names: list[str] = []
+    for log_file in find_log_files(artifact_path, args.quiet):
+        log_files.append(log_file)
+        metrics.append(build_metrics.pop(os.path.basename(log_file), None))
+        build_names.append(log_file)
+    # the builds with metrics, but without a log
+    for log_name, build in build_metrics.items():
+        log_files.append(None)
+        metrics.append(build)
+        build_names.append(log_name)
+    log_results = []
+    build_durations = []
+    for build_name, (job_info, build_duration) in zip(
+        build_names, parse_log_files(log_files, metrics, args.workers)
+    ):
+        if not args.quiet:
+            print(f"Parsed result for {build_name}: {job_info}")
+        log_results.append(job_info)
+        if build_duration is not None:
+            build_durations.append(build_duration)
 
-# %%
-if "GITHUB_WORKSPACE" in os.environ.keys():
-    with open(os.environ["GITHUB_STEP_SUMMARY"], "a") as fh:
-        fh.write("\n\n### Summary of Build Results\n")
-        fh.write(md_table)
+    print(f"Final log results: {len(log_results)} entries")
+    if len(log_results) == 0:
+        print("::warning::No build results to summarize")
+        return 0
+
+    # save the build durations for packing the jobs of later runs
+    durations_file = os.environ.get("BUILD_DURATIONS_FILE", DEFAULT_DURATIONS_FILE)
+    if len(build_durations) > 0:
+        update_build_durations(durations_file, build_durations)
+        print(f"Saved {len(build_durations)} build durations to {durations_file}")
+
+    df = summarize_log_results(log_results)
+
+    os.makedirs(artifact_path, exist_ok=True)
+    results_file = os.path.join(artifact_path, RESULTS_TABLE_FILE_NAME)
+    if save_results_table(df, results_file):
+        print(f"Saved the build results table to {results_file}")
+
+    display_columns = ["compiler", "example", "board"]
+    display_columns += [col for col in df.columns if col.startswith("flag_")]
+    display_columns += [
+        "success",
+        "ram_used",
+        "ram_percent",
+        "flash_used",
+        "flash_percent",
+    ]
+    if "build_seconds" in df.columns:
+        display_columns.append("build_seconds")
+    md_table = (
+        df[display_columns]
+        .assign(success=df["success"].map(SUCCESS_SYMBOLS))
+        .to_markdown(index=False, tablefmt="github")
+    )
+
+    print("\n\n### Summary of Build Results\n")
+    print(md_table)
+
+    if "GITHUB_WORKSPACE" in os.environ.keys():
+        with open(os.environ["GITHUB_STEP_SUMMARY"], "a") as fh:
+            fh.write("\n\n### Summary of Build Results\n")
+            fh.write(md_table)
+
+    # add the results to the history, and compare them with the earlier runs
+    if args.history_file != "":
+        history = open_build_history(args.history_file)
+        run_id = append_build_results(history, df)
+        if run_id is not None:
+            print(f"Added the build results to the history in {args.history_file}")
+            report = format_regression_report(
+                find_regressions(
+                    history,
+                    run_id,
+                    flash_threshold=args.flash_threshold,
+                    ram_threshold=args.ram_threshold,
+                    time_threshold=args.time_threshold,
+                )
+            )
+            print(report)
+            if "GITHUB_WORKSPACE" in os.environ.keys():
+                with open(os.environ["GITHUB_STEP_SUMMARY"], "a") as fh:
+                    fh.write(report)
+        history.close()
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
 
 
 # %%
-# cSpell:ignore tablefmt
+# cSpell:ignore tablefmt pyarrow
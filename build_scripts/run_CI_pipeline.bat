@@ -79,6 +79,17 @@ if errorlevel 1 (
     goto :error
 )
 
+REM Run the generated jobs locally (only if --run-jobs or RUN_JOBS=true is set)
+echo.%* | findstr /c:"--run-jobs" >nul && set RUN_JOBS=true
+if /i "%RUN_JOBS%"=="true" (
+    echo.
+    echo Running run_local_jobs.py...
+    python -u "%SCRIPT_DIR%\run_local_jobs.py" %*
+    if errorlevel 1 (
+        echo Warning: run_local_jobs.py reported failed jobs with exit code !errorlevel!
+    )
+)
+
 REM Step 4: Run cleanup (only runs locally, not in GitHub Actions, and only if --cleanup argument is provided)
 echo.
 echo [Step 4] Running cleanup script...
@@ -0,0 +1,277 @@
+#!/usr/bin/env python
+"""
+Run the generated build jobs locally on a pool of workers.
+
+On GitHub Actions, the jobs in arduino_job_matrix.json and pio_job_matrix.json are
+fanned out to separate runners. This script runs the same job scripts on this
+machine instead, for testing the build matrix without pushing.
+
+Each job runs its bash script with its output written to a log in
+<artifact path>/local_job_logs/, and is stopped if it runs longer than the job
+timeout. The jobs for each toolchain (Arduino CLI, PlatformIO) share one package
+directory, so each toolchain is guarded by a lock that only lets a limited number
+of its jobs (--toolchain-slots, default 1) run at the same time. The locks are lock
+files, so they also hold across several copies of this script.
+
+Usage:
+    python run_local_jobs.py [--local-workers N] [--job-timeout SECONDS] [--toolchain-slots N]
+
+This is run after 4_build_jobs.py by generate_job_matrix.py when --run-jobs (or
+RUN_JOBS=true) is set. It is not part of the GitHub workflow.
+"""
+
+# %%
+import os
+import sys
+import time
+import signal
+import tempfile
+import threading
+import subprocess
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+import configargparse
+from build_utils import load_json_file, save_json_file
+from build_config import (
+    ConfigError,
+    get_extended_config,
+    set_verbose_mode,
+    print_verbose,
+)
+
+try:
+    import fcntl
+except ImportError:  # Windows; only jobs in this process are locked
+    fcntl = None
+
+# %%
+# settings
+
+# The job matrices written by 4_build_jobs.py and the toolchain their jobs use
+JOB_MATRIX_FILES = {
+    "arduino_job_matrix.json": "arduino-cli",
+    "pio_job_matrix.json": "platformio",
+}
+# Where the toolchain lock files live
+LOCK_PATH = os.path.join(tempfile.gettempdir(), "envirodiy_ci_locks")
+
+
+# %%
+class ToolchainLocks:
+    """Limit how many jobs may use each toolchain at the same time.
+
+    Jobs in this process wait on a semaphore per toolchain; the slot they take is
+    also held as an exclusive lock on a lock file, so jobs started by another copy
+    of this script wait for it too.
+    """
+
+    def __init__(self, slots: int = 1, lock_path: str = LOCK_PATH):
+        self.slots = max(1, slots)
+        self.lock_path = lock_path
+        self._semaphores: Dict[str, threading.BoundedSemaphore] = {}
+        self._semaphores_lock = threading.Lock()
+
+    def _semaphore(self, toolchain: str) -> threading.BoundedSemaphore:
+        with self._semaphores_lock:
+            if toolchain not in self._semaphores:
+                self._semaphores[toolchain] = threading.BoundedSemaphore(self.slots)
+            return self._semaphores[toolchain]
+
+    @contextmanager
+    def hold(self, toolchain: str):
+        """Wait for a free slot for the toolchain and hold it"""
+        with self._semaphore(toolchain):
+            if fcntl is None:
+                yield
+                return
+            os.makedirs(self.lock_path, exist_ok=True)
+            while True:
+                for slot in range(self.slots):
+                    lock_file = open(
+                        os.path.join(self.lock_path, f"{toolchain}-{slot}.lock"), "w"
+                    )
+                    try:
+                        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    except BlockingIOError:
+                        lock_file.close()
+                        continue
+                    try:
+                        yield
+                    finally:
+                        fcntl.flock(lock_file, fcntl.LOCK_UN)
+                        lock_file.close()
+                    return
+                # every slot is held by another process
+                time.sleep(0.5)
+
+
+class JobProgress:
+    """Print a running summary as the jobs start and finish"""
+
+    def __init__(self, total: int):
+        self.total = total
+        self.running = 0
+        self.finished = 0
+        self.counts: Dict[str, int] = {"passed": 0, "failed": 0, "timed out": 0}
+        self._lock = threading.Lock()
+
+    def summary(self) -> str:
+        counts = ", ".join(f"{k} {v}" for k, v in self.counts.items())
+        waiting = self.total - self.finished - self.running
+        return f"running {self.running}, {counts}, waiting {waiting}"
+
+    def start(self, job: dict) -> None:
+        with self._lock:
+            self.running += 1
+            print_verbose(f"Started {job['job_name']}")
+
+    def finish(self, result: dict) -> None:
+        with self._lock:
+            self.running -= 1
+            self.finished += 1
+            self.counts[result["status"]] += 1
+            mark = "✓" if result["status"] == "passed" else "✗"
+            print(
+                f"[{self.finished:>{len(str(self.total))}}/{self.total}] {mark} "
+                f"{result['job_name']} ({result['seconds']:.1f} s) | {self.summary()}",
+                flush=True,
+            )
+
+
+# %%
+def load_local_jobs(artifact_path: str) -> List[dict]:
+    """Read the job matrices, interleaving the toolchains so both make progress"""
+    jobs_by_toolchain: List[List[dict]] = []
+    for file_name, toolchain in JOB_MATRIX_FILES.items():
+        matrix_file = os.path.join(artifact_path, file_name)
+        if not os.path.isfile(matrix_file):
+            print_verbose(f"No job matrix at {matrix_file}")
+            continue
+        jobs_by_toolchain.append(
+            [dict(job, toolchain=toolchain) for job in load_json_file(matrix_file)]
+        )
+    jobs = []
+    for n in range(max((len(j) for j in jobs_by_toolchain), default=0)):
+        jobs.extend(j[n] for j in jobs_by_toolchain if n < len(j))
+    return jobs
+
+
+def stop_job(process: subprocess.Popen) -> None:
+    """Stop a job script and every command it started"""
+    if os.name == "posix":
+        os.killpg(process.pid, signal.SIGKILL)
+    else:
+        process.kill()
+    process.wait()
+
+
+def run_local_job(
+    job: dict,
+    locks: ToolchainLocks,
+    progress: JobProgress,
+    workspace_path: str,
+    log_path: str,
+    timeout: int | None,
+) -> dict:
+    """Run one job script, holding its toolchain lock, and return the result"""
+    log_file = os.path.join(log_path, f"{job['job_tag']}.log")
+    with locks.hold(job["toolchain"]):
+        progress.start(job)
+        start = time.perf_counter()
+        with open(log_file, "w") as log_out:
+            process = subprocess.Popen(
+                ["bash", job["script"]],
+                cwd=workspace_path,
+                stdout=log_out,
+                stderr=subprocess.STDOUT,
+                # a new session lets a timed out job be stopped with its children
+                start_new_session=os.name == "posix",
+            )
+            try:
+                return_code = process.wait(timeout=timeout)
+                status = "passed" if return_code == 0 else "failed"
+            except subprocess.TimeoutExpired:
+                stop_job(process)
+                return_code = None
+                status = "timed out"
+        result = {
+            "job_name": job["job_name"],
+            "job_tag": job["job_tag"],
+            "toolchain": job["toolchain"],
+            "status": status,
+            "return_code": return_code,
+            "seconds": round(time.perf_counter() - start, 3),
+            "log_file": log_file,
+        }
+        progress.finish(result)
+    return result
+
+
+# %%
+def main(args: configargparse.Namespace | None = None) -> int:
+    """Run the generated jobs locally and save a summary of the results"""
+    print("=" * 60)
+    print("CI Build Pipeline: Run Jobs Locally")
+    print("=" * 60)
+
+    if args is None:
+        print_verbose(
+            "Reading configuration from environment variables, command line arguments, and the config file..."
+        )
+        try:
+            args = get_extended_config()
+        except ConfigError as e:
+            print(f"::error::{e}")
+            return 1
+    set_verbose_mode(args.verbose)
+
+    jobs = load_local_jobs(args.artifact_path)
+    if len(jobs) == 0:
+        print("::warning::No jobs to run!")
+        return 0
+
+    workers = int(args.local_workers) or os.cpu_count() or 1
+    timeout = int(args.job_timeout) or None
+    log_path = os.path.join(args.artifact_path, "local_job_logs")
+    os.makedirs(log_path, exist_ok=True)
+    locks = ToolchainLocks(int(args.toolchain_slots))
+    progress = JobProgress(len(jobs))
+
+    print(f"Jobs to run: {len(jobs)}")
+    print(f"Workers: {workers}")
+    print(f"Jobs per toolchain at once: {locks.slots}")
+    print(f"Job timeout: {f'{timeout} s' if timeout else 'none'}")
+    print(f"Job logs: {log_path}\n")
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(
+            executor.map(
+                lambda job: run_local_job(
+                    job, locks, progress, args.workspace_path, log_path, timeout
+                ),
+                jobs,
+            )
+        )
+    elapsed = time.perf_counter() - start
+
+    results_file = os.path.join(args.artifact_path, "local_job_results.json")
+    save_json_file(results_file, results)
+
+    print("\n=== Local Job Summary ===")
+    print(f"Finished {len(results)} jobs in {elapsed:.1f} s: {progress.summary()}")
+    for result in results:
+        if result["status"] != "passed":
+            print(f"  ✗ {result['job_name']} {result['status']}: {result['log_file']}")
+    print(f"Results saved to: {results_file}")
+
+    return 0 if progress.counts["passed"] == len(results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
+
+
+# %%
+# cSpell:ignore fcntl killpg
@@ -0,0 +1,10 @@
+"""Shared setup for the tests of the CI build pipeline scripts."""
+
+import os
+import sys
+
+# The pipeline scripts are run as scripts, not installed as a package, so they are
+# imported from the folder above this one
+BUILD_SCRIPTS_PATH = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if BUILD_SCRIPTS_PATH not in sys.path:
+    sys.path.insert(0, BUILD_SCRIPTS_PATH)
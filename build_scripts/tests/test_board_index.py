@@ -0,0 +1,133 @@
+"""Tests that the board index resolves names like scanning the board mappings did."""
+
+import json
+import os
+
+import pytest
+
+from build_utils import BoardIndex, index_board_mappings, load_pipeline_stage
+from conftest import BUILD_SCRIPTS_PATH
+
+configure_workspace = load_pipeline_stage(
+    os.path.join(BUILD_SCRIPTS_PATH, "1_configure_workspace.py")
+)
+
+
+def scan_known_dicts(input_item, primary_dict, secondary_dict, return_type):
+    """The matching before the board index: scan the keys, then the values, of each"""
+    for match_dict in [primary_dict, secondary_dict]:
+        for k, v in match_dict.items():
+            if input_item.lower() == k.lower():
+                return k if return_type.lower() == "keys" else v
+        for k, v in match_dict.items():
+            for item in v if isinstance(v, list) else [v]:
+                if input_item.lower() == item.lower():
+                    return k if return_type.lower() == "keys" else item
+    return None
+
+
+def get_arduino_mappings():
+    mapping_file = os.path.join(BUILD_SCRIPTS_PATH, "platformio_to_arduino_boards.json")
+    with open(mapping_file) as f:
+        return configure_workspace.build_arduino_mappings(json.load(f))
+
+
+def get_pio_mappings():
+    # environments named like other boards, boards with more than one environment,
+    # and names that only differ by case
+    pio_env_to_board = {
+        "mayfly": "mayfly",
+        "Mayfly-1": "mayfly",
+        "uno": "uno",
+        "megaatmega2560": "uno",
+        "feather": "adafruit_feather_m0",
+        "FEATHER": "adafruit_feather_m4",
+        "stonefly": "envirodiy_stonefly_m4",
+    }
+    board_to_pio_env: dict = {}
+    for env, board in pio_env_to_board.items():
+        board_to_pio_env.setdefault(board, []).append(env)
+    return pio_env_to_board, board_to_pio_env
+
+
+def get_names(primary_dict, secondary_dict):
+    """Every key and value of the mappings in several cases, and some unknown names"""
+    names = ["not_a_board", "", "arduino:avr"]
+    for match_dict in [primary_dict, secondary_dict]:
+        for k, v in match_dict.items():
+            names.append(k)
+            names.extend(v if isinstance(v, list) else [v])
+    return names + [name.upper() for name in names] + [name.title() for name in names]
+
+
+MAPPINGS = {"fqbn": get_arduino_mappings(), "pio_env": get_pio_mappings()}
+
+
+@pytest.mark.parametrize("target", ["fqbn", "pio_env"])
+@pytest.mark.parametrize("return_type", ["keys", "values", "Keys"])
+def test_index_matches_scan(target, return_type):
+    primary_dict, secondary_dict = MAPPINGS[target]
+    board_index = BoardIndex(
+        {t: index_board_mappings(*MAPPINGS[t]) for t in BoardIndex.TARGETS}
+    )
+    for name in get_names(primary_dict, secondary_dict):
+        expected = scan_known_dicts(name, primary_dict, secondary_dict, return_type)
+        assert board_index.match(target, name, return_type) == expected, name
+        assert (
+            configure_workspace.match_input_with_known_dicts(
+                name, primary_dict, secondary_dict, return_type
+            )
+            == expected
+        ), name
+
+
+def test_resolve_uses_first_match():
+    board_index = BoardIndex(
+        {t: index_board_mappings(*MAPPINGS[t]) for t in BoardIndex.TARGETS}
+    )
+    pio_env_to_board, board_to_pio_env = MAPPINGS["pio_env"]
+    pio_board_to_fqbn, board_to_fqbn = MAPPINGS["fqbn"]
+    for board in ["mayfly", "uno", "adafruit_feather_m0", "feather"]:
+        assert board_index.resolve(board) == {
+            "pio_env": scan_known_dicts(
+                board, pio_env_to_board, board_to_pio_env, "keys"
+            ),
+            "fqbn": scan_known_dicts(board, pio_board_to_fqbn, board_to_fqbn, "values"),
+        }
+    # an environment name is matched before a board of another environment
+    assert board_index.match("pio_env", "uno", "keys") == "uno"
+    assert board_index.match("pio_env", "feather", "keys") == "feather"
+
+
+def test_ambiguous_names():
+    board_index = BoardIndex({"pio_env": index_board_mappings(*MAPPINGS["pio_env"])})
+    ambiguous = board_index.get_ambiguous_names("pio_env", "keys")
+    # the results are in the order they are matched, so the first one is used
+    assert ambiguous["feather"] == [
+        "feather",
+        "FEATHER",
+        "adafruit_feather_m0",
+        "adafruit_feather_m4",
+    ]
+    assert ambiguous["uno"] == ["uno", "megaatmega2560"]
+    assert ambiguous["megaatmega2560"] == ["megaatmega2560", "uno"]
+
+
+def test_save_and_load(tmp_path):
+    board_index = BoardIndex(
+        {t: index_board_mappings(*MAPPINGS[t]) for t in BoardIndex.TARGETS}
+    )
+    index_file = str(tmp_path / "board_index.json")
+    board_index.save(index_file)
+    loaded = BoardIndex.load(index_file)
+    assert loaded.indexes == board_index.indexes
+    for board in ["mayfly", "MAYFLY", "uno", "not_a_board"]:
+        assert loaded.resolve(board) == board_index.resolve(board)
+
+
+def test_load_unknown_version(tmp_path):
+    index_file = str(tmp_path / "board_index.json")
+    with open(index_file, "w") as f:
+        json.dump({"index_version": -1, "pio_env": {}, "fqbn": {}}, f)
+    with pytest.raises(ValueError):
+        BoardIndex.load(index_file)
@@ -0,0 +1,157 @@
+"""Tests of the download cache against a local HTTP server."""
+
+import threading
+import time
+from argparse import Namespace
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import build_cache
+from build_cache import DownloadCache
+
+LAST_MODIFIED = "Wed, 01 Jan 2025 00:00:00 GMT"
+
+
+class FileServer(ThreadingHTTPServer):
+    """Serve one file with an ETag and a modified time, and record the requests"""
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FileRequestHandler)
+        self.content = b'{"version": 1}'
+        self.etag = '"v1"'
+        self.requests = []
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_port}/files/example_boards.json"
+
+
+class FileRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        server = self.server
+        server.requests.append(dict(self.headers))
+        if self.headers.get("If-None-Match") == server.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header("ETag", server.etag)
+        self.send_header("Last-Modified", LAST_MODIFIED)
+        self.send_header("Content-Length", str(len(server.content)))
+        self.end_headers()
+        self.wfile.write(server.content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = FileServer()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def make_cache(tmp_path, **options):
+    options.setdefault("bundled_path", None)
+    return DownloadCache(cache_path=str(tmp_path / "cache"), timeout=5, **options)
+
+
+def expire(cache, url):
+    cache.index[url]["fetched_at"] = time.time() - cache.ttl - 1
+
+
+def test_revalidation(tmp_path, server):
+    cache = make_cache(tmp_path, ttl=0)
+    assert cache.fetch_json(server.url) == {"version": 1}
+    assert "If-None-Match" not in server.requests[0]
+
+    # an unchanged file is revalidated, not downloaded again
+    assert cache.fetch(server.url) == b'{"version": 1}'
+    assert server.requests[1]["If-None-Match"] == '"v1"'
+    assert server.requests[1]["If-Modified-Since"] == LAST_MODIFIED
+
+    # a changed file is downloaded again, by another cache reading the same index
+    server.content = b'{"version": 2}'
+    server.etag = '"v2"'
+    cache = make_cache(tmp_path, ttl=0)
+    assert cache.fetch_json(server.url) == {"version": 2}
+    assert cache.index[server.url]["etag"] == '"v2"'
+    assert len(server.requests) == 3
+
+
+def test_ttl(tmp_path, server):
+    cache = make_cache(tmp_path, ttl=3600)
+    cache.fetch(server.url)
+    server.content = b'{"version": 2}'
+    server.etag = '"v2"'
+    # within the TTL, the cached copy is used without a request
+    assert make_cache(tmp_path, ttl=3600).fetch(server.url) == b'{"version": 1}'
+    assert len(server.requests) == 1
+
+    expire(cache, server.url)
+    assert cache.fetch(server.url) == b'{"version": 2}'
+    assert len(server.requests) == 2
+
+
+def test_offline(tmp_path, server, capsys):
+    cache = make_cache(tmp_path, ttl=0)
+    cache.fetch(server.url)
+    args = Namespace(
+        download_cache_path=str(tmp_path / "cache"),
+        download_cache_ttl=0,
+        offline="true",
+    )
+    offline_cache = build_cache.configure_download_cache(args)
+    try:
+        assert offline_cache.offline
+        assert offline_cache.fetch(server.url) == b'{"version": 1}'
+    finally:
+        build_cache.download_cache = build_cache.DownloadCache()
+    assert len(server.requests) == 1
+    assert "offline mode is enabled" in capsys.readouterr().out
+
+    # with nothing cached or bundled, offline mode cannot get the file
+    with pytest.raises(SystemExit):
+        make_cache(tmp_path / "empty", offline=True).fetch(server.url)
+
+
+def test_stale_copy_on_network_error(tmp_path, server, capsys):
+    cache = make_cache(tmp_path, ttl=0)
+    cache.fetch(server.url)
+    url = server.url
+    server.shutdown()
+    server.server_close()
+    assert make_cache(tmp_path, ttl=0).fetch(url) == b'{"version": 1}'
+    assert "Using a stale cached copy" in capsys.readouterr().out
+
+
+def test_corrupt_cached_copy_is_downloaded_again(tmp_path, server):
+    cache = make_cache(tmp_path, ttl=3600)
+    cache.fetch(server.url)
+    digest = cache.index[server.url]["sha256"]
+    (tmp_path / "cache" / "objects" / digest).write_bytes(b"garbage")
+    assert make_cache(tmp_path, ttl=3600).fetch(server.url) == b'{"version": 1}'
+    # the corrupt copy is not revalidated, since it cannot be used if unchanged
+    assert "If-None-Match" not in server.requests[1]
+
+
+def test_bundled_copy(tmp_path, server, capsys):
+    bundled_path = tmp_path / "bundled"
+    bundled_path.mkdir()
+    (bundled_path / "example_boards.json").write_bytes(b'{"version": 0}')
+    url = server.url
+    server.shutdown()
+    server.server_close()
+    cache = make_cache(tmp_path, bundled_path=str(bundled_path))
+    assert cache.fetch_json(url) == {"version": 0}
+    assert "Using the bundled copy" in capsys.readouterr().out
+    # the bundled copy is not cached as if it were downloaded
+    assert url not in cache.index
+    assert make_cache(tmp_path, offline=True, bundled_path=str(bundled_path)).fetch(
+        url
+    ) == (b'{"version": 0}')
@@ -0,0 +1,98 @@
+"""Tests of the config file that carries the configuration between the stages."""
+
+import json
+
+import configargparse
+import pytest
+
+import build_config
+from build_config import (
+    CONFIG_VERSION,
+    ConfigError,
+    JsonConfigFileParser,
+    read_config_snapshot,
+    write_config_file,
+)
+
+
+def make_args(config_file, **values):
+    return configargparse.Namespace(
+        config_file_path=config_file,
+        artifact_path="/tmp/artifacts",
+        boards_to_build=["mayfly", "stonefly"],
+        final_matrix=[{"board": "mayfly", "example": "examples/ünïcode"}],
+        verbose=False,
+        **values,
+    )
+
+
+def test_round_trip(tmp_path):
+    config_file = str(tmp_path / "matrix_config.json")
+    args = make_args(config_file)
+    write_config_file(args)
+
+    values = read_config_snapshot(config_file)
+    assert values == dict(vars(args), config_version=CONFIG_VERSION)
+    with open(config_file, "rb") as f:
+        assert b"\r\n" not in f.read()
+
+
+def test_parse_file_keeps_the_run_options(tmp_path):
+    config_file = str(tmp_path / "matrix_config.json")
+    write_config_file(make_args(config_file, cleanup=True))
+
+    namespace = configargparse.Namespace(verbose=True, artifact_path="/elsewhere")
+    parsed = JsonConfigFileParser().parse_file(config_file, namespace=namespace)
+    assert parsed.verbose is True
+    # the other values come from the config file, with the booleans as strings
+    assert parsed.artifact_path == "/tmp/artifacts"
+    assert parsed.cleanup == "true"
+    assert parsed.boards_to_build == ["mayfly", "stonefly"]
+
+
+def test_newer_version_is_an_error(tmp_path):
+    config_file = str(tmp_path / "matrix_config.json")
+    with open(config_file, "w") as f:
+        json.dump({"config_version": CONFIG_VERSION + 1}, f)
+    with pytest.raises(ConfigError, match="newer version"):
+        read_config_snapshot(config_file)
+
+
+def test_wrong_types_are_errors(tmp_path):
+    config_file = str(tmp_path / "matrix_config.json")
+    with open(config_file, "w") as f:
+        json.dump({"config_version": CONFIG_VERSION, "final_matrix": "mayfly"}, f)
+    with pytest.raises(ConfigError, match="final_matrix"):
+        read_config_snapshot(config_file)
+
+    args = make_args(config_file)
+    args.artifact_path = 3
+    with pytest.raises(ConfigError, match="artifact_path"):
+        write_config_file(args)
+    # the values are checked before the file is written
+    with open(config_file) as f:
+        assert json.load(f)["final_matrix"] == "mayfly"
+
+
+def test_extended_config_is_read_again_when_the_file_changes(tmp_path, monkeypatch):
+    config_file = str(tmp_path / "matrix_config.json")
+    write_config_file(make_args(config_file))
+    reads = []
+
+    def read_extended_config():
+        reads.append(config_file)
+        return make_args(config_file)
+
+    monkeypatch.setattr(build_config, "read_extended_config", read_extended_config)
+    monkeypatch.setattr(build_config, "extended_config_cache", {})
+
+    first = build_config.get_extended_config()
+    first.boards_to_build.append("uno")
+    second = build_config.get_extended_config()
+    assert len(reads) == 1
+    # each call gets its own copy
+    assert second.boards_to_build == ["mayfly", "stonefly"]
+
+    write_config_file(make_args(config_file, matrix_file_path="build_matrix.jsonl"))
+    build_config.get_extended_config()
+    assert len(reads) == 2
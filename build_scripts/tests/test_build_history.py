@@ -0,0 +1,177 @@
+"""Tests of the build history and of the regressions found in it."""
+
+import pandas as pd
+import pytest
+
+from build_history import (
+    MIN_BASELINE_SECONDS,
+    TIME_BASELINE_RUNS,
+    append_build_results,
+    find_regressions,
+    get_build_flags,
+    open_build_history,
+    query_build_history,
+)
+
+
+def make_results(builds):
+    """A results table like parse_test_results.py makes, from (board, values) pairs"""
+    return pd.DataFrame(
+        [
+            {
+                "compiler": "platformio",
+                "example": "simple_logging",
+                "board": board,
+                "success": True,
+                "ram_used": 1000,
+                "ram_total": 8192,
+                "flash_used": 10000,
+                "flash_total": 131072,
+                "build_seconds": 100.0,
+            }
+            | values
+            for board, values in builds
+        ]
+    )
+
+
+@pytest.fixture
+def connection(tmp_path):
+    connection = open_build_history(str(tmp_path / "build_history.sqlite"))
+    yield connection
+    connection.close()
+
+
+def add_runs(connection, *runs):
+    run_ids = [
+        append_build_results(connection, make_results(builds), f"run-{n}")
+        for n, builds in enumerate(runs)
+    ]
+    return run_ids[-1]
+
+
+def get_regressions(connection, run_id, **thresholds):
+    regressions = find_regressions(connection, run_id, **thresholds)
+    return {
+        (row.board, row.metric): row.growth_percent for row in regressions.itertuples()
+    }
+
+
+def test_size_growth_beyond_threshold(connection):
+    run_id = add_runs(
+        connection,
+        [("mayfly", {}), ("uno", {}), ("stonefly", {})],
+        [
+            ("mayfly", {"flash_used": 10150}),
+            ("uno", {"flash_used": 10050, "ram_used": 1011}),
+            ("stonefly", {"flash_used": 9000}),
+        ],
+    )
+    # 1.5% more flash and 1.1% more RAM are beyond the 1% thresholds; 0.5% is not,
+    # and shrinking is not a regression
+    assert get_regressions(connection, run_id) == {
+        ("mayfly", "flash_used"): 1.5,
+        ("uno", "ram_used"): 1.1,
+    }
+
+
+def test_custom_thresholds(connection):
+    run_id = add_runs(
+        connection,
+        [("mayfly", {})],
+        [("mayfly", {"flash_used": 10150, "build_seconds": 130.0})],
+    )
+    assert get_regressions(
+        connection, run_id, flash_threshold=2.0, time_threshold=25.0
+    ) == {("mayfly", "build_seconds"): 30.0}
+
+
+def test_sizes_compared_with_last_success(connection):
+    run_id = add_runs(
+        connection,
+        [("mayfly", {"flash_used": 10000})],
+        [("mayfly", {"flash_used": 12000})],
+        [("mayfly", {"success": False, "flash_used": None, "ram_used": None})],
+        [("mayfly", {"flash_used": 12600})],
+    )
+    # compared with run-1, the last run that succeeded, not run-0 or the failed run-2
+    assert get_regressions(connection, run_id) == {("mayfly", "flash_used"): 5.0}
+
+
+def test_failed_builds_are_not_compared_by_size(connection):
+    run_id = add_runs(
+        connection,
+        [("mayfly", {})],
+        [("mayfly", {"success": False, "flash_used": 20000})],
+    )
+    assert get_regressions(connection, run_id) == {}
+
+
+def test_build_time_compared_with_average(connection):
+    # a slow run, then enough 100 s runs that it is not in the average any more
+    earlier = [[("mayfly", {"build_seconds": 1000.0})]] + [
+        [("mayfly", {"build_seconds": seconds})]
+        for seconds in [80.0, 120.0] + [100.0] * (TIME_BASELINE_RUNS - 2)
+    ]
+    run_id = add_runs(connection, *earlier, [("mayfly", {"build_seconds": 149.0})])
+    assert get_regressions(connection, run_id) == {}
+
+    run_id = append_build_results(
+        connection, make_results([("mayfly", {"build_seconds": 180.0})]), "run-last"
+    )
+    # the average now has the 149 s run instead of the 80 s one
+    average = (120.0 + 100.0 * (TIME_BASELINE_RUNS - 2) + 149.0) / TIME_BASELINE_RUNS
+    assert get_regressions(connection, run_id) == {
+        ("mayfly", "build_seconds"): round((180.0 / average - 1) * 100, 1)
+    }
+
+
+def test_short_builds_are_not_timed(connection):
+    run_id = add_runs(
+        connection,
+        [("mayfly", {"build_seconds": MIN_BASELINE_SECONDS / 2})],
+        [("mayfly", {"build_seconds": MIN_BASELINE_SECONDS * 2})],
+    )
+    assert get_regressions(connection, run_id) == {}
+
+
+def test_new_builds_are_not_regressions(connection):
+    run_id = add_runs(connection, [("mayfly", {})], [("uno", {"flash_used": 99999})])
+    assert get_regressions(connection, run_id) == {}
+
+
+def test_builds_are_keyed_by_flags(connection):
+    def with_flags(flags, flash_used):
+        df = make_results([("mayfly", {"flash_used": flash_used})])
+        for name, value in flags.items():
+            df[f"flag_{name}"] = value
+        return df
+
+    append_build_results(connection, with_flags({"MODEM": "xbee"}, 10000), "run-0")
+    append_build_results(connection, with_flags({"MODEM": "sim7080"}, 11000), "run-1")
+    run_id = append_build_results(
+        connection, with_flags({"MODEM": "xbee"}, 10500), "run-2"
+    )
+    regressions = find_regressions(connection, run_id)
+    assert regressions["flags"].tolist() == ["MODEM=xbee"]
+    assert regressions["growth_percent"].tolist() == [5.0]
+
+
+def test_build_flags():
+    df = pd.DataFrame(
+        {"flag_b": ["2", None, ""], "flag_a": ["1", "1", None], "other": [1, 2, 3]}
+    )
+    assert get_build_flags(df).tolist() == ["a=1; b=2", "a=1", ""]
+
+
+def test_runs_are_added_once_and_pruned(connection):
+    results = make_results([("mayfly", {}), ("uno", {})])
+    assert append_build_results(connection, results, "run-0") is not None
+    assert append_build_results(connection, results, "run-0") is None
+    for n in range(1, 5):
+        append_build_results(connection, results, f"run-{n}", runs_kept=3)
+
+    history = query_build_history(connection, board="mayfly")
+    assert history["run_name"].tolist() == ["run-2", "run-3", "run-4"]
+    assert len(query_build_history(connection)) == 6
+    assert len(query_build_history(connection, example="other")) == 0
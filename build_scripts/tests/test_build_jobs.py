@@ -0,0 +1,437 @@
+"""Tests of the command blocks and of grouping them into log groups and jobs."""
+
+import os
+import subprocess
+
+import configargparse
+import pytest
+
+from build_utils import (
+    BUILD_METRICS_FILE_SUFFIX,
+    load_json_file,
+    load_pipeline_stage,
+    read_build_metrics,
+)
+from conftest import BUILD_SCRIPTS_PATH
+
+build_jobs = load_pipeline_stage(os.path.join(BUILD_SCRIPTS_PATH, "4_build_jobs.py"))
+
+
+def make_block(matrix_item, toolchain="platformio"):
+    return build_jobs.CommandBlock(
+        matrix_item,
+        output_file_name="log.log",
+        other_commands=["echo other"],
+        build_commands=["pio run"],
+        compile_cache_key_args=[toolchain, "/overlay"],
+    )
+
+
+def test_command_block_fields():
+    block = make_block(
+        {
+            "compiler": "platformio",
+            "board": "mayfly",
+            "inline_defines": ["A", "B"],
+            "build_commands": ["ignored"],
+            "other_commands": ["ignored"],
+        }
+    )
+    assert block.keys() == ["compiler", "board", "inline_defines"]
+    assert block["inline_defines"] == ("A", "B")
+    assert block.other_commands == ("echo other",)
+    assert block.build_commands == ("pio run",)
+    assert "build_commands" not in block
+    with pytest.raises(KeyError):
+        block["example"]
+    # the blocks have no __dict__, only their slots
+    with pytest.raises(AttributeError):
+        block.extra = 1
+
+
+def test_blocks_share_their_values():
+    first = make_block(
+        {"compiler": "platformio", "board": "mayfly", "flags": ["-DA", "-DB"]}
+    )
+    second = make_block(
+        {"compiler": "platformio", "board": "mayfly", "flags": ["-DA", "-DB"]}
+    )
+    assert first["flags"] is second["flags"]
+    assert first.compile_cache_key_args is second.compile_cache_key_args
+    assert first.other_commands is second.other_commands
+
+
+@pytest.mark.parametrize("board_key", ["fqbn", "pio_env"])
+def test_board_from_other_keys(board_key):
+    block = make_block({"compiler": "arduino-cli", board_key: "arduino:avr:uno"})
+    assert "board" in block
+    assert block["board"] == "arduino:avr:uno"
+    assert block.get_values(["compiler", "board"]) == (
+        "arduino-cli",
+        "arduino:avr:uno",
+    )
+
+
+def test_group_values_must_be_set():
+    block = make_block({"compiler": "platformio", "board": None})
+    with pytest.raises(ValueError, match="does not have the key example"):
+        block.get_values(["example"])
+    with pytest.raises(ValueError, match="None value for the key board"):
+        block.get_values(["board"])
+
+
+@pytest.fixture
+def workspace(tmp_path):
+    for example in ["a", "b"]:
+        os.makedirs(tmp_path / "workspace" / "examples" / example)
+        with open(
+            tmp_path / "workspace" / "examples" / example / f"{example}.ino", "w"
+        ) as f:
+            f.write("void setup() {}\nvoid loop() {}\n")
+    os.makedirs(tmp_path / "artifacts")
+    os.makedirs(tmp_path / "ci")
+    return tmp_path
+
+
+def make_args(workspace, **values):
+    matrix = [
+        {
+            "compiler": compiler,
+            "example": f"examples/{example}",
+            "board": board,
+            "inline_defines": [],
+            "compiler_flags": [],
+        }
+        for compiler in ["arduino-cli", "platformio"]
+        for example in ["a", "b"]
+        for board in ["mayfly", "uno"]
+    ]
+    return configargparse.Namespace(
+        **{
+            "workspace_path": str(workspace / "workspace"),
+            "artifact_path": str(workspace / "artifacts"),
+            "ci_path": str(workspace / "ci"),
+            "matrix_file_path": None,
+            "final_matrix": matrix,
+            "arduino_cli_config": "arduino_cli.yaml",
+            "pio_config_file": "platformio.ini",
+            "log_grouping_fields": [],
+            "job_grouping_fields": [],
+            "build_durations_file": "",
+            "job_count": 0,
+            "verbose": False,
+        }
+        | values
+    )
+
+
+def read_job_matrices(workspace):
+    return {
+        toolchain: load_json_file(
+            str(workspace / "artifacts" / f"{toolchain}_job_matrix.json")
+        )
+        for toolchain in ["arduino", "pio"]
+    }
+
+
+def test_jobs_by_compiler_and_board(workspace):
+    assert build_jobs.main(make_args(workspace)) == 0
+    job_matrices = read_job_matrices(workspace)
+    assert [job["job_tag"] for job in job_matrices["arduino"]] == [
+        "arduino-cli-mayfly",
+        "arduino-cli-uno",
+    ]
+    assert [job["job_tag"] for job in job_matrices["pio"]] == [
+        "platformio-mayfly",
+        "platformio-uno",
+    ]
+    for job in job_matrices["arduino"] + job_matrices["pio"]:
+        assert job["cache_tag"] == job["job_tag"]
+        with open(job["script"]) as f:
+            script = f.read()
+        # every job builds both examples, in their own log groups
+        assert script.count("echo ::group::") == 2
+
+
+def test_log_groups_must_refine_jobs(workspace):
+    args = make_args(workspace, log_grouping_fields=["compiler", "example"])
+    with pytest.raises(ValueError, match="log grouping fields must include"):
+        build_jobs.main(args)
+
+
+def test_log_groups_must_not_mix_toolchains(workspace):
+    with open(workspace / "ci" / "build_job_matrix.py", "w") as f:
+        f.write(
+            "def get_job_group_fields(command_block):\n"
+            "    return {'board': command_block['board']}\n"
+            "\n"
+            "def get_log_group_fields(command_block):\n"
+            "    return {'board': command_block['board'],\n"
+            "            'example': command_block['example']}\n"
+        )
+    with pytest.raises(ValueError, match="both arduino-cli and platformio"):
+        build_jobs.main(make_args(workspace))
+
+
+def test_custom_groups_that_refine_the_jobs(workspace):
+    with open(workspace / "ci" / "build_job_matrix.py", "w") as f:
+        f.write(
+            "def get_job_group_fields(command_block):\n"
+            "    return {'compiler': command_block['compiler']}\n"
+            "\n"
+            "def get_log_group_fields(command_block):\n"
+            "    return {'compiler': command_block['compiler'],\n"
+            "            'example': command_block['example']}\n"
+        )
+    assert build_jobs.main(make_args(workspace)) == 0
+    job_matrices = read_job_matrices(workspace)
+    assert [job["job_tag"] for job in job_matrices["arduino"]] == ["arduino-cli"]
+    assert [job["job_tag"] for job in job_matrices["pio"]] == ["platformio"]
+
+
+FAKE_PIO = """#!/bin/bash
+# a stand-in for PlatformIO that logs each compile and prints the patched sketch
+case "$1" in
+    --version) echo "PlatformIO Core, version 6.1.0" ;;
+    pkg) echo "atmelavr @ 5.0.0" ;;
+    ci)
+        echo "$*" >> "$FAKE_TOOL_CALLS"
+        source_dir="${@: -1}"
+        echo "Compiling $(basename "$source_dir")"
+        cat "$source_dir"/*.ino
+        echo "RAM:   [=         ]  12.5% (used 2048 bytes from 16384 bytes)"
+        echo "Flash: [==        ]  20.0% (used 26214 bytes from 131072 bytes)"
+        exit "${FAKE_TOOL_FAILS:-0}"
+        ;;
+esac
+"""
+
+FAKE_ARDUINO_CLI = """#!/bin/bash
+# a stand-in for the Arduino CLI that logs each compile
+for arg in "$@"; do
+    case "$arg" in
+        version) echo "arduino-cli Version: 1.0.0"; exit 0 ;;
+        list) echo "arduino:avr 1.8.6"; exit 0 ;;
+        get) echo "$HOME/Arduino"; exit 0 ;;
+        compile)
+            echo "$*" >> "$FAKE_TOOL_CALLS"
+            source_dir="${@: -1}"
+            echo '{"compiler_out": "'"$(basename "$source_dir")"'", "success": true}'
+            exit "${FAKE_TOOL_FAILS:-0}"
+            ;;
+    esac
+done
+"""
+
+
+@pytest.fixture
+def compile_workspace(workspace):
+    bin_path = workspace / "bin"
+    bin_path.mkdir()
+    for name, script in [("pio", FAKE_PIO), ("arduino-cli", FAKE_ARDUINO_CLI)]:
+        (bin_path / name).write_text(script)
+        (bin_path / name).chmod(0o755)
+    (workspace / "workspace" / "platformio.ini").write_text("[platformio]\n")
+    (workspace / "workspace" / "arduino_cli.yaml").write_text("board_manager:\n")
+    return workspace
+
+
+def make_compile_args(workspace, compiler, inline_defines):
+    matrix = [
+        {
+            "compiler": compiler,
+            "example": "examples/a",
+            "board": "mayfly",
+            "inline_defines": inline_defines,
+            "compiler_flags": [],
+        }
+    ]
+    return make_args(
+        workspace,
+        final_matrix=matrix,
+        arduino_cli_config=str(workspace / "workspace" / "arduino_cli.yaml"),
+        pio_config_file=str(workspace / "workspace" / "platformio.ini"),
+    )
+
+
+def run_compile_job(workspace, compiler, inline_defines=[], fails=False):
+    """Generate the job script of one build, run it, and return its log and metrics"""
+    for file_name in os.listdir(workspace / "artifacts"):
+        if not os.path.isdir(workspace / "artifacts" / file_name):
+            os.remove(workspace / "artifacts" / file_name)
+    args = make_compile_args(workspace, compiler, inline_defines)
+    assert build_jobs.main(args) == 0
+    toolchain = "arduino" if compiler == "arduino-cli" else "pio"
+    (job,) = read_job_matrices(workspace)[toolchain]
+    env = dict(
+        os.environ,
+        PATH=f"{workspace / 'bin'}{os.pathsep}{os.environ['PATH']}",
+        HOME=str(workspace),
+        COMPILE_CACHE_PATH=str(workspace / "compile_cache"),
+        FAKE_TOOL_CALLS=str(workspace / "calls.txt"),
+        FAKE_TOOL_FAILS="1" if fails else "0",
+    )
+    env.pop("RUNNER_DEBUG", None)
+    result = subprocess.run(
+        ["bash", job["script"]],
+        cwd=workspace / "workspace",
+        env=env,
+        capture_output=True,
+    )
+    assert result.returncode == (1 if fails else 0), result.stderr.decode()
+    (metrics,) = read_build_metrics(
+        [str(workspace / "artifacts" / f"{job['job_tag']}{BUILD_METRICS_FILE_SUFFIX}")]
+    ).values()
+    with open(workspace / "artifacts" / metrics["log_file"], "rb") as f:
+        return f.read(), metrics
+
+
+def count_compiles(workspace):
+    if not os.path.isfile(workspace / "calls.txt"):
+        return 0
+    with open(workspace / "calls.txt") as f:
+        return len(f.readlines())
+
+
+@pytest.mark.skipif(os.name != "posix", reason="job scripts need bash")
+@pytest.mark.parametrize("compiler", ["platformio", "arduino-cli"])
+def test_compile_cache(compile_workspace, compiler):
+    log, metrics = run_compile_job(compile_workspace, compiler, ["FOO=1"])
+    assert metrics["cached"] is False
+    assert metrics["exit_code"] == 0
+    assert count_compiles(compile_workspace) == 1
+
+    # an identical compile is replayed, with the same log
+    cached_log, cached_metrics = run_compile_job(compile_workspace, compiler, ["FOO=1"])
+    assert cached_metrics["cached"] is True
+    assert cached_metrics["exit_code"] == 0
+    assert cached_log == log
+    assert count_compiles(compile_workspace) == 1
+    if compiler == "platformio":
+        assert b"#define FOO 1" in log
+        assert cached_metrics["ram_used"] == metrics["ram_used"] == 2048
+
+    # a different inline define is compiled
+    _, metrics = run_compile_job(compile_workspace, compiler, ["FOO=2"])
+    assert metrics["cached"] is False
+    assert count_compiles(compile_workspace) == 2
+
+    # a changed example is compiled
+    with open(compile_workspace / "workspace" / "examples" / "a" / "a.h", "w") as f:
+        f.write("#define BAR 1\n")
+    _, metrics = run_compile_job(compile_workspace, compiler, ["FOO=2"])
+    assert metrics["cached"] is False
+    assert count_compiles(compile_workspace) == 3
+    _, metrics = run_compile_job(compile_workspace, compiler, ["FOO=2"])
+    assert metrics["cached"] is True
+    assert count_compiles(compile_workspace) == 3
+
+
+@pytest.mark.skipif(os.name != "posix", reason="job scripts need bash")
+def test_failed_compiles_are_not_cached(compile_workspace):
+    _, metrics = run_compile_job(compile_workspace, "platformio", fails=True)
+    assert metrics["exit_code"] == 1
+    assert metrics["cached"] is False
+    _, metrics = run_compile_job(compile_workspace, "platformio", fails=True)
+    assert metrics["cached"] is False
+    assert count_compiles(compile_workspace) == 2
+    assert not os.path.isdir(compile_workspace / "compile_cache") or (
+        os.listdir(compile_workspace / "compile_cache") == []
+    )
+
+    # the compile is cached once it succeeds
+    run_compile_job(compile_workspace, "platformio")
+    _, metrics = run_compile_job(compile_workspace, "platformio")
+    assert metrics["cached"] is True
+    assert count_compiles(compile_workspace) == 3
+
+
+@pytest.mark.skipif(os.name != "posix", reason="job scripts need bash")
+def test_items_patch_their_own_overlays(compile_workspace):
+    example_path = compile_workspace / "workspace" / "examples" / "a"
+    (example_path / "a.h").write_text("#define BAR 1\n")
+    sketch = (example_path / "a.ino").read_text()
+    args = make_compile_args(compile_workspace, "platformio", [])
+    args.final_matrix = [
+        dict(args.final_matrix[0], inline_defines=[define])
+        for define in ["FOO=1", "FOO=2"]
+    ]
+    assert build_jobs.main(args) == 0
+    (job,) = read_job_matrices(compile_workspace)["pio"]
+    result = subprocess.run(
+        ["bash", job["script"]],
+        cwd=compile_workspace / "workspace",
+        env=dict(
+            os.environ,
+            PATH=f"{compile_workspace / 'bin'}{os.pathsep}{os.environ['PATH']}",
+            HOME=str(compile_workspace),
+            COMPILE_CACHE="false",
+            FAKE_TOOL_CALLS=str(compile_workspace / "calls.txt"),
+        ),
+        capture_output=True,
+    )
+    assert result.returncode == 0, result.stderr.decode()
+
+    overlays = sorted(
+        os.path.join(dir_path, "a")
+        for dir_path in (compile_workspace / "artifacts" / "example_overlays").glob("*")
+    )
+    assert len(overlays) == 2
+    with open(compile_workspace / "calls.txt") as f:
+        assert sorted(line.split()[-1] for line in f) == overlays
+    patched = []
+    for overlay in overlays:
+        with open(os.path.join(overlay, "a.ino")) as f:
+            overlay_sketch = f.read()
+        assert overlay_sketch.endswith(sketch)
+        patched.append(overlay_sketch[: -len(sketch)])
+        # the other files are linked to the checked out ones, not copied
+        assert os.path.samefile(os.path.join(overlay, "a.h"), example_path / "a.h")
+    assert sorted(patched) == [
+        "#if !defined(FOO)\n#define FOO 1\n#endif\n\n",
+        "#if !defined(FOO)\n#define FOO 2\n#endif\n\n",
+    ]
+    assert (example_path / "a.ino").read_text() == sketch
+
+
+@pytest.mark.parametrize(
+    "command, expected",
+    [
+        ("cp /ws/ex/a/config.h /tmp", "cp /ov/a/config.h /tmp"),
+        ("ls /ws/ex/a", "ls /ov/a"),
+        ("ls /ws/ex/a /ws/ex/a", "ls /ov/a /ov/a"),
+        ('cat "/ws/ex/a/a.ino"', 'cat "/ov/a/a.ino"'),
+        ("cat '/ws/ex/a'", "cat '/ov/a'"),
+        ('cd "/ws/ex/a"; ls', 'cd "/ov/a"; ls'),
+        ("ls /ws/ex/a\\b.h", "ls /ov/a\\b.h"),
+        # another example that starts with the same path is left alone
+        ("ls /ws/ex/ab /ws/ex/a-b/a.ino", "ls /ws/ex/ab /ws/ex/a-b/a.ino"),
+        ("ls /ws/ex/a.ino", "ls /ws/ex/a.ino"),
+        ("ls /ws/ex/ab /ws/ex/a", "ls /ws/ex/ab /ov/a"),
+    ],
+)
+def test_retarget_example_path(command, expected):
+    assert build_jobs.retarget_example_path(command, "/ws/ex/a", "/ov/a") == expected
+
+
+def test_retarget_example_path_with_special_characters():
+    assert (
+        build_jobs.retarget_example_path(
+            "cp /ws/ex/a+b (1)/x.h .", "/ws/ex/a+b (1)", r"/ov/a\1"
+        )
+        == r"cp /ov/a\1/x.h ."
+    )
+
+
+def test_interned_values_are_kept_for_one_run(workspace):
+    args = make_args(workspace)
+    for matrix_item in args.final_matrix:
+        matrix_item["inline_defines"] = ["FIRST_RUN"]
+    assert build_jobs.main(args) == 0
+    assert ("FIRST_RUN",) in build_jobs.interned_values
+
+    assert build_jobs.main(make_args(workspace)) == 0
+    assert ("FIRST_RUN",) not in build_jobs.interned_values
+    interned_count = len(build_jobs.interned_values)
+    assert build_jobs.main(make_args(workspace)) == 0
+    assert len(build_jobs.interned_values) == interned_count
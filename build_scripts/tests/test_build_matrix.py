@@ -0,0 +1,69 @@
+"""Tests of building the default matrix, and of the incremental builds."""
+
+import os
+
+from build_utils import load_pipeline_stage
+from conftest import BUILD_SCRIPTS_PATH
+
+build_matrix = load_pipeline_stage(
+    os.path.join(BUILD_SCRIPTS_PATH, "3_build_matrix.py")
+)
+
+EXAMPLES = [f"examples/example_{n}" for n in range(6)]
+
+
+def make_config(**values):
+    return {
+        "workspace_path": "/workspace",
+        "examples_to_build": EXAMPLES,
+        "build_envs": ["mayfly", "stonefly"],
+        "build_fqbns": ["EnviroDIY:avr:envirodiy_mayfly"],
+        "inline_defines": [[]],
+        "compiler_flags": [[]],
+    } | values
+
+
+def build(config):
+    counts: dict = {}
+    matrix = list(build_matrix.iter_default_matrix(config, counts))
+    return matrix, counts
+
+
+def test_full_matrix():
+    matrix, counts = build(make_config())
+    assert len(matrix) == len(EXAMPLES) * 3
+    assert counts["possible"] == counts["filtered"] == counts["final"] == len(matrix)
+    assert counts["affected"] == len(matrix)
+    assert counts["canary"] == 0
+
+
+def test_exclusions():
+    matrix, counts = build(make_config(matrix_exclusions=[{"pio_env": "stonefly"}]))
+    assert len(matrix) == len(EXAMPLES) * 2
+    assert counts["possible"] == len(EXAMPLES) * 3
+    assert counts["filtered"] == counts["final"] == len(matrix)
+
+
+def test_incremental_matrix():
+    config = make_config(
+        incremental_build=True,
+        affected_examples=[EXAMPLES[1]],
+        canary_count=2,
+        diff_base="origin/main",
+    )
+    matrix, counts = build(config)
+    affected = [e for e in matrix if e["example"] == EXAMPLES[1]]
+    assert len(affected) == counts["affected"] == 3
+    assert len(matrix) - len(affected) == counts["canary"] == 2
+    assert counts["final"] == len(matrix)
+    # the same change picks the same canaries
+    assert build(config)[0] == matrix
+
+
+def test_incremental_matrix_without_affected_examples():
+    matrix, counts = build(
+        make_config(incremental_build="true", affected_examples=[], canary_count=0)
+    )
+    assert matrix == []
+    assert counts["affected"] == counts["canary"] == counts["final"] == 0
+    assert counts["filtered"] == len(EXAMPLES) * 3
@@ -0,0 +1,155 @@
+"""Tests of packing the log groups into jobs by their expected durations."""
+
+import os
+import random
+
+import pytest
+
+from build_scheduler import (
+    DEFAULT_BUILD_SECONDS,
+    BuildCostModel,
+    pack_jobs,
+    simulate_makespan,
+    update_build_durations,
+)
+from build_utils import load_pipeline_stage
+from conftest import BUILD_SCRIPTS_PATH
+
+
+def make_units(costs_by_affinity, toolchain="platformio"):
+    return [
+        {
+            "log_group": f"{affinity}-{n}",
+            "toolchain": toolchain,
+            "affinity": affinity,
+            "affinity_name": affinity,
+            "cost": cost,
+        }
+        for affinity, costs in costs_by_affinity.items()
+        for n, cost in enumerate(costs)
+    ]
+
+
+def get_log_groups(jobs):
+    return sorted(unit["log_group"] for job in jobs for unit in job)
+
+
+def get_job_costs(jobs):
+    return [sum(unit["cost"] for unit in job) for job in jobs]
+
+
+def test_every_unit_is_packed_once():
+    rng = random.Random(1)
+    units = make_units(
+        {f"board{b}": [rng.uniform(5, 300) for _ in range(10)] for b in range(12)}
+    ) + make_units({"uno": [30, 40], "mayfly": [50]}, toolchain="arduino-cli")
+    jobs = pack_jobs(units, 7)
+
+    assert len(jobs) == 7
+    assert get_log_groups(jobs) == sorted(unit["log_group"] for unit in units)
+    for job in jobs:
+        assert len({unit["toolchain"] for unit in job}) == 1
+        # the units keep their original order in each job
+        indexes = [unit["index"] for unit in job]
+        assert indexes == sorted(indexes)
+
+
+def test_every_toolchain_gets_a_job():
+    units = make_units({"mayfly": [100, 100]}) + make_units(
+        {"uno": [1]}, toolchain="arduino-cli"
+    )
+    jobs = pack_jobs(units, 1)
+    assert len(jobs) == 2
+    assert sorted(job[0]["toolchain"] for job in jobs) == ["arduino-cli", "platformio"]
+
+
+def test_affinity_groups_stay_together():
+    units = make_units({"mayfly": [10, 10, 10], "uno": [15, 15], "stonefly": [30]})
+    jobs = pack_jobs(units, 3)
+    for job in jobs:
+        assert len({unit["affinity"] for unit in job}) == 1
+    assert sorted(get_job_costs(jobs)) == [30, 30, 30]
+
+
+def test_long_affinity_group_is_split():
+    units = make_units({"mayfly": [60] * 6, "uno": [30]})
+    jobs = pack_jobs(units, 4)
+    assert len(jobs) == 4
+    # the even share is 97.5 s, so the 360 s of the mayfly builds take four pieces
+    assert max(get_job_costs(jobs)) == 120
+    assert sum(any(unit["affinity"] == "mayfly" for unit in job) for job in jobs) == 4
+
+
+def test_longest_job_is_near_even_share():
+    rng = random.Random(2)
+    units = make_units(
+        {f"board{b}": [rng.uniform(5, 120) for _ in range(8)] for b in range(30)}
+    )
+    job_count = 10
+    jobs = pack_jobs(units, job_count)
+    total = sum(unit["cost"] for unit in units)
+    longest_unit = max(unit["cost"] for unit in units)
+    assert max(get_job_costs(jobs)) <= total / job_count + longest_unit
+    # and sooner than one job per board on the same number of runners
+    per_board = get_job_costs(
+        [[u for u in units if u["affinity"] == f"board{b}"] for b in range(30)]
+    )
+    assert simulate_makespan(get_job_costs(jobs), job_count) < simulate_makespan(
+        per_board, job_count
+    )
+
+
+def test_empty_units():
+    assert pack_jobs([], 4) == []
+
+
+def test_cost_model_estimates():
+    cost_model = BuildCostModel(
+        {
+            "a": {"toolchain": "platformio", "seconds": 10, "samples": 1},
+            "b": {"toolchain": "platformio", "seconds": 30, "samples": 2},
+            "c": {"toolchain": "platformio", "seconds": 50, "samples": 1},
+        }
+    )
+    assert cost_model.estimate("b", "platformio") == 30
+    # a build that was never timed takes the median of its toolchain, or the default
+    assert cost_model.estimate("d", "platformio") == 30
+    assert cost_model.estimate("d", "arduino-cli") == DEFAULT_BUILD_SECONDS
+    assert (cost_model.known, cost_model.unknown) == (1, 2)
+
+
+def test_durations_are_a_moving_average(tmp_path):
+    durations_file = str(tmp_path / "cache" / "build_durations.json")
+    update_build_durations(durations_file, [("a", "platformio", 100.0)])
+    durations = update_build_durations(
+        durations_file, [("a", "platformio", 50.0), ("b", "arduino-cli", 20.0)]
+    )
+    assert durations["a"] == {"toolchain": "platformio", "seconds": 75.0, "samples": 2}
+    assert durations["b"] == {"toolchain": "arduino-cli", "seconds": 20.0, "samples": 1}
+    assert os.listdir(str(tmp_path / "cache")) == ["build_durations.json"]
+
+
+@pytest.fixture(scope="module")
+def build_jobs():
+    return load_pipeline_stage(os.path.join(BUILD_SCRIPTS_PATH, "4_build_jobs.py"))
+
+
+def test_packed_jobs_are_cached_by_their_longest_grouping(build_jobs):
+    units = make_units({"mayfly": [100, 50], "uno": [40], "stonefly": [120]})
+    grouped_command_matrix = {
+        unit["log_group"]: {"group_commands": [f"echo {unit['log_group']}"]}
+        for unit in units
+    }
+    job_matrix = build_jobs.create_packed_job_matrix(grouped_command_matrix, units, 2)
+    assert len(job_matrix) == 2
+    for job in job_matrix.values():
+        affinities = {
+            unit["affinity"]
+            for unit in units
+            if f"echo {unit['log_group']}" in job["job_command"]
+        }
+        assert job["cache_tag"] in affinities
+    assert sorted(job["cache_tag"] for job in job_matrix.values()) == [
+        "mayfly",
+        "stonefly",
+    ]
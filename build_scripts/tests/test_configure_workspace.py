@@ -0,0 +1,232 @@
+"""Tests of finding the examples affected by the changes in a git repository."""
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+from argparse import Namespace
+
+import pytest
+
+from build_utils import load_pipeline_stage
+from conftest import BUILD_SCRIPTS_PATH
+
+configure_workspace = load_pipeline_stage(
+    os.path.join(BUILD_SCRIPTS_PATH, "1_configure_workspace.py")
+)
+
+LIBRARY_FILES = {
+    "library.properties": "name=Example\n",
+    "README.md": "# Example\n",
+    "src/Sensor.h": "#pragma once\nint read_sensor();\n",
+    "src/Sensor.cpp": '#include "Sensor.h"\nint read_sensor() { return 1; }\n',
+    "src/Logger.h": '#pragma once\n#include "sensors/../Sensor.h"\n',
+    "src/Unused.h": "#pragma once\n",
+    "examples/reads/reads.ino": "#include <Sensor.h>\nvoid setup() {}\n",
+    "examples/logs/logs.ino": '#include "Logger.h"\nvoid setup() {}\n',
+    "examples/logs/config.h": "#define INTERVAL 5\n",
+    "examples/blinks/blinks.ino": "#include <Unused.h>\nvoid setup() {}\n",
+    "examples/old/old.ino": "void setup() {}\n",
+    # the include index skips the CI folder
+    "continuous_integration/Sensor.h": "#pragma once\n",
+    "continuous_integration/platformio.ini": "[platformio]\n",
+}
+
+
+def git(workspace, *args):
+    subprocess.run(
+        ["git", "-c", "user.name=CI", "-c", "user.email=ci@example.com", *args],
+        cwd=workspace,
+        check=True,
+        capture_output=True,
+    )
+
+
+@pytest.fixture
+def repository(tmp_path):
+    workspace = tmp_path / "workspace"
+    for path, content in LIBRARY_FILES.items():
+        os.makedirs(workspace / os.path.dirname(path), exist_ok=True)
+        (workspace / path).write_text(content)
+    git(workspace, "init", "-q", "-b", "main")
+    git(workspace, "add", ".")
+    git(workspace, "commit", "-q", "-m", "Library")
+    git(workspace, "checkout", "-q", "-b", "feature")
+    return workspace
+
+
+def make_args(workspace, diff_base="main"):
+    return Namespace(
+        workspace_path=str(workspace),
+        ci_path=str(workspace / "continuous_integration"),
+        artifact_path=str(workspace / "continuous_integration_artifacts"),
+        examples_path=str(workspace / "examples"),
+        extras_path=str(workspace / "extras"),
+        # the old example is not built
+        examples_to_build=["examples/reads", "examples/logs", "examples/blinks"],
+        diff_base=diff_base,
+    )
+
+
+def change(workspace, path, commit=True):
+    with open(workspace / path, "a") as f:
+        f.write("// changed\n")
+    if commit:
+        git(workspace, "commit", "-q", "-a", "-m", f"Change {path}")
+
+
+@pytest.mark.parametrize(
+    "path, expected",
+    [
+        ("examples/logs/config.h", ["examples/logs"]),
+        ("examples/reads/reads.ino", ["examples/reads"]),
+        # through the include of Sensor.h in Logger.h
+        ("src/Sensor.h", ["examples/logs", "examples/reads"]),
+        ("src/Sensor.cpp", ["examples/logs", "examples/reads"]),
+        ("src/Logger.h", ["examples/logs"]),
+        ("src/Unused.h", ["examples/blinks"]),
+        ("examples/old/old.ino", []),
+        ("README.md", []),
+        ("library.properties", None),
+        ("continuous_integration/platformio.ini", None),
+    ],
+)
+def test_affected_examples(repository, path, expected):
+    change(repository, path)
+    args = make_args(repository)
+    assert configure_workspace.select_affected_examples(args) == expected
+    assert args.incremental_build == (expected is not None)
+    assert args.affected_examples == (expected or [])
+
+
+def test_uncommitted_changes_and_new_files(repository):
+    change(repository, "src/Logger.h", commit=False)
+    (repository / "examples" / "reads" / "extra.h").write_text("")
+    git(repository, "add", "examples/reads/extra.h")
+    assert configure_workspace.get_changed_files(str(repository), "main") == [
+        "examples/reads/extra.h",
+        "src/Logger.h",
+    ]
+    assert configure_workspace.select_affected_examples(make_args(repository)) == [
+        "examples/logs",
+        "examples/reads",
+    ]
+
+
+def test_changes_on_the_base_branch_are_ignored(repository):
+    git(repository, "checkout", "-q", "main")
+    change(repository, "src/Sensor.h")
+    git(repository, "checkout", "-q", "feature")
+    change(repository, "examples/logs/config.h")
+    assert configure_workspace.get_changed_files(str(repository), "main") == [
+        "examples/logs/config.h"
+    ]
+
+
+def test_include_index(repository):
+    include_index = configure_workspace.build_include_index(make_args(repository))
+    assert include_index == {
+        os.path.join("src", "Sensor.h"): set(),
+        os.path.join("src", "Sensor.cpp"): {"Sensor.h"},
+        os.path.join("src", "Logger.h"): {"Sensor.h"},
+        os.path.join("src", "Unused.h"): set(),
+    }
+
+
+def test_unknown_diff_base_builds_everything(repository, capsys):
+    change(repository, "examples/logs/config.h")
+    args = make_args(repository, diff_base="origin/missing")
+    assert configure_workspace.select_affected_examples(args) is None
+    assert args.incremental_build is False
+    assert "::warning::Unable to find the changes since origin/missing" in (
+        capsys.readouterr().out
+    )
+    assert configure_workspace.select_affected_examples(make_args(repository, "")) is (
+        None
+    )
+
+
+def run_pio_project_config(project_dir):
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-m",
+            "platformio",
+            "project",
+            "config",
+            "--json-output",
+            "--project-dir",
+            str(project_dir),
+        ],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    json_lines = [line for line in result.stdout.splitlines() if line.startswith("[")]
+    return configure_workspace.nested_list_to_dict(json.loads(json_lines[-1]))
+
+
+@pytest.fixture
+def pio_project(tmp_path):
+    shutil.copyfile(
+        os.path.join(BUILD_SCRIPTS_PATH, "platformio.ini"), tmp_path / "platformio.ini"
+    )
+    return tmp_path
+
+
+def test_in_process_config_matches_pio(pio_project):
+    in_process = configure_workspace.read_platformio_config_in_process(str(pio_project))
+    assert len(in_process) > 10
+    assert in_process == run_pio_project_config(pio_project)
+    assert configure_workspace.read_platformio_config(str(pio_project)) == in_process
+
+
+def test_in_process_config_with_extra_configs(pio_project):
+    config = (pio_project / "platformio.ini").read_text()
+    (pio_project / "platformio.ini").write_text(
+        config.replace("[platformio]\n", "[platformio]\nextra_configs = extra/*.ini\n")
+    )
+    os.makedirs(pio_project / "extra")
+    (pio_project / "extra" / "boards.ini").write_text(
+        "[env:extra_board]\nextends = env\nplatform = atmelavr\nboard = uno\n"
+    )
+    in_process = configure_workspace.read_platformio_config_in_process(str(pio_project))
+    assert in_process["env:extra_board"]["board"] == "uno"
+    assert in_process == run_pio_project_config(pio_project)
+
+
+def test_config_key(pio_project):
+    (pio_project / "platformio.ini").write_text(
+        "[platformio]\nextra_configs = extra/*.ini\n\n[env:uno]\nboard = uno\n"
+    )
+    os.makedirs(pio_project / "extra")
+    (pio_project / "extra" / "boards.ini").write_text("[env:mega]\nboard = mega\n")
+    key = configure_workspace.get_platformio_config_key(str(pio_project))
+    assert key is not None
+    assert configure_workspace.get_platformio_config_key(str(pio_project)) == key
+
+    (pio_project / "extra" / "boards.ini").write_text(
+        "[env:mega]\nboard = megaatmega2560\n"
+    )
+    changed_key = configure_workspace.get_platformio_config_key(str(pio_project))
+    assert changed_key not in [None, key]
+
+    # a new file that matches the pattern changes the key too
+    (pio_project / "extra" / "more.ini").write_text("[env:due]\nboard = due\n")
+    assert configure_workspace.get_platformio_config_key(str(pio_project)) not in [
+        None,
+        key,
+        changed_key,
+    ]
+
+    # the output of a config that uses the environment can not be keyed
+    (pio_project / "extra" / "more.ini").write_text(
+        "[env:due]\nboard = ${sysenv.BOARD}\n"
+    )
+    assert configure_workspace.get_platformio_config_key(str(pio_project)) is None
+    (pio_project / "extra" / "more.ini").unlink()
+    (pio_project / "platformio.ini").write_text(
+        "[platformio]\nextra_configs = ${sysenv.EXTRA_CONFIGS}\n"
+    )
+    assert configure_workspace.get_platformio_config_key(str(pio_project)) is None
@@ -0,0 +1,142 @@
+"""Tests of finding the examples, and of when the cached example index is used."""
+
+import os
+
+import pytest
+
+from build_utils import ExampleIndex, load_json_file
+
+
+def add_sketch(folder, name=None, other_files=()):
+    name = name or os.path.basename(folder)
+    os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(folder, name + ".ino"), "w") as f:
+        f.write("void setup() {}\nvoid loop() {}\n")
+    for other_file in other_files:
+        with open(os.path.join(folder, other_file), "w") as f:
+            f.write("")
+
+
+def bump_mtime(directory):
+    """Move a folder's modification time forward, as a change made later would"""
+    mtime_ns = os.stat(directory).st_mtime_ns + 10**9
+    os.utime(directory, ns=(mtime_ns, mtime_ns))
+
+
+@pytest.fixture
+def workspace(tmp_path):
+    examples = tmp_path / "examples"
+    add_sketch(str(examples / "simple_logging"), other_files=["ReadMe.md"])
+    add_sketch(str(examples / "menu_a_la_carte"), other_files=["platformio.ini"])
+    add_sketch(str(examples / "nested" / "inner"))
+    # a sketch that is not named like its folder is not an example
+    add_sketch(str(examples / "misnamed"), name="other")
+    # the excluded folders are not searched
+    add_sketch(str(examples / "archive" / "old"))
+    add_sketch(str(tmp_path / "extras" / "extra_one"))
+    return tmp_path
+
+
+def get_search_paths(workspace):
+    return [str(workspace / "examples"), str(workspace / "extras")]
+
+
+def get_example_names(example_index):
+    return sorted(os.path.basename(e["path"]) for e in example_index.get_examples())
+
+
+def test_finds_examples(workspace):
+    example_index = ExampleIndex(get_search_paths(workspace))
+    assert get_example_names(example_index) == [
+        "extra_one",
+        "inner",
+        "menu_a_la_carte",
+        "simple_logging",
+    ]
+    simple = [
+        e for e in example_index.get_examples() if e["path"].endswith("simple_logging")
+    ][0]
+    assert simple["sketch"] == os.path.join(simple["path"], "simple_logging.ino")
+    assert simple["files"] == ["ReadMe.md"]
+    assert example_index.find_sketch("other.ino") == [
+        str(workspace / "examples" / "misnamed")
+    ]
+    assert example_index.find_sketch("old.ino") == []
+
+
+def test_unchanged_folders_use_cache(workspace, tmp_path):
+    cache_file = str(tmp_path / "cache" / "example_index.json")
+    first = ExampleIndex(get_search_paths(workspace), cache_file=cache_file)
+    assert not first.from_cache
+    assert os.path.isfile(cache_file)
+
+    second = ExampleIndex(get_search_paths(workspace), cache_file=cache_file)
+    assert second.from_cache
+    assert second.get_examples() == first.get_examples()
+
+
+def test_added_example_invalidates_cache(workspace, tmp_path):
+    cache_file = str(tmp_path / "cache" / "example_index.json")
+    ExampleIndex(get_search_paths(workspace), cache_file=cache_file)
+
+    add_sketch(str(workspace / "examples" / "nested" / "inner" / "deeper"))
+    bump_mtime(str(workspace / "examples" / "nested" / "inner"))
+    example_index = ExampleIndex(get_search_paths(workspace), cache_file=cache_file)
+    assert not example_index.from_cache
+    assert "deeper" in get_example_names(example_index)
+    # the new index is saved, so the next one is read from the cache
+    assert ExampleIndex(get_search_paths(workspace), cache_file=cache_file).from_cache
+
+
+def test_removed_file_invalidates_cache(workspace, tmp_path):
+    cache_file = str(tmp_path / "cache" / "example_index.json")
+    ExampleIndex(get_search_paths(workspace), cache_file=cache_file)
+
+    folder = workspace / "examples" / "menu_a_la_carte"
+    os.remove(str(folder / "platformio.ini"))
+    bump_mtime(str(folder))
+    example_index = ExampleIndex(get_search_paths(workspace), cache_file=cache_file)
+    assert not example_index.from_cache
+    menu = [
+        e for e in example_index.get_examples() if e["path"].endswith("menu_a_la_carte")
+    ][0]
+    assert menu["files"] == []
+
+
+def test_removed_folder_invalidates_cache(workspace, tmp_path):
+    cache_file = str(tmp_path / "cache" / "example_index.json")
+    ExampleIndex(get_search_paths(workspace), cache_file=cache_file)
+
+    extras = workspace / "extras"
+    os.remove(str(extras / "extra_one" / "extra_one.ino"))
+    os.rmdir(str(extras / "extra_one"))
+    os.rmdir(str(extras))
+    example_index = ExampleIndex(get_search_paths(workspace), cache_file=cache_file)
+    assert not example_index.from_cache
+    assert "extra_one" not in get_example_names(example_index)
+
+
+def test_other_search_paths_do_not_use_cache(workspace, tmp_path):
+    cache_file = str(tmp_path / "cache" / "example_index.json")
+    ExampleIndex(get_search_paths(workspace), cache_file=cache_file)
+
+    example_index = ExampleIndex([str(workspace / "examples")], cache_file=cache_file)
+    assert not example_index.from_cache
+    assert "extra_one" not in get_example_names(example_index)
+
+    example_index = ExampleIndex(
+        [str(workspace / "examples")], excluded_folders=[], cache_file=cache_file
+    )
+    assert not example_index.from_cache
+    assert "old" in get_example_names(example_index)
+
+
+def test_unreadable_cache_is_rebuilt(workspace, tmp_path):
+    cache_file = str(tmp_path / "cache" / "example_index.json")
+    os.makedirs(os.path.dirname(cache_file))
+    with open(cache_file, "w") as f:
+        f.write("{not json")
+
+    example_index = ExampleIndex(get_search_paths(workspace), cache_file=cache_file)
+    assert not example_index.from_cache
+    assert load_json_file(cache_file)["sketch_folders"] == example_index.sketch_folders
@@ -0,0 +1,237 @@
+"""Tests of resolving the packages to install and of the installation scripts."""
+
+import os
+import subprocess
+from argparse import Namespace
+
+import pytest
+
+from build_utils import load_pipeline_stage
+from conftest import BUILD_SCRIPTS_PATH
+
+install_scripts = load_pipeline_stage(
+    os.path.join(BUILD_SCRIPTS_PATH, "2_generate_install_scripts.py")
+)
+
+
+def test_dependencies_are_resolved_once(capsys):
+    library_dependencies = [
+        {"name": "SDI-12", "owner": "envirodiy", "version": "~2.1.4"},
+        {"name": "RTCZero", "owner": "arduino-libraries", "version": "~1.6.0"},
+        {"name": "SDI-12", "owner": "envirodiy", "version": "~2.1.4"},
+    ]
+    example_dependencies = [
+        {"name": "sdi-12", "owner": "envirodiy", "version": "~2.2.0"},
+        {"name": "RTCZero", "owner": "arduino-libraries", "version": "~1.6.0"},
+        {"name": "Adafruit BusIO", "owner": "adafruit", "version": "~1.16.0"},
+        {
+            "name": "TinyGSM",
+            "owner": "envirodiy",
+            "version": "https://github.com/EnviroDIY/TinyGSM.git",
+        },
+        {
+            "name": "TinyGSM-fork",
+            "owner": "envirodiy",
+            "version": "https://github.com/envirodiy/tinygsm",
+        },
+    ]
+    libraries, examples = install_scripts.resolve_library_dependencies(
+        library_dependencies, example_dependencies
+    )
+    assert libraries == library_dependencies[:2]
+    # the git libraries are keyed by their repository, whatever their names
+    assert examples == [example_dependencies[2], example_dependencies[3]]
+    out = capsys.readouterr().out
+    # the version in library.json wins, with a warning
+    assert out.count("::warning::") == 2
+    assert (
+        "::warning::example_dependencies.json asks for envirodiy/sdi-12@~2.2.0, "
+        "using envirodiy/SDI-12@~2.1.4"
+    ) in out
+
+
+def run_with_lock(tmp_path, lock_key):
+    command = install_scripts.add_lock_to_command(
+        'echo installing >> "$0.calls"\necho done', lock_key
+    )
+    lock_text = install_scripts.LIBRARY_LOCK_TEXT.format(tmp_path / "lock")
+    result = subprocess.run(
+        ["bash", "-ec", lock_text + command, str(tmp_path / "install")],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return result.stdout
+
+
+@pytest.mark.skipif(os.name != "posix", reason="install scripts need bash")
+@pytest.mark.parametrize(
+    "lock_key",
+    [
+        "envirodiy/SDI-12@~2.1.4",
+        "Adafruit BusIO@1.16.0",
+        'it\'s@"$HOME"`true`',
+        "--name=-x",
+    ],
+)
+def test_lock_guard(tmp_path, lock_key):
+    assert run_with_lock(tmp_path, lock_key) == "done\n"
+    assert (tmp_path / "lock").read_text() == lock_key + "\n"
+    assert run_with_lock(tmp_path, lock_key) == f"Already installed: {lock_key}\n"
+    assert (tmp_path / "install.calls").read_text() == "installing\n"
+    assert (tmp_path / "lock").read_text() == lock_key + "\n"
+
+    # another version is not in the lock file yet, and only whole lines match
+    other_key = lock_key + "1"
+    assert run_with_lock(tmp_path, other_key) == "done\n"
+    assert run_with_lock(tmp_path, lock_key[:-1]) == "done\n"
+    assert (tmp_path / "lock").read_text().splitlines() == [
+        lock_key,
+        other_key,
+        lock_key[:-1],
+    ]
+
+
+def test_lock_guard_text():
+    assert install_scripts.add_lock_to_command(
+        'pio pkg install -g --library "envirodiy/SDI-12@~2.1.4"\n\necho ok',
+        "envirodiy/SDI-12@~2.1.4",
+    ) == (
+        "if grep -qxF -- 'envirodiy/SDI-12@~2.1.4' \"$lock_file\"; then\n"
+        "    printf 'Already installed: %s\\n' 'envirodiy/SDI-12@~2.1.4'\n"
+        "else\n"
+        '    pio pkg install -g --library "envirodiy/SDI-12@~2.1.4"\n'
+        "\n"
+        "    echo ok\n"
+        "    printf '%s\\n' 'envirodiy/SDI-12@~2.1.4' >> \"$lock_file\"\n"
+        "fi"
+    )
+
+
+PIO_TOOLS = {
+    "atmelavr": {
+        "name": "Atmel AVR",
+        "tools": ["platformio/toolchain-atmelavr", "platformio/tool-scons"],
+    },
+    "atmelsam": {
+        "name": "Atmel SAM",
+        "tools": ["platformio/toolchain-gccarmnoneeabi", "platformio/tool-scons"],
+    },
+    "espressif32": {"name": "Espressif 32", "tools": ["platformio/tool-esptool"]},
+}
+
+
+def test_shared_tools_are_installed_once():
+    packages = install_scripts.resolve_pio_packages(
+        ["atmelsam", "atmelavr", "atmelsam", "ststm32"], PIO_TOOLS
+    )
+    assert packages == [
+        {
+            "title": "Atmel SAM",
+            "platform": "atmelsam",
+            "tools": ["platformio/toolchain-gccarmnoneeabi", "platformio/tool-scons"],
+        },
+        {
+            "title": "Atmel AVR",
+            "platform": "atmelavr",
+            "tools": ["platformio/toolchain-atmelavr"],
+        },
+        {"title": "ststm32", "platform": "ststm32", "tools": []},
+    ]
+
+
+def write_reference_pio_script(platforms, pio_tools):
+    """The PlatformIO platform script as it was written before the tools were resolved"""
+    script = "#!/bin/bash\n\n" + install_scripts.DEBUG_TEXT
+    script += install_scripts.PIO_PLATFORM_START_TEXT
+    for platform in platforms:
+        install_command = install_scripts.create_pio_ci_core_command(
+            platform_name=platform, is_tool=False
+        )
+        if platform in pio_tools.keys():
+            for tool in pio_tools[platform]["tools"]:
+                install_command += "\n" + install_scripts.create_pio_ci_core_command(
+                    platform_name=tool, is_tool=True
+                )
+            group_title = pio_tools[platform]["name"]
+        else:
+            group_title = platform
+        script += "\n".join(
+            install_scripts.add_log_to_command(install_command, group_title)
+        )
+    return script + install_scripts.PIO_PLATFORM_END_TEXT
+
+
+@pytest.fixture
+def install_args(tmp_path, monkeypatch):
+    monkeypatch.setattr(install_scripts, "load_pio_tools", lambda: PIO_TOOLS)
+    for folder in ["workspace", "examples", "ci", "artifacts"]:
+        (tmp_path / folder).mkdir()
+
+    def make_install_args(build_platforms, install_jobs):
+        return Namespace(
+            verbose=False,
+            download_cache_path=str(tmp_path / "downloads"),
+            download_cache_ttl=0,
+            offline=True,
+            install_jobs=install_jobs,
+            build_cores=["arduino:avr", "arduino:samd"],
+            build_platforms=build_platforms,
+            workspace_path=str(tmp_path / "workspace"),
+            examples_path=str(tmp_path / "examples"),
+            ci_path=str(tmp_path / "ci"),
+            artifact_path=str(tmp_path / "artifacts"),
+        )
+
+    return make_install_args
+
+
+def read_platform_script(args, toolchain):
+    with open(
+        os.path.join(args.artifact_path, f"install-platforms-{toolchain}.sh")
+    ) as f:
+        return f.read()
+
+
+def test_serial_platform_script(install_args):
+    # without shared tools, the script is the same as before
+    args = install_args(["atmelavr", "espressif32", "ststm32"], 1)
+    assert install_scripts.main(args) == 0
+    assert read_platform_script(args, "platformio") == write_reference_pio_script(
+        ["atmelavr", "espressif32", "ststm32"], PIO_TOOLS
+    )
+    assert "xargs" not in read_platform_script(args, "arduino-cli")
+
+    # with them, only the repeated install of a shared tool is left out
+    args = install_args(["atmelavr", "atmelsam"], 1)
+    assert install_scripts.main(args) == 0
+    reference_lines = write_reference_pio_script(
+        ["atmelavr", "atmelsam"], PIO_TOOLS
+    ).split("\n")
+    repeated_line = "pio pkg install -g --tool platformio/tool-scons"
+    assert reference_lines.count(repeated_line) == 2
+    del reference_lines[
+        len(reference_lines) - 1 - reference_lines[::-1].index(repeated_line)
+    ]
+    assert read_platform_script(args, "platformio").split("\n") == reference_lines
+
+
+def test_parallel_platform_script(install_args):
+    args = install_args(["atmelavr", "atmelsam"], 4)
+    assert install_scripts.main(args) == 0
+    script = read_platform_script(args, "platformio")
+    packages = script.split("<<'PACKAGES'\n")[1].split("\nPACKAGES\n")[0]
+    assert packages.split("\n") == [
+        "platform atmelavr",
+        "platform atmelsam",
+        "tool platformio/toolchain-atmelavr",
+        "tool platformio/tool-scons",
+        "tool platformio/toolchain-gccarmnoneeabi",
+    ]
+    assert "xargs -P 4" in script
+    # the serial installs that follow are the same as with one install job
+    serial_args = install_args(["atmelavr", "atmelsam"], 1)
+    install_scripts.main(serial_args)
+    assert script.replace(
+        install_scripts.PIO_PLATFORM_PREFETCH_TEXT.format(5, 4, packages), ""
+    ) == read_platform_script(serial_args, "platformio")
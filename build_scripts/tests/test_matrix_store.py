@@ -0,0 +1,82 @@
+"""Tests of the final matrix store (build_utils.write_matrix_store and MatrixStore)."""
+
+import os
+
+from build_utils import MatrixStore, get_matrix_offsets_file, write_matrix_store
+
+MATRIX = [
+    {
+        "compiler": "arduino-cli",
+        "board": "mayfly",
+        "example": "examples/simple_logging",
+        "inline_defines": ["MS_BUILD_TEST_XBEE_CELLULAR"],
+        "compiler_flags": [],
+    },
+    {
+        "compiler": "platformio",
+        "board": "mayfly",
+        "example": "examples/menu_a_la_carte",
+        "inline_defines": [],
+        "compiler_flags": ['-D NAME="värde"'],
+    },
+    {"compiler": "platformio", "board": "uno", "example": "examples/a", "empty": {}},
+]
+
+
+def test_round_trip(tmp_path):
+    matrix_file = str(tmp_path / "build_matrix.jsonl")
+    assert write_matrix_store(iter(MATRIX), matrix_file) == len(MATRIX)
+
+    store = MatrixStore(matrix_file)
+    assert len(store) == len(MATRIX)
+    assert list(store) == MATRIX
+    # the store can be iterated more than once
+    assert list(store) == MATRIX
+
+
+def test_one_entry_per_line(tmp_path):
+    matrix_file = str(tmp_path / "build_matrix.jsonl")
+    write_matrix_store(MATRIX, matrix_file)
+
+    with open(matrix_file, "rb") as f:
+        lines = f.read().split(b"\n")
+    assert lines[-1] == b""
+    assert len(lines) - 1 == len(MATRIX)
+    # non-ASCII characters are escaped, so the byte offsets are the character offsets
+    assert all(line.isascii() for line in lines)
+
+
+def test_offsets_point_at_each_entry(tmp_path):
+    matrix_file = str(tmp_path / "build_matrix.jsonl")
+    write_matrix_store(MATRIX, matrix_file)
+
+    store = MatrixStore(matrix_file)
+    with open(matrix_file, "rb") as f:
+        line_starts = [0]
+        for line in f:
+            line_starts.append(line_starts[-1] + len(line))
+    assert list(store.offsets) == line_starts[:-1]
+    assert os.path.getsize(get_matrix_offsets_file(matrix_file)) == 8 * len(MATRIX)
+    for n in reversed(range(len(MATRIX))):
+        assert store[n] == MATRIX[n]
+    assert store[-1] == MATRIX[-1]
+
+
+def test_offsets_without_offsets_file(tmp_path):
+    matrix_file = str(tmp_path / "build_matrix.jsonl")
+    write_matrix_store(MATRIX, matrix_file)
+    with_file = list(MatrixStore(matrix_file).offsets)
+
+    os.remove(get_matrix_offsets_file(matrix_file))
+    store = MatrixStore(matrix_file)
+    assert list(store.offsets) == with_file
+    assert [store[n] for n in range(len(store))] == MATRIX
+
+
+def test_empty_matrix(tmp_path):
+    matrix_file = str(tmp_path / "build_matrix.jsonl")
+    assert write_matrix_store(iter([]), matrix_file) == 0
+
+    store = MatrixStore(matrix_file)
+    assert len(store) == 0
+    assert list(store) == []
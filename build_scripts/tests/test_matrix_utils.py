@@ -0,0 +1,299 @@
+"""Tests of the matrix utilities against the simpler implementations they replaced."""
+
+import json
+import os
+import random
+
+import pytest
+
+import build_utils
+from benchmark_pipeline import (
+    make_synthetic_matrix,
+    reference_remove_nested_duplicates,
+)
+from build_utils import (
+    MATRIX_WILDCARDS,
+    CanonicalHasher,
+    MatrixRuleIndex,
+    dict_product,
+    external_sort,
+    iter_nested_unique,
+    remove_nested_duplicates,
+)
+
+OPTIONS = {
+    "compiler": ["arduino-cli", "platformio"],
+    "example": [f"examples/example_{n}" for n in range(4)],
+    "board": ["mayfly", "stonefly", "uno"],
+    "inline_defines": [[], ["A"], ["A", "B"], ["B", "A"]],
+    "compiler_flags": [[], ["-DX=1"]],
+}
+
+
+def make_matrix():
+    return list(dict_product(OPTIONS))
+
+
+def make_rule(rng, keys):
+    """A rule with some of the values of each of its keys"""
+    return {
+        key: rng.sample(OPTIONS[key], rng.randint(1, len(OPTIONS[key]))) for key in keys
+    }
+
+
+def reference_full_rule_matches(rules):
+    """The previous filter: every rule is expanded and each entry compared as JSON"""
+    expanded = [json.dumps(e) for rule in rules for e in dict_product(rule)]
+    return lambda entry: json.dumps(entry) in expanded
+
+
+def reference_rule_matches(rules, entry):
+    """Check every rule against the entry, one after another"""
+    for rule in rules:
+        if all(
+            value in MATRIX_WILDCARDS
+            or (
+                key in entry
+                and entry[key] in (value if isinstance(value, list) else [value])
+            )
+            for key, value in rule.items()
+        ):
+            return True
+    return False
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_rule_index_matches_full_rules(seed):
+    rng = random.Random(seed)
+    rules = [make_rule(rng, list(OPTIONS)) for _ in range(rng.randint(1, 5))]
+    index = MatrixRuleIndex(rules)
+    reference = reference_full_rule_matches(rules)
+    matrix = make_matrix()
+    assert [index.matches(e) for e in matrix] == [reference(e) for e in matrix]
+    assert len(index) == len(
+        {json.dumps(e) for rule in rules for e in dict_product(rule)}
+    )
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_rule_index_matches_partial_rules(seed):
+    rng = random.Random(seed)
+    rules = []
+    for _ in range(rng.randint(1, 6)):
+        rule = make_rule(rng, rng.sample(list(OPTIONS), rng.randint(1, 3)))
+        # single values, wildcards, and keys that no entry has
+        key = rng.choice(list(rule))
+        roll = rng.random()
+        if roll < 0.2:
+            rule[key] = rng.choice(MATRIX_WILDCARDS)
+        elif roll < 0.4 and key in ["compiler", "board", "example"]:
+            rule[key] = rule[key][0]
+        elif roll < 0.5:
+            rule["pio_env"] = ["mayfly"]
+        rules.append(rule)
+    index = MatrixRuleIndex(rules)
+    matrix = make_matrix()
+    # some entries are missing keys, and some have them in another order
+    for entry in rng.sample(matrix, 20):
+        del entry[rng.choice(list(OPTIONS))]
+    for entry in rng.sample(matrix, 20):
+        items = list(entry.items())
+        rng.shuffle(items)
+        entry.clear()
+        entry.update(items)
+    assert [index.matches(e) for e in matrix] == [
+        reference_rule_matches(rules, e) for e in matrix
+    ]
+
+
+def test_rule_index_without_rules():
+    index = MatrixRuleIndex([])
+    assert len(index) == 0
+    assert not any(index.matches(e) for e in make_matrix())
+    # a rule of only wildcards matches everything
+    index.add_rule({"board": "*", "example": ["*"]})
+    assert all(index.matches(e) for e in make_matrix())
+
+
+def make_value(rng, depth=0):
+    """A random JSON value, with the kinds of values the matrix entries have"""
+    kind = rng.choice(["str", "number", "list", "dict"] if depth < 3 else ["str"])
+    if kind == "str":
+        return rng.choice(["a", "b", "mayfly", "-DX=1", ""])
+    if kind == "number":
+        return rng.choice([0, 1, 1.0, True, False, None])
+    if kind == "list":
+        return [make_value(rng, depth + 1) for _ in range(rng.randint(0, 3))]
+    keys = rng.sample(["board", "inline_defines", "compiler_flags", "job_group"], 2)
+    return {key: make_value(rng, depth + 1) for key in keys}
+
+
+def shuffle_copy(rng, value, ordered=False):
+    """Copy a value, reordering what the de-duplication must not care about"""
+    if isinstance(value, dict):
+        items = [
+            (k, shuffle_copy(rng, v, k in ["inline_defines", "compiler_flags"]))
+            for k, v in value.items()
+        ]
+        rng.shuffle(items)
+        return dict(items)
+    if isinstance(value, list):
+        items = [shuffle_copy(rng, v, ordered) for v in value]
+        if not ordered:
+            rng.shuffle(items)
+        return items
+    return value
+
+
+def make_nested_matrix(rng, size):
+    matrix = []
+    for _ in range(size):
+        if len(matrix) > 0 and rng.random() < 0.3:
+            entry = shuffle_copy(rng, rng.choice(matrix))
+            # entries that only differ in their job group are duplicates
+            if isinstance(entry, dict) and rng.random() < 0.5:
+                entry["job_group"] = rng.choice(["a", "b"])
+        elif rng.random() < 0.1:
+            entry = make_value(rng, 1)
+        else:
+            entry = {
+                "compiler": rng.choice(["arduino-cli", "platformio"]),
+                "inline_defines": rng.choice([[], ["A"], ["A", "B"], ["B", "A"]]),
+                "other_commands": rng.sample(["x", "y", "z"], rng.randint(0, 3)),
+                "extra": make_value(rng, 1),
+            }
+        matrix.append(entry)
+    return matrix
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_unique_entries_match_the_json_reference(seed):
+    matrix = make_nested_matrix(random.Random(seed), 300)
+    expected = reference_remove_nested_duplicates(matrix)
+    assert len(expected) < len(matrix)
+    unique = list(iter_nested_unique(matrix))
+    # the same entries are kept, the first of each
+    assert [id(e) for e in unique] == [id(e) for e in expected]
+    assert [id(e) for e in remove_nested_duplicates(matrix)] == [
+        id(e) for e in expected
+    ]
+
+
+def test_unique_entries_of_a_synthetic_matrix():
+    matrix = make_synthetic_matrix(5000)
+    assert list(iter_nested_unique(matrix)) == reference_remove_nested_duplicates(
+        matrix
+    )
+
+
+def test_unique_entries_are_streamed():
+    read = []
+
+    def entries():
+        for n in range(10):
+            read.append(n)
+            yield {"n": n % 3}
+
+    unique = iter_nested_unique(entries())
+    assert next(unique) == {"n": 0}
+    assert read == [0]
+    assert list(unique) == [{"n": 1}, {"n": 2}]
+
+
+@pytest.fixture
+def sort_chunk_paths(monkeypatch):
+    """Record the temporary directories that external_sort spills its chunks to"""
+    paths = []
+    temporary_directory = build_utils.tempfile.TemporaryDirectory
+
+    class RecordedDirectory(temporary_directory):
+        def __enter__(self):
+            paths.append(super().__enter__())
+            return paths[-1]
+
+    monkeypatch.setattr(build_utils.tempfile, "TemporaryDirectory", RecordedDirectory)
+    return paths
+
+
+@pytest.mark.parametrize("size, chunk_size", [(0, 7), (6, 7), (7, 7), (100, 7)])
+def test_external_sort(sort_chunk_paths, size, chunk_size):
+    rng = random.Random(size)
+    items = [
+        {"key": rng.randint(0, 9), "order": n, "value": make_value(rng, 2)}
+        for n in range(size)
+    ]
+    sorted_items = external_sort(
+        iter(items), key=lambda e: e["key"], chunk_size=chunk_size
+    )
+    first = next(sorted_items, None)
+    if size >= chunk_size:
+        # everything was read and spilled in sorted chunks before the first item
+        (chunk_path,) = sort_chunk_paths
+        assert len(os.listdir(chunk_path)) == -(-size // chunk_size)
+    else:
+        assert sort_chunk_paths == []
+    result = ([first] if first is not None else []) + list(sorted_items)
+    # the sort is stable, and the items come back as they went in
+    assert result == sorted(items, key=lambda e: e["key"])
+    if size >= chunk_size:
+        assert not os.path.exists(sort_chunk_paths[0])
+
+
+def test_external_sort_of_matrix_entries(sort_chunk_paths):
+    matrix = list(iter_nested_unique(make_synthetic_matrix(1000)))
+
+    def matrix_key(entry):
+        return (entry["example"], entry["pio_env"], json.dumps(entry["inline_defines"]))
+
+    assert list(external_sort(matrix, key=matrix_key, chunk_size=64)) == sorted(
+        matrix, key=matrix_key
+    )
+    assert len(sort_chunk_paths) == 1
+
+
+def reference_is_duplicate(first, second):
+    return len(reference_remove_nested_duplicates([first, second])) == 1
+
+
+@pytest.mark.parametrize("seed", range(10))
+def test_canonical_keys_match_the_json_reference(seed):
+    rng = random.Random(seed)
+    matrix = make_nested_matrix(rng, 60)
+    hasher = CanonicalHasher()
+    for first in matrix:
+        for second in matrix:
+            ignore = isinstance(first, dict)
+            same_key = hasher.canonical_key(first, ignore) == hasher.canonical_key(
+                second, isinstance(second, dict)
+            )
+            assert same_key == reference_is_duplicate(first, second)
+            if same_key:
+                assert hasher.digest(first, ignore) == hasher.digest(second, ignore)
+
+
+def test_canonical_keys_do_not_depend_on_the_memo():
+    matrix = make_nested_matrix(random.Random(0), 200)
+    # the entries share their lists, as the entries from dict_product do
+    shared = ["A", "B"]
+    for entry in matrix[::3]:
+        if isinstance(entry, dict):
+            entry["inline_defines"] = shared
+    keys = [CanonicalHasher().canonical_key(e) for e in matrix]
+    for memo_size in [1, 2, 4096]:
+        hasher = CanonicalHasher(memo_size=memo_size)
+        assert [hasher.canonical_key(e) for e in matrix] == keys
+        assert [hasher.canonical_key(e) for e in matrix] == keys
+
+
+def test_canonical_key_ordering_rules():
+    hasher = CanonicalHasher()
+    key = hasher.canonical_key
+    assert key({"a": [1, 2], "b": "x"}) == key({"b": "x", "a": [2, 1]})
+    assert key({"inline_defines": ["A", "B"]}) != key({"inline_defines": ["B", "A"]})
+    assert key({"compiler_flags": [["A", "B"]]}) != key(
+        {"compiler_flags": [["B", "A"]]}
+    )
+    assert key(("a", "b")) != key(("b", "a"))
+    assert len({key(v) for v in [1, 1.0, True, "1", None, "null"]}) == 6
+    assert key({"a": 1, "job_group": "x"}, True) == key({"a": 1}, True)
+    assert key({"a": 1, "job_group": "x"}) != key({"a": 1})
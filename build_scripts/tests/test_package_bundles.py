@@ -0,0 +1,352 @@
+"""Tests of the package manifest, its cache keys, and packing and unpacking bundles."""
+
+import json
+import os
+
+import pytest
+
+import package_bundles
+from package_bundles import (
+    BundleStore,
+    create_package_manifest,
+    find_arduino_core,
+    get_bundles_key,
+    get_lock_file,
+    load_package_lock,
+    locate_bundle,
+    select_bundles,
+    write_package_manifest,
+)
+
+PIO_PLATFORMS = {
+    "platformio/atmelavr": ["platformio/toolchain-atmelavr", "platformio/tool-avrdude"],
+    "platformio/atmelsam": ["platformio/toolchain-gccarmnoneeabi"],
+}
+DEPENDENCIES = [
+    {"name": "SDI-12", "owner": "envirodiy", "version": "~2.1.4", "note": "ignored"},
+    {"name": "SDI-12", "owner": "envirodiy", "version": "~2.1.4"},
+    {"name": "RTCZero", "owner": "arduino-libraries"},
+]
+
+
+def make_manifest():
+    return create_package_manifest(
+        ["arduino:avr", "EnviroDIY:avr@1.0.0", "arduino:avr"],
+        PIO_PLATFORMS,
+        DEPENDENCIES,
+    )
+
+
+def get_bundle(manifest, toolchain, name):
+    return [
+        bundle
+        for bundle in manifest["toolchains"][toolchain]["bundles"]
+        if bundle["name"] == name
+    ][0]
+
+
+def test_manifest_bundles():
+    manifest = make_manifest()
+    arduino = manifest["toolchains"]["arduino-cli"]["bundles"]
+    assert [bundle["name"] for bundle in arduino] == [
+        "core-EnviroDIY-avr",
+        "core-arduino-avr",
+        "libraries",
+    ]
+    pio = manifest["toolchains"]["platformio"]["bundles"]
+    assert [bundle["name"] for bundle in pio] == [
+        "platform-atmelavr",
+        "platform-atmelsam",
+        "libraries",
+    ]
+    assert [p["spec"] for p in pio[0]["packages"]] == [
+        "platformio/atmelavr",
+        "platformio/tool-avrdude",
+        "platformio/toolchain-atmelavr",
+    ]
+    # the same library is only listed once, with only the keys that change it
+    assert pio[2]["packages"] == [
+        {"name": "RTCZero", "owner": "arduino-libraries", "type": "library"},
+        {
+            "name": "SDI-12",
+            "owner": "envirodiy",
+            "version": "~2.1.4",
+            "type": "library",
+        },
+    ]
+    # the same libraries in each toolchain are different bundles
+    assert arduino[2]["hash"] != pio[2]["hash"]
+
+
+def test_manifest_hashes_follow_the_packages(tmp_path):
+    manifest = make_manifest()
+    # the same packages in another order give the same manifest file
+    reordered = create_package_manifest(
+        ["EnviroDIY:avr@1.0.0", "arduino:avr"],
+        dict(reversed(list(PIO_PLATFORMS.items()))),
+        list(reversed(DEPENDENCIES)),
+    )
+    write_package_manifest(manifest, str(tmp_path / "a.json"))
+    write_package_manifest(reordered, str(tmp_path / "b.json"))
+    assert (tmp_path / "a.json").read_bytes() == (tmp_path / "b.json").read_bytes()
+
+    changed = create_package_manifest(
+        ["arduino:avr", "EnviroDIY:avr@1.0.1"], PIO_PLATFORMS, DEPENDENCIES
+    )
+    assert get_bundle(changed, "arduino-cli", "core-arduino-avr") == get_bundle(
+        manifest, "arduino-cli", "core-arduino-avr"
+    )
+    assert (
+        get_bundle(changed, "arduino-cli", "core-EnviroDIY-avr")["hash"]
+        != get_bundle(manifest, "arduino-cli", "core-EnviroDIY-avr")["hash"]
+    )
+    assert (
+        changed["toolchains"]["arduino-cli"]["hash"]
+        != manifest["toolchains"]["arduino-cli"]["hash"]
+    )
+    assert (
+        changed["toolchains"]["platformio"]["hash"]
+        == manifest["toolchains"]["platformio"]["hash"]
+    )
+
+
+def test_bundles_key_has_the_locked_versions():
+    manifest = make_manifest()
+    selected = select_bundles(manifest, ["platformio"], ["platform-atmelavr"])
+    bundle = selected[0][1]
+
+    def lock_versions(versions, bundle_hash=bundle["hash"]):
+        return {
+            "platformio": {
+                "platform-atmelavr": {"hash": bundle_hash, "versions": versions}
+            }
+        }
+
+    unpacked_key = get_bundles_key(selected, {})
+    first = get_bundles_key(selected, lock_versions({"platformio/atmelavr": "5.0.0"}))
+    same = get_bundles_key(selected, lock_versions({"platformio/atmelavr": "5.0.0"}))
+    newer = get_bundles_key(selected, lock_versions({"platformio/atmelavr": "5.1.0"}))
+    assert first == same
+    assert len({unpacked_key, first, newer}) == 3
+    # versions locked for other packages are not used
+    assert (
+        get_bundles_key(
+            selected, lock_versions({"platformio/atmelavr": "5.0.0"}, "other")
+        )
+        == unpacked_key
+    )
+    # the key of a toolchain covers all of its bundles
+    assert get_bundles_key(select_bundles(manifest, ["platformio"], []), {}) != (
+        unpacked_key
+    )
+
+
+def write_pio_package(root, folder, name, version, files):
+    package_dir = os.path.join(root, folder)
+    os.makedirs(package_dir, exist_ok=True)
+    with open(os.path.join(package_dir, ".piopm"), "w") as f:
+        json.dump({"name": name, "version": version, "spec": {"name": name}}, f)
+    for path, content in files.items():
+        file_path = os.path.join(package_dir, path)
+        os.makedirs(os.path.dirname(file_path), exist_ok=True)
+        with open(file_path, "w") as f:
+            f.write(content)
+
+
+def make_pio_roots(base):
+    core_dir = os.path.join(base, ".platformio")
+    return {
+        "pio_platforms": os.path.join(core_dir, "platforms"),
+        "pio_packages": os.path.join(core_dir, "packages"),
+        "pio_lib": os.path.join(core_dir, "lib"),
+        "arduino_data": os.path.join(base, ".arduino15"),
+        "arduino_libraries": os.path.join(base, "Arduino", "libraries"),
+    }
+
+
+def install_atmelavr(roots, version):
+    write_pio_package(
+        roots["pio_platforms"],
+        "atmelavr",
+        "atmelavr",
+        version,
+        {"platform.json": f'{{"version": "{version}"}}'},
+    )
+    write_pio_package(
+        roots["pio_packages"],
+        "toolchain-atmelavr",
+        "toolchain-atmelavr",
+        version,
+        {"bin/avr-gcc": f"gcc {version}", f"lib/only-in-{version}.a": version},
+    )
+    write_pio_package(
+        roots["pio_packages"],
+        "tool-avrdude",
+        "tool-avrdude",
+        "1.0.0",
+        {"avrdude.conf": "shared"},
+    )
+    os.symlink(
+        "avr-gcc",
+        os.path.join(roots["pio_packages"], "toolchain-atmelavr", "bin", "cc"),
+    )
+    os.chmod(
+        os.path.join(roots["pio_packages"], "toolchain-atmelavr", "bin", "avr-gcc"),
+        0o755,
+    )
+
+
+def read_tree(root):
+    tree = {}
+    for dir_path, _, file_names in os.walk(root):
+        for file_name in file_names:
+            file_path = os.path.join(dir_path, file_name)
+            relative = os.path.relpath(file_path, root)
+            if os.path.islink(file_path):
+                tree[relative] = ("link", os.readlink(file_path))
+            else:
+                with open(file_path) as f:
+                    tree[relative] = (f.read(), os.stat(file_path).st_mode & 0o777)
+    return tree
+
+
+def test_pack_and_unpack(tmp_path):
+    manifest = make_manifest()
+    bundle = get_bundle(manifest, "platformio", "platform-atmelavr")
+    installed = make_pio_roots(str(tmp_path / "installed"))
+    install_atmelavr(installed, "5.1.0")
+
+    folders, versions, missing = locate_bundle("platformio", bundle, installed)
+    assert missing == []
+    assert versions == {
+        "platformio/atmelavr": "5.1.0",
+        "platformio/tool-avrdude": "1.0.0",
+        "platformio/toolchain-atmelavr": "5.1.0",
+    }
+    store = BundleStore(str(tmp_path / "store"))
+    index = store.pack(bundle, folders, installed, versions)
+    assert store.has_bundle(bundle)
+    assert store.get_versions(bundle) == versions
+
+    restored = make_pio_roots(str(tmp_path / "restored"))
+    assert store.unpack(bundle, restored) == len(index["files"])
+    for root in ["pio_platforms", "pio_packages"]:
+        assert read_tree(restored[root]) == read_tree(installed[root])
+
+
+def test_unpack_over_an_older_version(tmp_path):
+    manifest = make_manifest()
+    bundle = get_bundle(manifest, "platformio", "platform-atmelavr")
+    installed = make_pio_roots(str(tmp_path / "installed"))
+    install_atmelavr(installed, "5.1.0")
+    store = BundleStore(str(tmp_path / "store"))
+    folders, versions, _ = locate_bundle("platformio", bundle, installed)
+    store.pack(bundle, folders, installed, versions)
+
+    restored = make_pio_roots(str(tmp_path / "restored"))
+    install_atmelavr(restored, "5.0.0")
+    # a package the bundle does not own is left alone
+    write_pio_package(restored["pio_packages"], "tool-other", "tool-other", "1", {})
+    store.unpack(bundle, restored)
+
+    assert read_tree(restored["pio_platforms"]) == read_tree(installed["pio_platforms"])
+    restored_packages = read_tree(restored["pio_packages"])
+    assert "toolchain-atmelavr/lib/only-in-5.0.0.a" not in restored_packages
+    assert "tool-other/.piopm" in restored_packages
+    del restored_packages["tool-other/.piopm"]
+    assert restored_packages == read_tree(installed["pio_packages"])
+
+
+def test_find_arduino_core_uses_the_newest_version(tmp_path):
+    data_dir = str(tmp_path)
+    hardware = os.path.join(data_dir, "packages", "arduino", "hardware", "avr")
+    for version in ["1.8.6", "1.10.0-rc1", "1.10.0", "1.9.0"]:
+        os.makedirs(os.path.join(hardware, version))
+    with open(os.path.join(hardware, "1.10.0", "installed.json"), "w") as f:
+        json.dump(
+            {
+                "packages": [
+                    {
+                        "platforms": [
+                            {
+                                "architecture": "avr",
+                                "toolsDependencies": [
+                                    {
+                                        "packager": "arduino",
+                                        "name": "avr-gcc",
+                                        "version": "7.3.0",
+                                    }
+                                ],
+                            }
+                        ]
+                    }
+                ]
+            },
+            f,
+        )
+    with open(os.path.join(data_dir, "package_index.json"), "w") as f:
+        f.write("{}")
+
+    folders, version = find_arduino_core(data_dir, "arduino:avr")
+    assert version == "1.10.0"
+    assert folders == [
+        os.path.join("packages", "arduino", "hardware", "avr", "1.10.0"),
+        os.path.join("packages", "arduino", "tools", "avr-gcc", "7.3.0"),
+        "package_index.json",
+    ]
+    assert find_arduino_core(data_dir, "arduino:avr@1.8.6")[1] == "1.8.6"
+    assert find_arduino_core(data_dir, "arduino:avr@2.0.0") is None
+
+
+def test_commands_pack_key_and_unpack(tmp_path, monkeypatch, capsys):
+    manifest_file = str(tmp_path / "package_manifest.json")
+    write_package_manifest(make_manifest(), manifest_file)
+    installed = make_pio_roots(str(tmp_path / "installed"))
+    install_atmelavr(installed, "5.1.0")
+    monkeypatch.setenv("PLATFORMIO_CORE_DIR", os.path.dirname(installed["pio_lib"]))
+    common = [
+        "--manifest",
+        manifest_file,
+        "--store",
+        str(tmp_path / "store"),
+        "--toolchain",
+        "platformio",
+    ]
+
+    assert package_bundles.main(["key", "platform-atmelavr"] + common) == 0
+    key_before = capsys.readouterr().out.strip()
+    assert package_bundles.main(["pack", "platform-atmelavr"] + common) == 0
+    lock = load_package_lock(get_lock_file(manifest_file))
+    assert (
+        lock["platformio"]["platform-atmelavr"]["versions"]["platformio/atmelavr"]
+        == "5.1.0"
+    )
+    capsys.readouterr()
+    assert package_bundles.main(["key", "platform-atmelavr"] + common) == 0
+    assert capsys.readouterr().out.strip() != key_before
+
+    # a bundle with a package that is not installed is not packed
+    assert package_bundles.main(["pack", "platform-atmelsam"] + common) == 1
+
+    restored = make_pio_roots(str(tmp_path / "restored"))
+    monkeypatch.setenv("PLATFORMIO_CORE_DIR", os.path.dirname(restored["pio_lib"]))
+    assert package_bundles.main(["unpack"] + common) == 0
+    assert read_tree(restored["pio_packages"]) == read_tree(installed["pio_packages"])
+
+
+@pytest.mark.parametrize(
+    "versions",
+    [["1.8.6", "1.10.0", "1.9.0"], ["1.10.0", "1.10.0-rc1"], ["2.0.0-beta", "1.99.9"]],
+)
+def test_version_sort_key(versions):
+    expected = {
+        "1.8.6": 0,
+        "1.9.0": 1,
+        "1.10.0-rc1": 2,
+        "1.10.0": 3,
+        "1.99.9": 4,
+        "2.0.0-beta": 5,
+    }
+    assert sorted(versions, key=package_bundles.get_version_sort_key) == sorted(
+        versions, key=expected.__getitem__
+    )
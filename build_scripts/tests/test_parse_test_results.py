@@ -0,0 +1,314 @@
+"""Tests of getting the build results from the build metrics and from the logs."""
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+
+import parse_test_results
+from build_utils import (
+    LOG_MANIFEST_FILE_NAME,
+    load_pipeline_stage,
+    read_build_metrics,
+    write_log_manifest,
+)
+from conftest import BUILD_SCRIPTS_PATH
+from parse_test_results import (
+    PIO_LOG_TAIL_BYTES,
+    find_log_files,
+    get_job_info_from_filename,
+    get_job_info_from_metrics,
+    parse_log_file,
+    parse_log_files,
+    read_pio_log,
+    save_results_table,
+    summarize_log_results,
+)
+
+build_jobs = load_pipeline_stage(os.path.join(BUILD_SCRIPTS_PATH, "4_build_jobs.py"))
+
+MATRIX = [
+    {
+        "compiler": "platformio",
+        "example": "examples/menu_a_la_carte",
+        "board": "mayfly",
+        "inline_defines": [],
+        "compiler_flags": [],
+    },
+    {
+        "compiler": "arduino-cli",
+        "example": "examples/simple_logging",
+        "board": "EnviroDIY:avr:envirodiy_mayfly",
+        "inline_defines": ["MS_BUILD_TEST_XBEE_CELLULAR", "BUILD_PUB_MONITOR_MW"],
+        "compiler_flags": [],
+    },
+    {
+        "compiler": "platformio",
+        "example": "examples/logging_to_MMW",
+        "board": "envirodiy_stonefly_m4",
+        "inline_defines": ["TINY_GSM_MODEM_SIM7080"],
+        "compiler_flags": ["-DSDI12_EXTERNAL_PCINT"],
+        "build_commands": ["pio run"],
+        "other_commands": ["echo patched"],
+    },
+]
+
+PIO_LOG = """Processing mayfly (board: mayfly; platform: atmelavr)
+Linking .pio/build/mayfly/firmware.elf
+RAM:   [====      ]  35.4% (used 5796 bytes from 16384 bytes)
+Flash: [===       ]  26.9% (used 34463 bytes from 130048 bytes)
+Environment    Status    Duration
+-------------  --------  ------------
+mayfly         SUCCESS   00:00:07.963
+"""
+
+
+def get_log_file(matrix_item, artifact_path):
+    name_keys = [
+        k for k in matrix_item.keys() if k not in ["build_commands", "other_commands"]
+    ]
+    return build_jobs.get_filename_for_log(matrix_item, artifact_path, name_keys)
+
+
+def get_metrics(matrix_item, artifact_path, **results):
+    """The metrics of a build as a job script writes them, read back from JSON"""
+    command_block = build_jobs.CommandBlock(
+        matrix_item,
+        output_file_name=get_log_file(matrix_item, artifact_path),
+        other_commands=matrix_item.get("other_commands", []),
+        build_commands=matrix_item.get("build_commands", []),
+        compile_cache_key_args=[
+            "arduino-cli" if matrix_item["compiler"] == "arduino-cli" else "platformio"
+        ],
+    )
+    metrics = build_jobs.get_build_metrics(command_block, "log group")
+    metrics.update({"exit_code": 0, "seconds": 12.5, "cached": False} | results)
+    return json.loads(json.dumps(metrics))
+
+
+@pytest.mark.parametrize("matrix_item", MATRIX)
+def test_job_info_from_metrics_matches_log_name(matrix_item, tmp_path):
+    metrics = get_metrics(matrix_item, str(tmp_path))
+    assert get_job_info_from_metrics(metrics) == get_job_info_from_filename(
+        metrics["log_file"]
+    )
+
+
+def test_job_info_columns():
+    metrics = get_metrics(MATRIX[1], "artifacts")
+    assert get_job_info_from_metrics(metrics) == {
+        "compiler": "arduino-cli",
+        "example": "simple-logging",
+        "board": "envirodiy-mayfly",
+        "flag_1": "MS-XBEE-CELLULAR-MONITOR-MW",
+    }
+
+
+def write_pio_log(log_file, text=PIO_LOG, seconds=None):
+    with open(log_file, "w") as f:
+        f.write(text)
+    if seconds is not None:
+        with open(os.path.splitext(log_file)[0] + ".duration", "w") as f:
+            f.write(str(seconds))
+
+
+def test_metrics_and_log_give_the_same_results(tmp_path):
+    log_file = get_log_file(MATRIX[0], str(tmp_path))
+    write_pio_log(log_file, seconds=12.5)
+    sizes = {
+        "ram_used": 5796,
+        "ram_total": 16384,
+        "flash_used": 34463,
+        "flash_total": 130048,
+    }
+    from_log = parse_log_file(log_file)
+    from_metrics = parse_log_file(
+        log_file, get_metrics(MATRIX[0], str(tmp_path), **sizes)
+    )
+    assert from_metrics == from_log
+    assert from_log[0]["success"] is True
+    assert from_log[0]["build_seconds"] == 12.5
+
+
+def test_metrics_sizes_do_not_need_the_log(tmp_path):
+    metrics = get_metrics(
+        MATRIX[0],
+        str(tmp_path),
+        ram_used=1,
+        ram_total=2,
+        flash_used=3,
+        flash_total=4,
+    )
+    # the log is not read when the metrics have the sizes
+    job_info, duration = parse_log_file(None, metrics)
+    assert (job_info["ram_used"], job_info["flash_total"]) == (1, 4)
+    assert duration == (
+        os.path.splitext(metrics["log_file"])[0],
+        "platformio",
+        12.5,
+    )
+
+
+def test_missing_sizes_are_read_from_the_log(tmp_path):
+    log_file = get_log_file(MATRIX[0], str(tmp_path))
+    write_pio_log(log_file)
+    job_info, _ = parse_log_file(log_file, get_metrics(MATRIX[0], str(tmp_path)))
+    assert job_info["ram_used"] == 5796
+    assert job_info["flash_used"] == 34463
+
+
+def test_cached_and_failed_builds_are_not_timed(tmp_path):
+    cached, duration = parse_log_file(
+        None, get_metrics(MATRIX[0], str(tmp_path), cached=True)
+    )
+    assert cached["success"] is True
+    assert "build_seconds" not in cached and duration is None
+
+    failed, duration = parse_log_file(
+        None, get_metrics(MATRIX[0], str(tmp_path), exit_code=1)
+    )
+    assert failed["success"] is False
+    assert "build_seconds" not in failed and duration is None
+
+
+def test_pio_log_sizes_before_the_tail(tmp_path):
+    log_file = str(tmp_path / "platformio_example_mayfly.log")
+    sizes, status = PIO_LOG.split("Environment")
+    # the sizes are far from the end, so the whole log has to be searched
+    write_pio_log(
+        log_file, sizes + "x" * 80 + "\n" * PIO_LOG_TAIL_BYTES + "Environment" + status
+    )
+    assert read_pio_log(log_file) == {
+        "ram_used": 5796,
+        "ram_total": 16384,
+        "flash_used": 34463,
+        "flash_total": 130048,
+        "success": True,
+    }
+
+
+def test_read_build_metrics(tmp_path):
+    metrics_file = str(tmp_path / "job.metrics.jsonl")
+    first = get_metrics(MATRIX[0], str(tmp_path), exit_code=1)
+    second = get_metrics(MATRIX[0], str(tmp_path))
+    other = get_metrics(MATRIX[1], str(tmp_path))
+    with open(metrics_file, "w") as f:
+        for metrics in [first, other, second]:
+            f.write(json.dumps(metrics) + "\n")
+        # the job was stopped while writing the last line
+        f.write(json.dumps(other)[:20])
+    build_metrics = read_build_metrics([metrics_file, str(tmp_path / "missing")])
+    assert build_metrics == {
+        second["log_file"]: second,
+        other["log_file"]: other,
+    }
+
+
+def test_pool_gives_the_same_results(tmp_path):
+    log_files = []
+    for n in range(parse_test_results.MIN_LOGS_FOR_POOL + 6):
+        log_file = str(tmp_path / f"platformio_example-{n}_mayfly.log")
+        write_pio_log(log_file, seconds=n + 1)
+        log_files.append(log_file)
+    metrics = [None] * len(log_files)
+    sequential = parse_log_files(log_files, metrics, workers=1)
+    pooled = parse_log_files(log_files, metrics, workers=2)
+    assert pooled == sequential
+    assert [duration[2] for _, duration in pooled] == list(range(1, len(log_files) + 1))
+
+
+def test_find_log_files_from_manifest(tmp_path):
+    artifact_path = str(tmp_path / "artifacts")
+    os.makedirs(os.path.join(artifact_path, "job_logs"))
+    log_names = ["platformio_a_mayfly.log", "platformio_b_mayfly.log", "missing.log"]
+    write_log_manifest(
+        [
+            {"log_file": name, "toolchain": "platformio", "log_group": "mayfly"}
+            for name in log_names
+        ],
+        os.path.join(artifact_path, LOG_MANIFEST_FILE_NAME),
+    )
+    write_pio_log(os.path.join(artifact_path, log_names[0]))
+    # the logs of a job that were not merged are in the job's own folder
+    write_pio_log(os.path.join(artifact_path, "job_logs", log_names[1]))
+    # logs outside of the artifact path are not found
+    write_pio_log(str(tmp_path / "missing.log"))
+
+    assert find_log_files(artifact_path, quiet=True) == [
+        os.path.join(artifact_path, log_names[0]),
+        os.path.join(artifact_path, "job_logs", log_names[1]),
+    ]
+
+
+def make_log_result(board, example, success, **values):
+    return {
+        "compiler": "platformio",
+        "board": board,
+        "example": example,
+        "flag_debug": values.pop("flag_debug", ""),
+        "success": success,
+        "ram_used": 1024,
+        "ram_total": 4096,
+        "flash_used": 2000,
+        "flash_total": 8000,
+    } | values
+
+
+def test_summarize_log_results():
+    log_results = [
+        make_log_result("uno", "examples/b", True),
+        make_log_result("mayfly", "examples/b", None),
+        make_log_result("mayfly", "examples/a", True, ram_total=0),
+        make_log_result("uno", "examples/a", False, flash_total=None),
+        make_log_result("mayfly", "examples/a", False, flag_debug="MS-DEBUG"),
+        make_log_result("mayfly", "examples/a", True, flash_used=None),
+    ]
+    df = summarize_log_results(log_results)
+    # the failures first, then the successes, then the builds without a result
+    assert df["success"].tolist() == [0, 0, 1, 1, 1, 2]
+    assert df["success"].dtype == np.int8
+    assert df[["board", "example", "flag_debug"]].values.tolist() == [
+        ["mayfly", "examples/a", "MS-DEBUG"],
+        ["uno", "examples/a", ""],
+        ["mayfly", "examples/a", ""],
+        ["mayfly", "examples/a", ""],
+        ["uno", "examples/b", ""],
+        ["mayfly", "examples/b", ""],
+    ]
+    for col in ["compiler", "board", "example", "flag_debug"]:
+        assert isinstance(df[col].dtype, pd.CategoricalDtype)
+    # the rows keep their index, so they can be checked by their place in the list
+    assert df.loc[0, "ram_percent"] == 25.0
+    assert df.loc[0, "flash_percent"] == 25.0
+    # a total of 0 or none, or no used size, gives no percentage
+    assert np.isnan(df.loc[2, "ram_percent"])
+    assert np.isnan(df.loc[3, "flash_percent"])
+    assert np.isnan(df.loc[5, "flash_percent"])
+    assert df.loc[5, "ram_percent"] == 25.0
+
+
+def test_summarize_log_results_without_sizes():
+    df = summarize_log_results(
+        [{"compiler": "platformio", "board": "uno", "example": "examples/a"}]
+    )
+    assert df["success"].tolist() == [2]
+    assert np.isnan(df["ram_percent"].iloc[0])
+    assert np.isnan(df["flash_percent"].iloc[0])
+
+
+def test_results_table_round_trip(tmp_path):
+    pytest.importorskip("pyarrow")
+    df = summarize_log_results(
+        [
+            make_log_result("uno", "examples/b", True),
+            make_log_result("mayfly", "examples/a", False, ram_total=0),
+            make_log_result("mayfly", "examples/a", None, flag_debug="MS-DEBUG"),
+        ]
+    )
+    results_file = str(tmp_path / "build_results.parquet")
+    assert save_results_table(df, results_file)
+    saved = pd.read_parquet(results_file)
+    pd.testing.assert_frame_equal(saved, df.reset_index(drop=True))
+    assert isinstance(saved["board"].dtype, pd.CategoricalDtype)
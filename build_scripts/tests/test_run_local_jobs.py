@@ -0,0 +1,131 @@
+"""Tests of running the generated job scripts locally."""
+
+import os
+import time
+from argparse import Namespace
+
+import pytest
+
+import run_local_jobs
+from build_utils import load_json_file, save_json_file
+from run_local_jobs import JobProgress, ToolchainLocks, run_local_job
+
+pytestmark = pytest.mark.skipif(os.name != "posix", reason="job scripts need bash")
+
+
+def write_jobs(artifact_path, toolchain_scripts):
+    """Write a job matrix for each toolchain with a script for each job"""
+    matrix_files = {v: k for k, v in run_local_jobs.JOB_MATRIX_FILES.items()}
+    for toolchain, scripts in toolchain_scripts.items():
+        jobs = []
+        for n, script in enumerate(scripts):
+            job_tag = f"{toolchain}-{n}"
+            script_file = os.path.join(artifact_path, f"{job_tag}.sh")
+            with open(script_file, "w") as f:
+                f.write(script)
+            jobs.append(
+                {"job_name": job_tag, "job_tag": job_tag, "script": script_file}
+            )
+        save_json_file(os.path.join(artifact_path, matrix_files[toolchain]), jobs)
+
+
+def make_args(tmp_path, **values):
+    args = {
+        "verbose": False,
+        "artifact_path": str(tmp_path),
+        "workspace_path": str(tmp_path),
+        "local_workers": 4,
+        "job_timeout": 0,
+        "toolchain_slots": 1,
+    }
+    args.update(values)
+    return Namespace(**args)
+
+
+def is_running(pid):
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # a killed child that nothing has reaped yet is a zombie
+            return f.read().rsplit(")", 1)[1].split()[0] != "Z"
+    except FileNotFoundError:
+        return False
+
+
+def wait_until_stopped(pid, seconds=5):
+    end = time.monotonic() + seconds
+    while is_running(pid) and time.monotonic() < end:
+        time.sleep(0.05)
+    return not is_running(pid)
+
+
+@pytest.mark.skipif(not os.path.isdir("/proc"), reason="needs /proc")
+def test_timeout_stops_the_job_and_its_children(tmp_path):
+    pid_file = tmp_path / "child.pid"
+    script = tmp_path / "job.sh"
+    script.write_text(f"sleep 60 &\necho $! > {pid_file}\nwait\n")
+    job = {
+        "job_name": "slow",
+        "job_tag": "slow",
+        "toolchain": "platformio",
+        "script": str(script),
+    }
+    locks = ToolchainLocks(1, str(tmp_path / "locks"))
+    result = run_local_job(
+        job, locks, JobProgress(1), str(tmp_path), str(tmp_path), timeout=1
+    )
+    assert result["status"] == "timed out"
+    assert result["return_code"] is None
+    assert result["seconds"] < 30
+    assert wait_until_stopped(int(pid_file.read_text()))
+
+
+def test_failed_job_fails_the_run(tmp_path, capsys):
+    write_jobs(
+        str(tmp_path),
+        {"arduino-cli": ["echo built\n"], "platformio": ["echo broken\nexit 1\n"]},
+    )
+    assert run_local_jobs.main(make_args(tmp_path)) == 1
+    results = {
+        result["job_tag"]: result
+        for result in load_json_file(str(tmp_path / "local_job_results.json"))
+    }
+    assert results["arduino-cli-0"]["status"] == "passed"
+    assert results["platformio-0"]["status"] == "failed"
+    assert results["platformio-0"]["return_code"] == 1
+    with open(results["platformio-0"]["log_file"]) as f:
+        assert f.read() == "broken\n"
+    assert "platformio-0 failed" in capsys.readouterr().out
+
+
+def test_passing_jobs_pass_the_run(tmp_path):
+    write_jobs(str(tmp_path), {"platformio": ["true\n", "true\n"]})
+    assert run_local_jobs.main(make_args(tmp_path)) == 0
+
+
+def get_most_jobs_at_once(tmp_path, toolchain_slots):
+    times_file = tmp_path / "times.txt"
+    script = (
+        f"echo start $(date +%s.%N) >> {times_file}\n"
+        "sleep 0.5\n"
+        f"echo end $(date +%s.%N) >> {times_file}\n"
+    )
+    write_jobs(str(tmp_path), {"platformio": [script] * 3})
+    args = make_args(tmp_path, toolchain_slots=toolchain_slots)
+    assert run_local_jobs.main(args) == 0
+    events = sorted(
+        (float(t), kind)
+        for kind, t in map(str.split, times_file.read_text().split("\n")[:-1])
+    )
+    running = most_running = 0
+    for _, kind in events:
+        running += 1 if kind == "start" else -1
+        most_running = max(most_running, running)
+    return most_running
+
+
+def test_jobs_of_one_toolchain_wait_for_a_slot(tmp_path):
+    assert get_most_jobs_at_once(tmp_path, toolchain_slots=1) == 1
+
+
+def test_jobs_of_one_toolchain_share_the_slots(tmp_path):
+    assert get_most_jobs_at_once(tmp_path, toolchain_slots=3) > 1
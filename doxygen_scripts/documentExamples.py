@@ -1,6 +1,14 @@
 #!/usr/bin/env python
 import re
 import os
+import sys
+
+# The examples are found with the example index from the CI build scripts, which
+# is downloaded next to this script, or is in build_scripts in this repository.
+sys.path.append(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "build_scripts")
+)
+from build_utils import ExampleIndex
 
 # %%
 # Some working directories
@@ -77,32 +85,14 @@ doxy_file_type_patterns = (
 
 # %%
 examples_to_doc = []
-# Find all of the examples in the examples folder, append the path "examples" to it
-if os.path.isdir(f"{examples_path}"):
-    for root, subdirs, files in os.walk(examples_path):
-        for filename in files:
-            file_path = os.path.join(root, filename)
-            if filename == os.path.split(root)[-1] + ".ino" and root not in [
-                ".history",
-                "logger_test",
-                "archive",
-                "tests",
-                "menu_a_la_carte",
-            ]:
-                examples_to_doc.append(os.path.abspath(os.path.realpath(file_path)))
-# append any additional examples from the extras folder, iff it exists
-if os.path.isdir(f"{extras_path}"):
-    for root, subdirs, files in os.walk(extras_path):
-        for filename in files:
-            file_path = os.path.join(root, filename)
-            if filename == os.path.split(root)[-1] + ".ino" and root not in [
-                ".history",
-                "logger_test",
-                "archive",
-                "tests",
-                "menu_a_la_carte",
-            ]:
-                examples_to_doc.append(os.path.abspath(os.path.realpath(file_path)))
+# the names of the other files beside each example's sketch
+example_files = {}
+# Find all of the examples in the examples folder and any additional examples in
+# the extras folder, skipping the .history, archive, logger_test, and tests folders
+for example in ExampleIndex([examples_path, extras_path]).get_examples():
+    sketch_path = os.path.abspath(os.path.realpath(example["sketch"]))
+    examples_to_doc.append(sketch_path)
+    example_files[sketch_path] = example["files"]
 print("Examples to document:")
 print("    ", end="")
 print("\n    ".join(examples_to_doc))
@@ -184,7 +174,7 @@ with open(output_file, "w+") as out_file:
                         len(
                             [
                                 file
-                                for file in os.listdir(os.path.dirname(filename))
+                                for file in example_files[filename]
                                 if re.match(
                                     doxy_file_type_patterns, file, flags=re.IGNORECASE
                                 )
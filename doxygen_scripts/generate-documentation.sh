@@ -94,6 +94,7 @@ echo "::endgroup::"
 
 echo "::group::Creating dox Files from Example Header Lines"
 curl -SL ${WORKFLOW_DIR}documentExamples.py -o documentExamples.py
+curl -SL https://raw.githubusercontent.com/EnviroDIY/workflows/main/build_scripts/build_utils.py -o build_utils.py
 python -u documentExamples.py
 echo "::endgroup::"
 